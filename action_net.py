@@ -40,9 +40,16 @@ class ACT_net(nn.Module):
         self._init_modules()
         self._init_weights()
 
-    def forward(self, im_data, im_info, gt_tubes, gt_rois, num_boxes):
+    def forward(self, im_data, im_info, gt_tubes, gt_rois, num_boxes, base_feat=None, rois=None, im_size=None):
 
-        batch_size = im_data.size(0)
+        # base_feat : precomputed act_base features (see clip_cache.py), im_data is ignored then
+        # rois      : precomputed proposals of a fixed rpn, the rpn is skipped then
+        # im_size   : (height, width) of im_info as ints, see _RPN.forward
+        if base_feat is None:
+            # feed image data to base model to obtain base feature map
+            base_feat = self.act_base(im_data)
+
+        batch_size = base_feat.size(0)
         # print('batch_size :', batch_size)
         n_rois_batch = gt_rois.size(0)
         # print('n_rois_batch :', n_rois_batch)
@@ -53,11 +60,13 @@ class ACT_net(nn.Module):
         gt_rois = gt_rois.data
         num_boxes = num_boxes.data
 
-        # feed image data to base model to obtain base feature map
-        base_feat = self.act_base(im_data)
-
-        # feed base feature map tp RPN to obtain rois
-        rois, rpn_loss_cls, rpn_loss_bbox = self.act_rpn(base_feat, im_info, gt_tubes, gt_rois, num_boxes)
+        if rois is None:
+            # feed base feature map tp RPN to obtain rois
+            rois, rpn_loss_cls, rpn_loss_bbox = self.act_rpn(base_feat, im_info, gt_tubes, gt_rois, num_boxes,
+                                                             im_size=im_size)
+        else:
+            rpn_loss_cls = 0
+            rpn_loss_bbox = 0
         # print('rois.shape :',rois.shape)
         # if it is training phrase, then use ground trubut bboxes for refining
         if self.training:
@@ -70,7 +79,7 @@ class ACT_net(nn.Module):
 
             gt_rois_reshaped = torch.cat((gt_rois[:,:,:4].contiguous().view(n_rois_batch,-1) , gt_tubes[:,:,6].permute(1,0)),dim=1).unsqueeze(0)
             # print('gt_rois_reshaped.shape :',gt_rois_reshaped.shape)
-            roi_data = self.act_proposal_target(rois.unsqueeze(0), gt_rois_reshaped, num_boxes)
+            roi_data = self.act_proposal_target(rois, gt_rois_reshaped, num_boxes)
             rois, rois_label, rois_target, rois_inside_ws, rois_outside_ws = roi_data
 
             rois_label = Variable(rois_label.view(-1).long())
@@ -78,7 +87,6 @@ class ACT_net(nn.Module):
             rois_inside_ws = Variable(rois_inside_ws.view(-1, rois_inside_ws.size(2)))
             rois_outside_ws = Variable(rois_outside_ws.view(-1, rois_outside_ws.size(2)))
         else:
-            rois= rois.unsqueeze(0)
             rois_label = None
             rois_target = None
             rois_inside_ws = None
@@ -121,7 +129,8 @@ class ACT_net(nn.Module):
         # print('rois.shape edwwww 2:',rois.shape)
         # print('rois.shape edwwww 2:',bbox_pred.shape)
         # return 0,0,0,0,0,0
-        return rois,  bbox_pred, torch.Tensor([0]).cuda(),torch.Tensor([0]).cuda(),torch.Tensor([0]).cuda(),torch.Tensor([0]).cuda()
+        zero = bbox_pred.new_zeros(1)
+        return rois,  bbox_pred, zero, zero, zero, zero
         # return rois,  bbox_pred, rpn_loss_cls, rpn_loss_bbox,  act_loss_bbox, rois_label
         # return torch.Tensor([0,0,0,0,0,0]).cuda()
 
@@ -145,8 +154,8 @@ class ACT_net(nn.Module):
         normal_init(self.act_rpn.RPN_cls_score_8, 0, 0.01, truncated)
         normal_init(self.act_rpn.RPN_cls_score_4, 0, 0.01, truncated)
         normal_init(self.act_rpn.RPN_bbox_frame_pred_16, 0, 0.01, truncated)
-        normal_init(self.act_rpn.RPN_bbox_frame_pred_16, 0, 0.01, truncated)
-        normal_init(self.act_rpn.RPN_bbox_frame_pred_16, 0, 0.01, )
+        normal_init(self.act_rpn.RPN_bbox_frame_pred_8, 0, 0.01, truncated)
+        normal_init(self.act_rpn.RPN_bbox_frame_pred_4, 0, 0.01, truncated)
         normal_init(self.act_bbox_pred, 0, 0.001, truncated)
 
     def _init_modules(self):
@@ -158,12 +167,11 @@ class ACT_net(nn.Module):
         model = resnet34(num_classes=400, shortcut_type=resnet_shortcut,
                          sample_size=sample_size, sample_duration=sample_duration,
                          last_fc=False)
-        model = model.cuda()
         model = nn.DataParallel(model, device_ids=None)
 
         self.model_path = '../temporal_localization/resnet-34-kinetics.pth'
         print("Loading pretrained weights from %s" %(self.model_path))
-        model_data = torch.load(self.model_path)
+        model_data = torch.load(self.model_path, map_location='cpu')  # moved with the net, by .to(device)
         model.load_state_dict(model_data['state_dict'])
         # Build resnet.
         self.act_base = nn.Sequential(model.module.conv1, model.module.bn1, model.module.relu,
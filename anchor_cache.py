@@ -0,0 +1,96 @@
+"""
+Anchor grids shared by the proposal and anchor target layers.
+
+Both layers rebuilt the same `np.meshgrid` shifts and shifted anchors on every
+forward pass, although they only depend on the feature map size, the stride,
+the base anchors and the device. `AnchorGrid` builds them once per
+(feat_h, feat_w, stride, scales, ratios, base_size, device, dtype) and keeps
+them, with the inside-image indices of every image size, in a small LRU shared
+by all the layers of the process.
+
+The returned tensors are shared, index them (which copies) but don't modify
+them in place.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+from generate_anchors import generate_anchors
+
+MAX_ENTRIES = 32
+
+_cache = OrderedDict()
+
+
+def _cached(key, build):
+    value = _cache.get(key)
+    if value is None:
+        value = build()
+        _cache[key] = value
+        if len(_cache) > MAX_ENTRIES:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    return value
+
+
+def clear_anchor_cache():
+    _cache.clear()
+
+
+class AnchorGrid(object):
+
+    def __init__(self, feat_stride, scales, ratios, base_size=16):
+        self.feat_stride = int(np.asarray(feat_stride).ravel()[0])
+        self.scales = tuple(np.asarray(scales).ravel().tolist())
+        self.ratios = tuple(np.asarray(ratios).ravel().tolist())
+        self.base_size = base_size
+
+        self.base_anchors = torch.from_numpy(generate_anchors(base_size=base_size,
+                                                              ratios=np.array(ratios),
+                                                              scales=np.array(scales))).float()
+        self.num_anchors = self.base_anchors.size(0)
+
+    def _key(self, *args):
+        return (self.feat_stride, self.scales, self.ratios, self.base_size) + args
+
+    def anchors(self, feat_height, feat_width, device, dtype=torch.float32):
+        """Returns the (K * A, 4) anchors of a feat_height x feat_width map,
+        location-major like the permuted rpn outputs."""
+        device = torch.device(device)
+
+        def build():
+            shift_x = np.arange(0, feat_width) * self.feat_stride
+            shift_y = np.arange(0, feat_height) * self.feat_stride
+            shift_x, shift_y = np.meshgrid(shift_x, shift_y)
+            shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
+                                                 shift_x.ravel(), shift_y.ravel())).transpose())
+            shifts = shifts.contiguous().float()
+
+            K, A = shifts.size(0), self.num_anchors
+            anchors = self.base_anchors.view(1, A, 4) + shifts.view(K, 1, 4)
+            return anchors.view(K * A, 4).to(device=device, dtype=dtype)
+
+        return _cached(self._key('anchors', feat_height, feat_width, device, dtype), build)
+
+    def inside(self, feat_height, feat_width, im_height, im_width, device,
+               allowed_border=0, dtype=torch.float32):
+        """Returns (inds_inside, anchors[inds_inside]) for the anchors that
+        lie inside a im_height x im_width image (+ allowed_border)."""
+        device = torch.device(device)
+        im_height, im_width = int(im_height), int(im_width)
+
+        def build():
+            all_anchors = self.anchors(feat_height, feat_width, device, dtype)
+            keep = ((all_anchors[:, 0] >= -allowed_border) &
+                    (all_anchors[:, 1] >= -allowed_border) &
+                    (all_anchors[:, 2] < im_width + allowed_border) &
+                    (all_anchors[:, 3] < im_height + allowed_border))
+            inds_inside = torch.nonzero(keep).view(-1)
+            return inds_inside, all_anchors[inds_inside, :]
+
+        return _cached(self._key('inside', feat_height, feat_width, im_height, im_width,
+                                 allowed_border, device, dtype), build)
+
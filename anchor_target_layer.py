@@ -16,6 +16,7 @@ import numpy.random as npr
 
 from config import cfg
 from generate_anchors import generate_anchors
+from anchor_cache import AnchorGrid
 from bbox_transform import clip_boxes, bbox_overlaps_batch, bbox_transform_batch
 
 import pdb
@@ -38,9 +39,9 @@ class _AnchorTargetLayer(nn.Module):
 
         self._feat_stride = feat_stride
         self._scales = scales
-        anchor_scales = scales
-        self._anchors = torch.from_numpy(generate_anchors(scales=np.array(anchor_scales), ratios=np.array(ratios))).float()
-        self._num_anchors = self._anchors.size(0)
+        self._anchor_grid = AnchorGrid(feat_stride, scales, ratios)
+        self._anchors = self._anchor_grid.base_anchors
+        self._num_anchors = self._anchor_grid.num_anchors
 
         # allow boxes to sit over the edge by a small amount
         self._allowed_border = 0  # default is 0
@@ -64,31 +65,14 @@ class _AnchorTargetLayer(nn.Module):
         batch_size = gt_boxes.size(0)
 
         feat_height, feat_width = rpn_cls_score.size(2), rpn_cls_score.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
-                                  shift_x.ravel(), shift_y.ravel())).transpose())
-        shifts = shifts.contiguous().type_as(rpn_cls_score).float()
-
         A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(gt_boxes) # move to specific gpu.
-        all_anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        all_anchors = all_anchors.view(K * A, 4)
-
+        K = feat_height * feat_width
         total_anchors = int(K * A)
 
-        keep = ((all_anchors[:, 0] >= -self._allowed_border) &
-                (all_anchors[:, 1] >= -self._allowed_border) &
-                (all_anchors[:, 2] < long(im_info[0][1]) + self._allowed_border) &
-                (all_anchors[:, 3] < long(im_info[0][0]) + self._allowed_border))
-
-        inds_inside = torch.nonzero(keep).view(-1)
-
-        # keep only inside anchors
-        anchors = all_anchors[inds_inside, :]
+        # shifted anchors and the ones inside the image, cached per map / image size
+        inds_inside, anchors = self._anchor_grid.inside(feat_height, feat_width,
+                                                        long(im_info[0][0]), long(im_info[0][1]),
+                                                        gt_boxes.device, self._allowed_border, gt_boxes.dtype)
 
         # label: 1 is positive, 0 is negative, -1 is dont care
         labels = gt_boxes.new(batch_size, inds_inside.size(0)).fill_(-1)
@@ -15,9 +15,10 @@ import numpy as np
 import numpy.random as npr
 
 from config import cfg
-from generate_anchors import generate_anchors  
+from generate_anchors import generate_anchors
+from anchor_cache import AnchorGrid
 # from bbox_transform import clip_boxes, bbox_overlaps_batch, bbox_overlaps_time, bbox_transform_batch
-from bbox_transform import clip_boxes, bbox_overlaps_time, bbox_transform_batch, bbox_overlaps_rois
+from bbox_transform import clip_boxes, bbox_overlaps_windows, bbox_transform_batch
 import pdb
 
 DEBUG = False
@@ -39,9 +40,9 @@ class _AnchorTargetLayer(nn.Module):
 
         self._feat_stride = feat_stride
         self._scales = scales
-        anchor_scales = scales
-        self._anchors = torch.from_numpy(generate_anchors(scales=np.array(anchor_scales), ratios=np.array(ratios))).float()
-        self._num_anchors = self._anchors.size(0)
+        self._anchor_grid = AnchorGrid(feat_stride, scales, ratios)
+        self._anchors = self._anchor_grid.base_anchors
+        self._num_anchors = self._anchor_grid.num_anchors
 
         # allow boxes to sit over the edge by a small amount
         self._allowed_border = 0  # default is 0
@@ -55,222 +56,137 @@ class _AnchorTargetLayer(nn.Module):
         # filter out-of-image anchors
 
         rpn_cls_score = input[0] ## rpn classification score
-        gt_tubes = input[1]      ## gt tube
-        im_info = input[2]       ## im_info
-        gt_rois = input[3]       ## gt rois for each frame
+        gt_tubes = input[1]      ## gt tubes, (b, K, 7) x1, y1, t1, x2, y2, t2, label
+        im_info = input[2]       ## im_info, or the (height, width) of the image as ints
+        gt_rois = input[3]       ## gt rois for each frame of the tubes, (b, K, T, 5)
         num_boxes = input[4]     ## number of gt_boxes 
-        time_limit = input[5]    ## time limit
+        time_limit = input[5]    ## time limit, or a list of them
 
         # map of shape (..., H, W)
+        # every gt tube of every clip is handled at once: an anchor is
+        # assigned to the tube of its clip it overlaps the most and regresses
+        # the boxes of that tube at each frame.
+        # An anchor lasting time_limit frames is placed at every position
+        # of the clip, like the temporal convolution of its rpn branch, so
+        # there are b * (T - time_limit + 1) rows of labels. The per frame
+        # overlaps are computed once for all the time limits.
 
-        ### Not sure about that
-        # print('$$$$$$$$$$')
-        # print('time_limit :',time_limit)
         height, width = rpn_cls_score.size(2), rpn_cls_score.size(3)
-        gt_tube_batch_size = gt_tubes.size(0)
-        gt_rois_batch_size = time_limit
-
-        # print('gt_tubes.shape :', gt_tubes.shape)
-        # print('gt_tubes :', gt_tubes)
-
-        # print('gt_rois.shape :', gt_rois.shape)
-        # print('gt_rois :', gt_rois.squeeze())
+        batch_size = gt_tubes.size(0)
 
         feat_height, feat_width = rpn_cls_score.size(2), rpn_cls_score.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
-                                  shift_x.ravel(), shift_y.ravel())).transpose())
-        shifts = shifts.contiguous().type_as(rpn_cls_score).float()
-
         A = self._num_anchors
-        K = shifts.size(0)
-        # print("A {}, K {}".format(A,K))
-
-        self._anchors = self._anchors.type_as(gt_tubes) # move to specific gpu.
-        all_anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        all_anchors = all_anchors.view(K * A, 4)
-        # print('all_anchors.shape :', all_anchors.shape)
-        # print('all_anchors[0] :', all_anchors[0])
-
+        K = feat_height * feat_width
         total_anchors = int(K * A)
-        
-        keep = ((all_anchors[:, 0] >= -self._allowed_border) &
-                (all_anchors[:, 1] >= -self._allowed_border) &
-                (all_anchors[:, 2] < long(im_info[0][1]) + self._allowed_border) &
-                (all_anchors[:, 3] < long(im_info[0][0]) + self._allowed_border))
 
-        inds_inside = torch.nonzero(keep).view(-1)
+        # shifted anchors and the ones inside the image, cached per map / image size.
+        # The size of a device im_info has to be read back to the host.
+        if torch.is_tensor(im_info):
+            im_height, im_width = long(im_info[0][0]), long(im_info[0][1])
+        else:
+            im_height, im_width = im_info
+        inds_inside, anchors = self._anchor_grid.inside(feat_height, feat_width, im_height, im_width,
+                                                        gt_tubes.device, self._allowed_border, gt_tubes.dtype)
 
-        # keep only inside anchors
-        anchors = all_anchors[inds_inside, :]
+        time_limits = time_limit if isinstance(time_limit, (list, tuple)) else [time_limit]
 
-        # label: 1 is positive, 0 is negative, -1 is dont care
-        tube_labels = gt_tubes.new(gt_tube_batch_size, inds_inside.size(0)).fill_(-1)
-        rois_labels = gt_tubes.new(gt_rois_batch_size, inds_inside.size(0)).fill_(-1)
+        # count tube ovelaps, (b, n_windows, N, K) per time limit
+        overlaps = bbox_overlaps_windows(anchors, gt_rois, time_limits)
 
-        rois_bbox_inside_weights = gt_rois.new(gt_rois_batch_size, inds_inside.size(0)).zero_()
-        rois_bbox_outside_weights = gt_rois.new(gt_rois_batch_size, inds_inside.size(0)).zero_()
+        outputs = []
+        for time_limit in time_limits:
+            n_windows = overlaps[time_limit].size(1)
+            # (b * n_windows, K, time_limit, 5) boxes of the tubes in each window
+            gt_windows = gt_rois.unfold(2, time_limit, 1).permute(0, 2, 1, 4, 3).contiguous()
+            gt_windows = gt_windows.view(batch_size * n_windows, gt_rois.size(1), time_limit, gt_rois.size(3))
+
+            outputs.append(self._window_targets(overlaps[time_limit].view(batch_size * n_windows, -1, gt_rois.size(1)),
+                                                gt_windows, anchors, inds_inside, total_anchors, height, width))
 
-        # count tube ovelaps
-        tube_overlaps = bbox_overlaps_time(anchors, gt_tubes, time_limit)
-        rois_overlaps = bbox_overlaps_rois(anchors, gt_rois, time_limit)
+        if not isinstance(input[5], (list, tuple)):
+            return outputs[0]
+        return outputs
 
-        # print('rois_overlaps.shape :',rois_overlaps.shape)
+    def _window_targets(self, overlaps, gt_rois, anchors, inds_inside, total_anchors, height, width):
+        """ labels, bbox targets and weights of the anchors of (b, N, K)
+        overlaps with the gt tubes of (b, K, T, 5) boxes """
 
-        ##################################################################
-        # Until now, we have calculate overlaps for gt_tubes and anchors #
-        ##################################################################
+        batch_size, time_dim = gt_rois.size(0), gt_rois.size(2)
+        A = self._num_anchors
 
-        tube_max_overlaps, tube_argmax_overlaps = torch.max(tube_overlaps, 2)
-        rois_max_overlaps = tube_max_overlaps.expand(gt_rois_batch_size,-1)
-        rois_argmax_overlaps = tube_argmax_overlaps.expand(gt_rois_batch_size,-1)
+        # label: 1 is positive, 0 is negative, -1 is dont care
+        labels = gt_rois.new(batch_size, inds_inside.size(0)).fill_(-1)
 
-        gt_tube_max_overlaps, _ = torch.max(tube_overlaps, 1) ## contains the anchor closer to the gt_tube
-        gt_rois_max_overlaps, _ = torch.max(rois_overlaps, 1)  
+        max_overlaps, argmax_overlaps = torch.max(overlaps, 2)
+        gt_max_overlaps, _ = torch.max(overlaps, 1) ## contains the anchor closer to each gt_tube
 
-        # print('gt_rois_max_overlaps.shape :',gt_rois_max_overlaps.shape)
-        # print('gt_rois_max_overlaps :',gt_rois_max_overlaps)
         if not cfg.TRAIN.RPN_CLOBBER_POSITIVES:
-            tube_labels[tube_max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
-            rois_labels[rois_max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
+            labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
 
-        gt_tube_max_overlaps[gt_tube_max_overlaps==0] = 1e-5
+        # padding tubes overlap nothing, don't let them keep any anchor
+        gt_max_overlaps[gt_max_overlaps==0] = 1e-5
 
-        tube_keep = torch.sum(tube_overlaps.eq(gt_tube_max_overlaps.view(gt_tube_batch_size,1,-1).expand_as(tube_overlaps)), 2)
-        if torch.sum(tube_keep) > 0: # check if there is any 1,
-            tube_labels[tube_keep>0] = 1
+        keep = torch.sum(overlaps.eq(gt_max_overlaps.view(batch_size,1,-1).expand_as(overlaps)), 2)
+        labels[keep>0] = 1
 
         # fg label: above threshold IOU
-        tube_labels[tube_max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP] = 1
+        labels[max_overlaps >= cfg.TRAIN.RPN_POSITIVE_OVERLAP] = 1
 
         if cfg.TRAIN.RPN_CLOBBER_POSITIVES:
-            tube_labels[tube_max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
-
-        tube_num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCHSIZE)
-
-        tube_sum_fg = torch.sum((tube_labels == 1).int(), 1)
-        tube_sum_bg = torch.sum((tube_labels == 0).int(), 1)
-
-        ## this loop in only for subsampling if we have too many background and foreground samples
-        for i in range(gt_tube_batch_size):
-            # subsample positive labels if we have too many
-            if tube_sum_fg[i] > tube_num_fg:
-                tube_fg_inds = torch.nonzero(tube_labels[i] == 1).view(-1)
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                #rand_num = torch.randperm(fg_inds.size(0)).type_as(gt_tubes).long()
-                tube_rand_num = torch.from_numpy(np.random.permutation(tube_fg_inds.size(0))).type_as(gt_tubes).long()
-                tube_disable_inds = tube_fg_inds[tube_rand_num[:tube_fg_inds.size(0)-tube_num_fg]]
-                tube_labels[i][tube_disable_inds] = -1
-
-            tube_num_bg = cfg.TRAIN.RPN_BATCHSIZE - torch.sum((tube_labels == 1).int(), 1)[i]
-
-            # subsample negative labels if we have too many
-            if tube_sum_bg[i] > tube_num_bg:
-                tube_bg_inds = torch.nonzero(tube_labels[i] == 0).view(-1)
-
-                tube_rand_num = torch.from_numpy(np.random.permutation(tube_bg_inds.size(0))).type_as(gt_rois).long()
-                tube_disable_inds = tube_bg_inds[tube_rand_num[:tube_bg_inds.size(0)-tube_num_bg]]
-                tube_labels[i][tube_disable_inds] = -1
-
-        # for i in range(gt_rois_batch_size):
-        #     # subsample positive labels if we have too many
-        #     if rois_sum_fg[i] > rois_num_fg:
-        #         rois_fg_inds = torch.nonzero(rois_labels[i] == 1).view(-1)
-        #         # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-        #         # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-        #         # use numpy instead.
-        #         #rand_num = torch.randperm(fg_inds.size(0)).type_as(gt_tubes).long()
-        #         rois_rand_num = torch.from_numpy(np.random.permutation(rois_fg_inds.size(0))).type_as(gt_rois).long()
-        #         rois_disable_inds = rois_fg_inds[rois_rand_num[:rois_fg_inds.size(0)-rois_num_fg]]
-        #         rois_labels[i][rois_disable_inds] = -1
-
-        #     rois_num_bg = cfg.TRAIN.RPN_BATCHSIZE - torch.sum((rois_labels == 1).int(), 1)[i]
-
-        #     # subsample negative labels if we have too many
-        #     if rois_sum_bg[i] > rois_num_bg:
-        #         rois_bg_inds = torch.nonzero(rois_labels[i] == 0).view(-1)
-
-        #         rois_rand_num = torch.from_numpy(np.random.permutation(rois_bg_inds.size(0))).type_as(gt_rois).long()
-        #         rois_disable_inds = rois_bg_inds[rois_rand_num[:rois_bg_inds.size(0)-rois_num_bg]]
-        #         rois_labels[i][rois_disable_inds] = -1
-
-
-        ##################################################################################################################
-        # MEXRI EDW EXW ALLAKSEI TON KWDIKA, NA ton dw vima vima
-        ##################################################################################################################
-
-        rois_offset = torch.arange(0, gt_rois_batch_size)*gt_rois.size(1)
-        rois_argmax_overlaps = rois_argmax_overlaps + rois_offset.view(gt_rois_batch_size, 1).type_as(rois_argmax_overlaps)
-        rois_bbox_targets = _compute_targets_batch(anchors, gt_rois.view(-1,5)[rois_argmax_overlaps.view(-1), :].view(gt_rois_batch_size, -1, 5))
-        # print('rois_bbox_targets :',rois_bbox_targets)
-        # print('rois_bbox_targets.shape :',rois_bbox_targets.shape)
-        # print('tube_labels==1 :',tube_labels==1)
-        # print('tube_labels==1.shape :',(tube_labels.expand((gt_rois_batch_size,-1))==1).shape)
-        rois_bbox_inside_weights[tube_labels.expand((gt_rois_batch_size,-1))==1] = cfg.TRAIN.RPN_BBOX_INSIDE_WEIGHTS[0]
-        # print('bbox_inside_weights after :',bbox_inside_weights)
-        
+            labels[max_overlaps < cfg.TRAIN.RPN_NEGATIVE_OVERLAP] = 0
 
-        if cfg.TRAIN.RPN_POSITIVE_WEIGHT < 0:
-            tube_num_examples = torch.sum(tube_labels[0] >= 0)
-            tube_positive_weights = 1.0 / tube_num_examples.item()
-            tube_negative_weights = 1.0 / tube_num_examples.item()
-        else:
-            assert ((cfg.TRAIN.RPN_POSITIVE_WEIGHT > 0) &
-                    (cfg.TRAIN.RPN_POSITIVE_WEIGHT < 1))
+        # subsample positive labels if we have too many, then negative ones
+        num_fg = int(cfg.TRAIN.RPN_FG_FRACTION * cfg.TRAIN.RPN_BATCHSIZE)
+        _subsample(labels, 1, num_fg)
+        num_bg = cfg.TRAIN.RPN_BATCHSIZE - torch.sum((labels == 1).int(), 1)
+        _subsample(labels, 0, num_bg)
+
+        # boxes of the assigned tube at every frame, (b * T, N, 5)
+        gt_frames = gt_rois.permute(0, 2, 1, 3)
+        gt_frames = torch.gather(gt_frames, 2, argmax_overlaps.view(batch_size, 1, -1, 1).expand(
+            batch_size, time_dim, argmax_overlaps.size(1), gt_frames.size(3)))
+        bbox_targets = _compute_targets_batch(anchors, gt_frames.contiguous().view(batch_size * time_dim, -1, 5))
+
+        bbox_inside_weights = gt_rois.new(batch_size, inds_inside.size(0)).zero_()
+        bbox_inside_weights[labels==1] = cfg.TRAIN.RPN_BBOX_INSIDE_WEIGHTS[0]
 
         if cfg.TRAIN.RPN_POSITIVE_WEIGHT < 0:
-            rois_num_examples = torch.sum(rois_labels[i] >= 0)
-            rois_positive_weights = 1.0 / rois_num_examples.item()
-            rois_negative_weights = 1.0 / rois_num_examples.item()
+            num_examples = torch.sum((labels >= 0).type_as(labels), 1, keepdim=True).clamp(min=1)
+            positive_weights = 1.0 / num_examples
+            negative_weights = 1.0 / num_examples
         else:
             assert ((cfg.TRAIN.RPN_POSITIVE_WEIGHT > 0) &
                     (cfg.TRAIN.RPN_POSITIVE_WEIGHT < 1))
 
-        rois_bbox_outside_weights[rois_labels == 1] = rois_positive_weights
-        rois_bbox_outside_weights[rois_labels == 0] = rois_negative_weights
-
-        tube_labels = _unmap(tube_labels, total_anchors, inds_inside, gt_tube_batch_size, fill=-1)
-        rois_labels = _unmap(rois_labels, total_anchors, inds_inside, gt_rois_batch_size, fill=-1)
+        bbox_outside_weights = gt_rois.new(batch_size, inds_inside.size(0)).zero_()
+        bbox_outside_weights = torch.where(labels == 1, positive_weights, bbox_outside_weights)
+        bbox_outside_weights = torch.where(labels == 0, negative_weights, bbox_outside_weights)
 
-        rois_bbox_targets = _unmap(rois_bbox_targets, total_anchors, inds_inside, gt_rois_batch_size, fill=0)  
-        rois_bbox_inside_weights = _unmap(rois_bbox_inside_weights, total_anchors, inds_inside, gt_rois_batch_size, fill=0)
-        rois_bbox_outside_weights = _unmap(rois_bbox_outside_weights, total_anchors, inds_inside, gt_rois_batch_size, fill=0)
+        labels = _unmap(labels, total_anchors, inds_inside, batch_size, fill=-1)
+        bbox_targets = _unmap(bbox_targets, total_anchors, inds_inside, batch_size * time_dim, fill=0)
+        bbox_inside_weights = _unmap(bbox_inside_weights, total_anchors, inds_inside, batch_size, fill=0)
+        bbox_outside_weights = _unmap(bbox_outside_weights, total_anchors, inds_inside, batch_size, fill=0)
 
         outputs = []
 
         ### tube
 
-        tube_labels = tube_labels.view(gt_tube_batch_size, height, width, A).permute(0,3,1,2).contiguous()
-        tube_labels = tube_labels.view(gt_tube_batch_size, 1, A * height, width)
+        labels = labels.view(batch_size, height, width, A).permute(0,3,1,2).contiguous()
+        labels = labels.view(batch_size, 1, A * height, width)
+        outputs.append(labels)
 
-        # print('tube_labels.shape :',tube_labels.shape)
-        outputs.append(tube_labels)
+        #### rois, (b, T * 4A, H, W) like the per frame bbox predictions
 
+        bbox_targets = bbox_targets.view(batch_size, time_dim, height, width, A*4).permute(0,1,4,2,3).contiguous()
+        bbox_targets = bbox_targets.view(batch_size, time_dim * A * 4, height, width)
+        outputs.append(bbox_targets)
 
-        #### rois
-
-        rois_bbox_targets = rois_bbox_targets.view(gt_rois_batch_size, height, width, A*4).permute(0,3,1,2).contiguous()
-        rois_bbox_targets = rois_bbox_targets.view(-1,7,7)
-        outputs.append(rois_bbox_targets)
-
-        rois_anchors_count = rois_bbox_inside_weights.size(1)
-        rois_bbox_inside_weights = rois_bbox_inside_weights.view(
-            gt_rois_batch_size,rois_anchors_count,1).expand(gt_rois_batch_size, rois_anchors_count, 4)
-        rois_bbox_inside_weights = rois_bbox_inside_weights.contiguous().view(gt_rois_batch_size, height, width, 4*A)\
-                            .permute(0,3,1,2).contiguous()
-        rois_bbox_inside_weights = rois_bbox_inside_weights.view(-1,7,7)
-        outputs.append(rois_bbox_inside_weights)
-
-        rois_bbox_outside_weights = rois_bbox_outside_weights.view(
-            gt_rois_batch_size,rois_anchors_count,1).expand(gt_rois_batch_size, rois_anchors_count, 4)
-        rois_bbox_outside_weights = rois_bbox_outside_weights.contiguous().view(gt_rois_batch_size, height, width, 4*A)\
-                            .permute(0,3,1,2).contiguous()
-        rois_bbox_outside_weights = rois_bbox_outside_weights.view(-1,7,7)
-        outputs.append(rois_bbox_outside_weights)
+        # the same weights at every frame
+        for weights in (bbox_inside_weights, bbox_outside_weights):
+            weights = weights.view(batch_size, 1, height, width, A, 1).expand(
+                batch_size, time_dim, height, width, A, 4)
+            weights = weights.permute(0,1,4,5,2,3).contiguous().view(batch_size, time_dim * A * 4, height, width)
+            outputs.append(weights)
 
         return outputs
 
@@ -282,15 +198,33 @@ class _AnchorTargetLayer(nn.Module):
         """Reshaping happens during the call to forward."""
         pass
 
+def _subsample(labels, value, max_num):
+    """ Randomly disable (set to -1) the labels equal to value beyond max_num
+    of each row, max_num an int or a (b,) tensor. The labels of a row are
+    ranked by random keys, a random permutation of every row at once on the
+    labels' device """
+
+    candidates = labels == value
+    keys = torch.rand(labels.size(), device=labels.device)
+    keys.masked_fill_(~candidates, 2)
+    order = torch.argsort(keys, 1)
+    rank = torch.empty_like(order).scatter_(
+        1, order, torch.arange(labels.size(1), device=labels.device).expand_as(order).contiguous())
+    if torch.is_tensor(max_num):
+        max_num = max_num.view(-1, 1)
+    labels[candidates & (rank >= max_num)] = -1
+    return labels
+
+
 def _unmap(data, count, inds, batch_size, fill=0):
     """ Unmap a subset of item (data) back to the original set of items (of
     size count) """
 
     if data.dim() == 2:
-        ret = torch.Tensor(batch_size, count).fill_(fill).type_as(data)
+        ret = data.new(batch_size, count).fill_(fill)
         ret[:, inds] = data
     else:
-        ret = torch.Tensor(batch_size, count, data.size(2)).fill_(fill).type_as(data)
+        ret = data.new(batch_size, count, data.size(2)).fill_(fill)
         ret[:, inds,:] = data
     return ret
 
@@ -0,0 +1,205 @@
+"""
+Indexed, memory-mapped annotation stores.
+
+`BoxStore` turns a `{video_key: [[x1, y1, x2, y2], ...]}` json file (e.g.
+JHMDB's poses.json) into one contiguous float32 array of boxes plus a
+per-video (offset, count) index. Both are cached next to the json file and
+rebuilt when the json is newer than the cache. The box array is opened with
+`mmap_mode='r'`, so DataLoader workers share the same pages instead of each
+holding (and copy-on-write touching) its own parsed json.
+
+`TubeStore` does the same for UCF-101-24's pyannot.pkl. Instead of a dense
+(n_actions, n_frames, 5) float64 array per video, it keeps a columnar
+per-action table (start frame, end frame, label, box offset) and a CSR-style
+float32 box buffer, and builds the rois of a clip on demand.
+"""
+
+import os
+import json
+import pickle
+
+import numpy as np
+
+
+def _cache_is_valid(source_file, cache_files):
+    if not all(os.path.exists(fl) for fl in cache_files):
+        return False
+    source_mtime = os.stat(source_file).st_mtime
+    return min(os.stat(fl).st_mtime for fl in cache_files) >= source_mtime
+
+
+def save_npy(path, array):
+    dir_path = os.path.dirname(path)
+    if dir_path and not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    # write to a temporary name first, so a reader never sees half a file, and
+    # a name per process, so that two processes building it don't collide
+    tmp_path = path[:-len('.npy')] + '.tmp.{}.npy'.format(os.getpid())
+    np.save(tmp_path, array)
+    os.rename(tmp_path, path)
+
+
+def _save_json(path, obj):
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(obj, fp)
+    os.rename(path + '.tmp', path)
+
+
+class BoxStore(object):
+
+    def __init__(self, json_file):
+        self.json_file = json_file
+        self.boxes_file = json_file + '.boxes.npy'
+        self.index_file = json_file + '.index.json'
+
+        if not _cache_is_valid(json_file, [self.boxes_file, self.index_file]):
+            self.build()
+
+        with open(self.index_file, 'r') as fp:
+            self.index = json.load(fp)
+        self._boxes = None  # opened lazily, so every worker maps it after fork
+
+    def build(self):
+        with open(self.json_file, 'r') as fp:
+            data = json.load(fp)
+
+        index = {}
+        arrays = []
+        offset = 0
+        for key in sorted(data.keys()):
+            boxes = np.asarray(data[key], dtype=np.float32).reshape(-1, 4)
+            index[key] = [offset, boxes.shape[0]]
+            arrays.append(boxes)
+            offset += boxes.shape[0]
+        all_boxes = np.concatenate(arrays, 0) if arrays else np.zeros((0, 4), np.float32)
+
+        save_npy(self.boxes_file, all_boxes)
+        _save_json(self.index_file, index)
+
+    @property
+    def all_boxes(self):
+        if self._boxes is None:
+            self._boxes = np.load(self.boxes_file, mmap_mode='r')
+        return self._boxes
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def n_frames(self, key):
+        return self.index[key][1]
+
+    def boxes(self, key):
+        """Returns a read-only (n_frames, 4) view over the boxes of `key`."""
+        offset, count = self.index[key]
+        return self.all_boxes[offset:offset + count]
+
+    def __getstate__(self):
+        # don't pickle the memory map into spawned workers
+        state = self.__dict__.copy()
+        state['_boxes'] = None
+        return state
+
+
+class TubeStore(object):
+    """Columnar view over pyannot.pkl.
+
+    <pkl>.actions.npy : int32 (n_actions, 4) -> start frame, end frame, label, box offset
+    <pkl>.boxes.npy   : float32 (n_boxes, 4) -> x, y, w, h of every annotated frame
+    <pkl>.videos.json : {video: [action offset, n_actions, n_frames, label]}
+    """
+
+    def __init__(self, pkl_file):
+        self.pkl_file = pkl_file
+        self.actions_file = pkl_file + '.actions.npy'
+        self.boxes_file = pkl_file + '.boxes.npy'
+        self.videos_file = pkl_file + '.videos.json'
+
+        if not _cache_is_valid(pkl_file, [self.actions_file, self.boxes_file, self.videos_file]):
+            convert_pyannot(pkl_file)
+
+        with open(self.videos_file, 'r') as fp:
+            self.videos = json.load(fp)
+        self._actions = None
+        self._boxes = None
+
+    @property
+    def actions(self):
+        if self._actions is None:
+            self._actions = np.load(self.actions_file, mmap_mode='r')
+        return self._actions
+
+    @property
+    def all_boxes(self):
+        if self._boxes is None:
+            self._boxes = np.load(self.boxes_file, mmap_mode='r')
+        return self._boxes
+
+    def __contains__(self, video):
+        return video in self.videos
+
+    def __len__(self):
+        return len(self.videos)
+
+    def n_frames(self, video):
+        return self.videos[video][2]
+
+    def label(self, video):
+        return self.videos[video][3]
+
+    def clip_rois(self, video, frame_indices):
+        """Returns the (n_actions, len(frame_indices), 5) float32 rois
+        [x, y, w, h, label] of a clip. Frames outside an action have label -1,
+        just like slicing the old dense per-video array."""
+        action_offset, n_actions = self.videos[video][:2]
+        frames = np.asarray(frame_indices, dtype=np.int64)
+
+        rois = np.zeros((n_actions, len(frames), 5), dtype=np.float32)
+        rois[:, :, 4] = -1
+        for k in range(n_actions):
+            s_frame, e_frame, label, box_offset = self.actions[action_offset + k]
+            inside = (frames >= s_frame) & (frames < e_frame)
+            rois[k, inside, :4] = self.all_boxes[box_offset + frames[inside] - s_frame]
+            rois[k, inside, 4] = label
+
+        return rois
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_actions'] = None
+        state['_boxes'] = None
+        return state
+
+
+def convert_pyannot(pkl_file):
+    """Converts pyannot.pkl into the files read by `TubeStore`."""
+    with open(pkl_file, 'rb') as fp:
+        boxes_data = pickle.load(fp)
+
+    videos = {}
+    actions = []
+    boxes = []
+    n_boxes = 0
+    for vid, values in boxes_data.items():  # keeps the pickle's video order
+        annots = values['annotations']
+        videos[vid] = [len(actions), len(annots), int(values['numf']), int(values['label'])]
+        for sample in annots:
+            vid_boxes = np.asarray(sample['boxes'], dtype=np.float32).reshape(-1, 4)
+            actions.append([sample['sf'], sample['ef'], sample['label'], n_boxes])
+            boxes.append(vid_boxes)
+            n_boxes += vid_boxes.shape[0]
+
+    actions = np.asarray(actions, dtype=np.int32).reshape(-1, 4)
+    boxes = np.concatenate(boxes, 0) if boxes else np.zeros((0, 4), np.float32)
+
+    save_npy(pkl_file + '.actions.npy', actions)
+    save_npy(pkl_file + '.boxes.npy', boxes)
+    _save_json(pkl_file + '.videos.json', videos)
+    print('converted {} videos, {} actions'.format(len(videos), actions.shape[0]))
+
+
+if __name__ == '__main__':
+
+    convert_pyannot('./pyannot.pkl')
@@ -12,6 +12,8 @@ import torch
 import numpy as np
 import pdb
 
+from config import cfg
+
 
 def bbox_transform(ex_rois, gt_rois):
     ex_widths = ex_rois[:, 2] - ex_rois[:, 0] + 1.0
@@ -362,11 +364,12 @@ def clip_boxes_batch(boxes, im_shape, batch_size):
 
 def clip_boxes(boxes, im_shape, batch_size):
 
-    for i in range(batch_size):
-        boxes[i, :, 0::4].clamp_(0, im_shape[i, 1]-1)
-        boxes[i, :, 1::4].clamp_(0, im_shape[i, 0]-1)
-        boxes[i, :, 2::4].clamp_(0, im_shape[i, 1]-1)
-        boxes[i, :, 3::4].clamp_(0, im_shape[i, 0]-1)
+    # one clamp against the (h, w) of every sample, im_shape stays on the device
+    im_shape = im_shape[:batch_size].type_as(boxes)
+    max_xy = torch.stack((im_shape[:, 1], im_shape[:, 0]), 1).repeat(1, 2) - 1
+    frames = boxes[:batch_size].view(batch_size, boxes.size(1), -1, 4)
+    frames.clamp_(min=0)
+    torch.min(frames, max_xy.view(batch_size, 1, 1, 4), out=frames)
 
     return boxes
 
@@ -415,454 +418,190 @@ def bbox_overlaps(anchors, gt_boxes):
 
     return overlaps
 
-def bbox_overlaps_time(anchors, gt_boxes, time_limit):
+def bbox_overlaps_chunked(anchors, gt_boxes, anchors_time=None, gt_time=None, chunk_size=None):
     """
-    anchors: (N, 4) ndarray of float
-    gt_boxes: (b, K, 5) ndarray of float
-
-    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    anchors      : (N, 4) or (b, N, 4) x1, y1, x2, y2
+    gt_boxes     : (b, K, 4)
+    anchors_time : optional (t1, t2) of the anchors, (2,), (N, 2) or (b, N, 2)
+    gt_time      : optional (t1, t2) of the gt boxes, (b, K, 2)
+
+    overlaps: (b, N, K) IoU of the boxes, or of the tubes (cuboids) when the
+    times are given. 0 for the padding gt boxes and -1 for the padding
+    anchors (1x1 boxes).
+
+    Anchors are processed chunk_size (cfg.OVERLAPS_CHUNK_SIZE) at a time
+    and the pairs are broadcast, never expanded, so the temporaries stay
+    at a few (b, chunk_size, K) tensors whatever the number of anchors.
     """
-    batch_size = gt_boxes.size(0)
+    if anchors.dim() not in (2, 3):
+        raise ValueError('anchors input dimension is not correct.')
+    if chunk_size is None:
+        chunk_size = cfg.OVERLAPS_CHUNK_SIZE
 
-    # print('gt_bboxes.shape : {}'.format(gt_boxes.shape))
-    # print('anchors.dim() : ', anchors.dim())
+    batch_size, K = gt_boxes.size(0), gt_boxes.size(1)
     if anchors.dim() == 2:
+        anchors = anchors.unsqueeze(0)
+    N = anchors.size(1)
+    anchors = anchors.type_as(gt_boxes)
+
+    gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
+    gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
+    gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1) # padding boxes, remove them
+    gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
+
+    anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
+    anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
+    anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
+    anchors_area = (anchors_boxes_x * anchors_boxes_y).unsqueeze(2)
+
+    tubes = anchors_time is not None
+    if tubes:
+        anchors_time = anchors_time.type_as(gt_boxes)
+        if anchors_time.dim() < 3:
+            anchors_time = anchors_time.view(1, -1, 2)
+        gt_time = gt_time.type_as(gt_boxes).view(batch_size, 1, K, 2)
+        gt_boxes_area = gt_boxes_area * (gt_time[:, :, :, 1] - gt_time[:, :, :, 0] + 1)
+        anchors_area = anchors_area * (anchors_time[:, :, 1:] - anchors_time[:, :, :1] + 1)
+
+    gt = gt_boxes.view(batch_size, 1, K, 4)
+    overlaps = gt_boxes.new_empty(batch_size, N, K)
+
+    for i in range(0, N, chunk_size):
+        j = min(i + chunk_size, N)
+        boxes = anchors[:, i:j].unsqueeze(2)
+
+        iw = torch.min(boxes[:, :, :, 2], gt[:, :, :, 2])
+        iw.sub_(torch.max(boxes[:, :, :, 0], gt[:, :, :, 0])).add_(1).clamp_(min=0)
+        ih = torch.min(boxes[:, :, :, 3], gt[:, :, :, 3])
+        ih.sub_(torch.max(boxes[:, :, :, 1], gt[:, :, :, 1])).add_(1).clamp_(min=0)
+        inter = iw.mul_(ih)
+        if tubes:
+            times = anchors_time[:, i:j] if anchors_time.size(1) > 1 else anchors_time
+            times = times.unsqueeze(2)
+            it = torch.min(times[:, :, :, 1], gt_time[:, :, :, 1])
+            it.sub_(torch.max(times[:, :, :, 0], gt_time[:, :, :, 0])).add_(1).clamp_(min=0)
+            inter.mul_(it)
+
+        ua = (anchors_area[:, i:j] + gt_boxes_area).sub_(inter)
+        torch.div(inter, ua, out=overlaps[:, i:j])
+
+    # mask the overlap here.
+    overlaps.masked_fill_(gt_area_zero.view(batch_size, 1, K), 0)
+    overlaps.masked_fill_(anchors_area_zero.view(-1, N, 1).expand(batch_size, N, K), -1)
 
-        N = anchors.size(0) # N is the size of anchors ==> 94 probably
-        K = gt_boxes.size(1)
-
-        # print('N : {}, K : {}'.format(N, K))
-        # print('achors shape before view :', anchors.shape)
-        anchors = anchors.view(1, N, 4).expand(batch_size, N, 4).contiguous()
-
-        # print('achors shape after view :', anchors.shape)
-        # print('gt_boxes.shape ', gt_boxes.shape)
-        # print('gt_boxes ', gt_boxes[0])
-
-        time_duration = gt_boxes[:,:,5] - gt_boxes[:,:,2] + 1
-        time_duration = time_duration.squeeze()
-        # print('time_duration :',time_duration)
-        # print('time_duration.shape :',time_duration.shape)
-        # print('time_limit == time_duration:',time_limit == time_duration)
-
-        if time_limit == time_duration:
-            gt_boxes = gt_boxes[:, :, [0,1,3,4]].contiguous()
-
-            gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
-            gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
-            gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
-            # gt_boxes_area = (gt_boxes_x * gt_boxes_y)
-            # gt_boxes_area = gt_boxes_area.view(batch_size, 1, K)
-            # print('gt_boxes_x.shape : ', gt_boxes_x.shape)
-            # print('gt_boxes_x : ', gt_boxes_x)
-            # print('gt_boxes_area.shape :', gt_boxes_area.shape)
-            # print('gt_boxes_area :', gt_boxes_area)
-
-
-            anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
-            anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
-            anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
-
-            # print('anchors_boxes_x.shape :',anchors_boxes_x.shape)
-            # print('anchors_boxes_x :',anchors_boxes_x)
-            # print('anchors_area.shape :',anchors_area.shape)
-            # print('anchors_area :',anchors_area)
-
-            # print('gt_boxes_x == 1 : ', gt_boxes_x == 1)
-            # print('gt_boxes_x :', gt_boxes_x)
-
-            gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1) # padding boxes, remove them
-            anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-            # print('gt_area_zero : ',gt_area_zero)
-
-            boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-            # print('gt_boxes.shape :', gt_boxes.shape)
-            query_boxes = gt_boxes.view(batch_size, 1, K, 4)
-            # print('query_boxes.shape :', query_boxes.shape)
-            # print('query_boxes :', query_boxes)
-            query_boxes = query_boxes.expand(batch_size, N, K, 4)
-            # print('query_boxes.shape :', query_boxes.shape)
-            # print('query_boxes :', query_boxes)
-            iw = (torch.min(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) -
-                  torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
-            iw[iw < 0] = 0
-
-            ih = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
-                  torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
-            ih[ih < 0] = 0
-            ua = anchors_area + gt_boxes_area - (iw * ih)
-            overlaps = iw * ih / ua
-
-            # mask the overlap here.
-            overlaps.masked_fill_(gt_area_zero.view(
-                batch_size, 1, K).expand(batch_size, N, K), 0)
-            overlaps.masked_fill_(anchors_area_zero.view(
-                batch_size, N, 1).expand(batch_size, N, K), -1)
-            # mask the overlap here.
-        else:
-            overlaps = torch.zeros(batch_size,N,K) # N -> number of anchors, K:number of gt_tubes
-    else:
-        raise ValueError('anchors input dimension is not correct.')
+    return overlaps
 
+def bbox_overlaps_time(anchors, gt_boxes, time_limit):
+    """
+    anchors: (N, 4) ndarray of float
+    gt_boxes: (b, K, 7) ndarray of float, x1, y1, t1, x2, y2, t2, label
 
-    return overlaps
+    overlaps: (b, N, K) tube IoU of the anchors, lasting the time_limit frames
+    of the clip, and the gt tubes (the box IoU when a tube lasts all of them)
+    """
+    if anchors.dim() != 2:
+        raise ValueError('anchors input dimension is not correct.')
+
+    window = gt_boxes.new_tensor([0, time_limit - 1])
+    return bbox_overlaps_chunked(anchors, gt_boxes[:, :, [0,1,3,4]],
+                                 window, gt_boxes[:, :, [2,5]])
 
 def bbox_overlaps_rois(anchors, gt_boxes, time_limit):
     """
     anchors: (N, 4) ndarray of float
-    gt_boxes: (b, K, 5) ndarray of float
+    gt_boxes: (b, K, 5) ndarray of float, a gt box per frame
 
-    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    overlaps: (b, N, K) ndarray of overlap between boxes and query_boxes
     """
-    batch_size = gt_boxes.size(0)
-    # print('batch_size :', batch_size)
-    # print('gt_bboxes.shape : {}'.format(gt_boxes.shape))
-    # print('anchors.dim() : ', anchors.dim())
-    if anchors.dim() == 2:
-
-        N = anchors.size(0) # N is the size of anchors ==> 94 probably
-        K = gt_boxes.size(1)
-
-        # print('N : {}, K : {}'.format(N, K))
-        # print('achors shape before view :', anchors.shape)
-        anchors = anchors.view(1, N, 4).expand(batch_size, N, 4).contiguous()
-
-        # print('achors shape after view :', anchors.shape)
-        # print('gt_boxes.shape ', gt_boxes.shape)
-        # print('gt_boxes ', gt_boxes[0])
-
-        gt_boxes = gt_boxes[:, :, :4].contiguous()
-
-        gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
-        gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
-        gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
-        # gt_boxes_area = (gt_boxes_x * gt_boxes_y)
-        # gt_boxes_area = gt_boxes_area.view(batch_size, 1, K)
-        # print('gt_boxes_x.shape : ', gt_boxes_x.shape)
-        # print('gt_boxes_x : ', gt_boxes_x)
-        # print('gt_boxes_area.shape :', gt_boxes_area.shape)
-        # print('gt_boxes_area :', gt_boxes_area)
-
-
-        anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
-        anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
-        anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
-
-        # print('anchors_boxes_x.shape :',anchors_boxes_x.shape)
-        # print('anchors_boxes_x :',anchors_boxes_x)
-        # print('anchors_area.shape :',anchors_area.shape)
-        # print('anchors_area :',anchors_area)
-
-        # print('gt_boxes_x == 1 : ', gt_boxes_x == 1)
-        # print('gt_boxes_x :', gt_boxes_x)
-
-        gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1) # padding boxes, remove them
-        anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-        # print('gt_area_zero : ',gt_area_zero)
-
-        boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-        # print('gt_boxes.shape :', gt_boxes.shape)
-        # print('boxes.shape :', boxes.shape)
-
-        query_boxes = gt_boxes.view(batch_size, 1, K, 4)
-        # print('query_boxes.shape :', query_boxes.shape)
-        # print('query_boxes :', query_boxes)
-        query_boxes = query_boxes.expand(batch_size, N, K, 4)
-        # print('query_boxes.shape :', query_boxes.shape)
-        # print('boxes.shape :',boxes.shape )
-        iw = (torch.min(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) -
-              torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
-        iw[iw < 0] = 0
-
-        ih = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
-              torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
-        ih[ih < 0] = 0
-        ua = anchors_area + gt_boxes_area - (iw * ih)
-        overlaps = iw * ih / ua
-
-        # mask the overlap here.
-        overlaps.masked_fill_(gt_area_zero.view(
-            batch_size, 1, K).expand(batch_size, N, K), 0)
-        overlaps.masked_fill_(anchors_area_zero.view(
-            batch_size, N, 1).expand(batch_size, N, K), -1)
-        # mask the overlap here.
-    else:
+    if anchors.dim() != 2:
         raise ValueError('anchors input dimension is not correct.')
 
+    return bbox_overlaps_chunked(anchors, gt_boxes[:, :, :4])
 
-    return overlaps
+def bbox_overlaps_windows(anchors, gt_rois, durations, chunk_size=None):
+    """
+    anchors   : (N, 4) ndarray of float
+    gt_rois   : (b, K, T, 4 / 5) ndarray of float, the box of every gt tube at
+                every frame of the clip, zeros where the tube is absent
+    durations : lengths of the temporal windows, e.g. (16, 8, 4)
+
+    overlaps: {duration: (b, T - duration + 1, N, K)} tube IoU of the anchors,
+    lasting the window starting at each frame, and the gt tubes inside that
+    window: the sum of the per frame intersections over the union of the two
+    volumes in the window. 0 for the padding gt tubes and -1 for the padding
+    anchors.
+
+    The per frame intersections are computed once per chunk of anchors, the
+    sum over every window of every duration is then a difference of their
+    cumulative sum over time, the same for the gt volumes.
+    """
+    if anchors.dim() != 2:
+        raise ValueError('anchors input dimension is not correct.')
+    if chunk_size is None:
+        chunk_size = cfg.OVERLAPS_CHUNK_SIZE
 
+    batch_size, K, T = gt_rois.size(0), gt_rois.size(1), gt_rois.size(2)
+    N = anchors.size(0)
+    anchors = anchors.type_as(gt_rois)
+
+    gt_boxes_x = (gt_rois[:, :, :, 2] - gt_rois[:, :, :, 0] + 1)
+    gt_boxes_y = (gt_rois[:, :, :, 3] - gt_rois[:, :, :, 1] + 1)
+    gt_present = ((gt_boxes_x != 1) | (gt_boxes_y != 1)).type_as(gt_rois) # padding frames, remove them
+    gt_tube_zero = gt_present.sum(2) == 0
+    # (b, T + 1, 1, K), gt volume up to each frame
+    gt_volume = (gt_boxes_x * gt_boxes_y * gt_present).permute(0, 2, 1).cumsum(1).unsqueeze(2)
+    gt_volume = torch.cat((gt_volume.new_zeros(batch_size, 1, 1, K), gt_volume), 1)
+
+    anchors_boxes_x = (anchors[:, 2] - anchors[:, 0] + 1)
+    anchors_boxes_y = (anchors[:, 3] - anchors[:, 1] + 1)
+    anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
+    anchors_area = (anchors_boxes_x * anchors_boxes_y).view(1, 1, N, 1)
+
+    # (b, T, 1, K, 4) and (b, T, 1, K)
+    gt = gt_rois[:, :, :, :4].permute(0, 2, 1, 3).unsqueeze(2)
+    gt_present = gt_present.permute(0, 2, 1).unsqueeze(2)
+    overlaps = dict((d, gt_rois.new_empty(batch_size, T - d + 1, N, K)) for d in durations)
+
+    for i in range(0, N, chunk_size):
+        j = min(i + chunk_size, N)
+        boxes = anchors[i:j].view(1, 1, -1, 1, 4)
+
+        iw = torch.min(boxes[..., 2], gt[..., 2])
+        iw.sub_(torch.max(boxes[..., 0], gt[..., 0])).add_(1).clamp_(min=0)
+        ih = torch.min(boxes[..., 3], gt[..., 3])
+        ih.sub_(torch.max(boxes[..., 1], gt[..., 1])).add_(1).clamp_(min=0)
+        inter = iw.mul_(ih).mul_(gt_present)
+
+        # (b, T + 1, chunk, K), intersection up to each frame
+        inter = torch.cat((inter.new_zeros(batch_size, 1, j - i, K), inter.cumsum(1)), 1)
+
+        for d in durations:
+            inter_window = inter[:, d:] - inter[:, :-d]
+            gt_volume_window = gt_volume[:, d:] - gt_volume[:, :-d]
+            ua = (anchors_area[:, :, i:j] * d + gt_volume_window) - inter_window
+            torch.div(inter_window, ua, out=overlaps[d][:, :, i:j])
+
+    # mask the overlap here.
+    for d in durations:
+        overlaps[d].masked_fill_(gt_tube_zero.view(batch_size, 1, 1, K), 0)
+        overlaps[d].masked_fill_(anchors_area_zero.view(1, 1, N, 1), -1)
 
+    return overlaps
 
 def bbox_overlaps_batch(anchors, gt_boxes):
     """
-    anchors: (N, 4) ndarray of float
+    anchors: (N, 4) or (b, N, 4 / 5) ndarray of float
     gt_boxes: (b, K, 5) ndarray of float
 
-    overlaps: (N, K) ndarray of overlap between boxes and query_boxes
+    overlaps: (b, N, K) ndarray of overlap between boxes and query_boxes
     """
-    batch_size = gt_boxes.size(0)
-
-    # print('gt_bboxes.shape : {}'.format(gt_boxes.shape))
-    # print('anchors.dim() : ', anchors.dim())
     if anchors.dim() == 2:
-        print('edwwww')
-        N = anchors.size(0)
-        K = gt_boxes.size(1)
-        # print('N : {}, K : {}'.format(N, K))
-        # print('achors shape before view :', anchors.shape)
-        anchors = anchors.view(1, N, 4).expand(batch_size, N, 4).contiguous()
-        # print('achors shape after view :', anchors.shape)
-        # print('gt_boxes.shape ', gt_boxes.shape)
-        # print('gt_boxes ', gt_boxes[0])
-        gt_boxes = gt_boxes[:, :, [0,1,3,4]].contiguous()
-        # print('gt_boxes.shape ', gt_boxes.shape)
-
-        gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
-        gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
-
-        # print('gt_boxes_x.shape : ', gt_boxes_x.shape)
-        gt_boxes_area = (gt_boxes_x * gt_boxes_y)
-        # print('gt_boxes_area.shape :', gt_boxes_area.shape)
-        gt_boxes_area = gt_boxes_area.view(batch_size, 1, K)
-        # gt_boxes_area = gt_boxes_area.view(batch_size, 1, F, K)
-        # print('gt_boxes_area.shape :', gt_boxes_area.shape)
-
-        anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
-        anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
-        anchors_area = (anchors_boxes_x *
-                        anchors_boxes_y).view(batch_size, N, 1)
-
-        # print('gt_boxes_x == 1 : ', gt_boxes_x == 1)
-        # print('gt_boxes_x :', gt_boxes_x)
-
-        gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
-        anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-        # print('gt_area_zero : ',gt_area_zero)
-        boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-        # print('gt_boxes.shape :', gt_boxes.shape)
-        query_boxes = gt_boxes.view(batch_size, 1, K, 4)
-        # print('query_boxes.shape :', query_boxes.shape)
-        # print('query_boxes :', query_boxes)
-        query_boxes = query_boxes.expand(batch_size, N, K, 4)
-        # print('query_boxes.shape :', query_boxes.shape)
-        # print('query_boxes :', query_boxes)
-        iw = (torch.min(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) -
-              torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
-        iw[iw < 0] = 0
-
-        ih = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
-              torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
-        ih[ih < 0] = 0
-        ua = anchors_area + gt_boxes_area - (iw * ih)
-        overlaps = iw * ih / ua
-
-        # mask the overlap here.
-        overlaps.masked_fill_(gt_area_zero.view(
-            batch_size, 1, K).expand(batch_size, N, K), 0)
-        overlaps.masked_fill_(anchors_area_zero.view(
-            batch_size, N, 1).expand(batch_size, N, K), -1)
-        print('overlaps.shape  after mask:', overlaps.shape)
-        # mask the overlap here.
-
-
+        gt_boxes = gt_boxes[:, :, [0,1,3,4]]
     elif anchors.dim() == 3:
-
-        N = anchors.size(1)
-        K = gt_boxes.size(1)
-
-        if anchors.size(2) == 4:
-            anchors = anchors[:, :, :4].contiguous()
-        else:
-            anchors = anchors[:, :, 1:5].contiguous()
-
-        gt_boxes = gt_boxes[:, :, :4].contiguous()
-
-        gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
-        gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
-        gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
-
-        anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
-        anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
-        anchors_area = (anchors_boxes_x *
-                        anchors_boxes_y).view(batch_size, N, 1)
-
-        gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
-        anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-        boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-        query_boxes = gt_boxes.view(
-            batch_size, 1, K, 4).expand(batch_size, N, K, 4)
-
-        iw = (torch.min(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) -
-              torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
-        iw[iw < 0] = 0
-
-        ih = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
-              torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
-        ih[ih < 0] = 0
-        ua = anchors_area + gt_boxes_area - (iw * ih)
-
-        overlaps = iw * ih / ua
-
-        # mask the overlap here.
-        overlaps.masked_fill_(gt_area_zero.view(
-            batch_size, 1, K).expand(batch_size, N, K), 0)
-        overlaps.masked_fill_(anchors_area_zero.view(
-            batch_size, N, 1).expand(batch_size, N, K), -1)
+        if anchors.size(2) != 4:
+            anchors = anchors[:, :, 1:5]
+        gt_boxes = gt_boxes[:, :, :4]
     else:
         raise ValueError('anchors input dimension is not correct.')
 
-    return overlaps
-
-
-# def bbox_overlaps_batch_3d(anchors, gt_boxes):
-#     """
-#     anchors: (N, 4) ndarray of float
-#     gt_boxes: (b, K, 5) ndarray of float
-
-#     overlaps: (N, K) ndarray of overlap between boxes and query_boxes
-#     """
-#     batch_size = gt_boxes.size(0)
-
-#     print('gt_bboxes.shape : {}'.format(gt_boxes.shape))
-#     print('anchors.dim() : ', anchors.dim())
-#     if anchors.dim() == 2:
-
-#         N = anchors.size(0)
-#         K = gt_boxes.size(1)
-#         print('N = {} K = {}'.format(N, K))
-#         print('batch_size', batch_size)
-#         anchors = anchors.view(1, N, 6)
-#         print('anchors shape :', anchors.shape)
-#         anchors = anchors.expand(batch_size, N, 6).contiguous()
-#         print('anchors shape :', anchors.shape)
-#         print('gt_boxes ', gt_boxes.shape)
-#         print('gt_boxes ', gt_boxes[0])
-#         gt_boxes = gt_boxes[:, :, :6].contiguous()
-#         # gt_boxes = gt_boxes.squeeze(2).contiguous()
-#         print('gt_boxes.shape ', gt_boxes.shape)
-
-#         gt_boxes_x = (gt_boxes[:, :, 3] - gt_boxes[:, :, 0] + 1)
-#         gt_boxes_y = (gt_boxes[:, :, 4] - gt_boxes[:, :, 1] + 1)
-#         gt_boxes_t = (gt_boxes[:, :, 5] - gt_boxes[:, :, 2] + 1)
-#         if batch_size == 1:  # only 1 video in batch:
-#             gt_boxes_x = gt_boxes_x.unsqueeze(0)
-#             gt_boxes_y = gt_boxes_y.unsqueeze(0)
-#             gt_boxes_t = gt_boxes_t.unsqueeze(0)
-
-#         print('gt_boxes_x.shape :', gt_boxes_x.shape)
-#         print('gt_boxes_x :', gt_boxes_x)
-#         gt_boxes_area = (gt_boxes_x * gt_boxes_y * gt_boxes_t)
-#         # if batch_size == 1:  # only 1 video in batch:
-#         #     print('first gt_boxes_area.shape :', gt_boxes_area.shape)
-#         #     gt_boxes_area = gt_boxes_area.unsqueeze(0)
-#         # print('gt_boxes_area.shape :',gt_boxes_area.shape)
-#         # gt_boxes_area = gt_boxes_area.view(batch_size, 1,  K)
-#         # print('gt_boxes_area.shape :',gt_boxes_area.shape)
-
-#         anchors_boxes_x = (anchors[:, :, 3] - anchors[:, :, 0] + 1)
-#         anchors_boxes_y = (anchors[:, :, 4] - anchors[:, :, 1] + 1)
-#         anchors_boxes_t = (anchors[:, :, 5] - anchors[:, :, 2] + 1)
-#         print('anchors_boxes_y : ', anchors_boxes_y.shape)
-
-#         anchors_area = (anchors_boxes_x * anchors_boxes_y *
-#                         anchors_boxes_t).view(batch_size, N, 1)  # for 1 frame
-#         print('anchors_area.shape :', anchors_area.shape)
-
-#         print('gt_boxes_x == 1 : ', gt_boxes_x == 1)
-#         print('gt_boxes_x :', gt_boxes_x)
-#         gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1) 
-#         anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-#         boxes = anchors.view(batch_size, N, 1, 6)
-#         # print('anchors : ', boxes)
-#         boxes = boxes.expand(batch_size, N, K, 6)
-#         print('gt_boxes.shape :', gt_boxes.shape)
-#         # print('gt_boxes :', gt_boxes)
-#         query_boxes = gt_boxes.view(batch_size, 1, K, 6)
-#         print('query_boxes.shape :', query_boxes.shape)
-#         query_boxes = query_boxes.expand(batch_size, N, K, 6)
-#         print('query_boxes.shape :', query_boxes.shape)
-#         # print('query_boxes[0] :', query_boxes[0][:])
-
-
-#         iw = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
-#               torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
-#         print(' iw.shape :', iw.shape)
-#         # print(' iw :', iw)
-#         iw[iw < 0] = 0
-
-#         ih = (torch.min(boxes[:, :, :, 4], query_boxes[:, :, :, 4]) -
-#               torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
-#         ih[ih < 0] = 0
-
-#         it = (torch.min(boxes[:, :, :, 5], query_boxes[:, :, :, 5]) -
-#               torch.max(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) + 1)
-#         it[it < 0] = 0
-
-#         print('anchors_area.shape : ', anchors_area.shape )
-#         print('gt_boxes_area.shape :',gt_boxes_area.shape)
-#         ua = anchors_area + gt_boxes_area - (iw * ih * it)
-#         print('ua.shape :', ua.shape)
-#         overlaps = iw * ih * it / ua
-#         # print('overlaps :', overlaps)
-#         print('overlaps.shape :', overlaps.shape)
-#         # mask the overlap here.
-#         print('gt_area_zero.shape :', gt_area_zero.shape, ' K {} N {}'.format(K,N))
-#         overlaps.masked_fill_(gt_area_zero.view(
-#             batch_size, 1, K).expand(batch_size, N, K), 0)
-#         overlaps.masked_fill_(anchors_area_zero.view(
-#             batch_size, N, 1).expand(batch_size, N, K), -1)
-#         print('overlaps.shape after mask :', overlaps.shape)
-#         # print('overlaps :', overlaps)
-#     elif anchors.dim() == 3:
-#         N = anchors.size(1)
-#         K = gt_boxes.size(1)
-
-#         if anchors.size(2) == 4:
-#             anchors = anchors[:, :, :4].contiguous()
-#         else:
-#             anchors = anchors[:, :, 1:5].contiguous()
-
-#         gt_boxes = gt_boxes[:, :, :4].contiguous()
-
-#         gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
-#         gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
-#         gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
-
-#         anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
-#         anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
-#         anchors_area = (anchors_boxes_x *
-#                         anchors_boxes_y).view(batch_size, N, 1)
-
-#         gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
-#         anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
-
-#         boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
-#         query_boxes = gt_boxes.view(
-#             batch_size, 1, K, 4).expand(batch_size, N, K, 4)
-
-#         iw = (torch.min(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) -
-#               torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
-#         iw[iw < 0] = 0
-
-#         ih = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
-#               torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
-#         ih[ih < 0] = 0
-#         ua = anchors_area + gt_boxes_area - (iw * ih)
-
-#         overlaps = iw * ih / ua
-
-#         # mask the overlap here.
-#         overlaps.masked_fill_(gt_area_zero.view(
-#             batch_size, 1, K).expand(batch_size, N, K), 0)
-#         overlaps.masked_fill_(anchors_area_zero.view(
-#             batch_size, N, 1).expand(batch_size, N, K), -1)
-#     else:
-#         raise ValueError('anchors input dimension is not correct.')
-
-#     return overlaps
+    return bbox_overlaps_chunked(anchors, gt_boxes)
@@ -0,0 +1,31 @@
+"""
+Building the anchors inside the image of an AnchorGrid against getting them
+from the anchor cache, for the feature maps of 112 to 448 px inputs.
+"""
+import time
+
+from anchor_cache import AnchorGrid, clear_anchor_cache
+
+
+def timed(fn, n_runs=1000):
+    t = time.time()
+    for _ in range(n_runs):
+        fn()
+    return (time.time() - t) / n_runs
+
+
+if __name__ == '__main__':
+
+    grid = AnchorGrid([16, ], [4, 8, 16], [0.5, 1, 2], base_size=14)
+
+    for feat_size in [7, 14, 20, 28]:
+        inside = lambda: grid.inside(feat_size, feat_size, feat_size * 16, feat_size * 16, 'cpu')
+
+        def build():
+            clear_anchor_cache()
+            inside()
+
+        t_build = timed(build)
+        t_cached = timed(inside)
+        print('{}x{}: build {:.3f}ms, cached {:.4f}ms'.format(feat_size, feat_size,
+                                                              t_build * 1000, t_cached * 1000))
@@ -0,0 +1,91 @@
+"""
+Peak memory and time of net_utils._crop_pool_layer (cfg.POOLING_MODE = 'crop')
+against cropping a copy of the feature map per roi with F.grid_sample, for the
+2d path and the per frame path on the act_base features.
+
+The peak is torch.cuda.max_memory_allocated on the gpu and the growth of the
+max rss of a forked process on the cpu.
+"""
+import multiprocessing
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+from config import cfg
+from net_utils import _crop_pool_layer
+
+
+def crop_pool_replicated(bottom, rois, max_pool=True, spatial_scale=1.0/16):
+    # grid_sample on a copy of the feature map (frame) of every roi
+    per_frame = bottom.dim() == 5
+    if not per_frame:
+        bottom = bottom.unsqueeze(2)
+    pool_size = cfg.POOLING_SIZE * 2 if max_pool else cfg.POOLING_SIZE
+    height, width = bottom.size(3), bottom.size(4)
+    crops = []
+    for t in range(bottom.size(2)):
+        x1, y1, x2, y2 = [rois[:, 1 + 4 * t + i:2 + 4 * t + i] * spatial_scale for i in range(4)]
+        zero = x1.new_zeros(x1.size())
+        theta = torch.cat([(x2 - x1) / (width - 1), zero, (x1 + x2 - width + 1) / (width - 1),
+                           zero, (y2 - y1) / (height - 1), (y1 + y2 - height + 1) / (height - 1)], 1).view(-1, 2, 3)
+        grid = F.affine_grid(theta, torch.Size((rois.size(0), 1, pool_size, pool_size)), align_corners=True)
+        c = F.grid_sample(bottom[rois[:, 0].long(), :, t].contiguous(), grid, align_corners=True)
+        crops.append(F.max_pool2d(c, 2, 2) if max_pool else c)
+    crops = torch.stack(crops, 2)
+    return crops if per_frame else crops.squeeze(2)
+
+
+def random_rois(n, batch_size, time_dim, im_size):
+    xy = torch.rand(n, time_dim, 2, 2) * im_size * 1.2 - im_size * 0.1
+    boxes = torch.cat((xy.min(2)[0], xy.max(2)[0]), 2).view(n, -1)
+    return torch.cat((torch.randint(0, batch_size, (n, 1)).float(), boxes), 1)
+
+
+def _child(fn, args, queue):
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t = time.time()
+    with torch.no_grad():
+        fn(*args)
+    elapsed = time.time() - t
+    queue.put(((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024., elapsed))
+
+
+def peak_memory(fn, *args):
+    """(peak MB above the inputs, seconds) of fn(*args)"""
+    if args[0].is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+        t = time.time()
+        with torch.no_grad():
+            fn(*args)
+        torch.cuda.synchronize()
+        return (torch.cuda.max_memory_allocated() - before) / 2. ** 20, time.time() - t
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_child, args=(fn, args, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+if __name__ == '__main__':
+
+    multiprocessing.set_start_method('fork')
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+
+    for name, bottom_size, time_dim in [('2d      (2, 256, 28, 28)    ', (2, 256, 28, 28), 1),
+                                        ('frames  (1, 256, 16, 7, 7)  ', (1, 256, 16, 7, 7), 16)]:
+        bottom = torch.randn(*bottom_size).to(device)
+        im_size = bottom_size[-1] * 16
+        for n_rois in [50, 300]:
+            rois = random_rois(n_rois, bottom_size[0], time_dim, im_size).to(device)
+            for max_pool in [True, False]:
+                mem_rep, t_rep = peak_memory(crop_pool_replicated, bottom, rois, max_pool)
+                mem, t = peak_memory(_crop_pool_layer, bottom, rois, max_pool)
+                print('{} {:3d} rois, max_pool {:d}: replicated {:7.1f}MB {:6.1f}ms, '
+                      'shared {:7.1f}MB {:6.1f}ms'.format(name, n_rois, max_pool,
+                                                          mem_rep, t_rep * 1000, mem, t * 1000))
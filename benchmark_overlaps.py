@@ -0,0 +1,115 @@
+"""
+Peak memory and time of the chunked overlap engine (bbox_overlaps_chunked)
+against the expanded (b, N, K, 4) pairs the overlap functions used to build,
+for the anchors of 112 to 448 px clips and more gt tubes / a larger batch.
+
+Then the time of the tube overlaps of the 16, 8 and 4 frames rpn branches at
+every position: bbox_overlaps_windows (per frame overlaps once, cumulative
+sums over time) against the tube / per frame overlaps of every branch and
+window computed from scratch.
+"""
+import multiprocessing
+import time
+
+import torch
+
+from bbox_transform import bbox_overlaps_chunked, bbox_overlaps_rois, bbox_overlaps_windows
+from benchmark_crop_pool import peak_memory
+
+
+def overlaps_expanded(anchors, gt_boxes):
+    # the previous bbox_overlaps_batch / _rois / _time body
+    batch_size, N, K = gt_boxes.size(0), anchors.size(0), gt_boxes.size(1)
+    anchors = anchors.view(1, N, 4).expand(batch_size, N, 4).contiguous()
+
+    gt_boxes_x = (gt_boxes[:, :, 2] - gt_boxes[:, :, 0] + 1)
+    gt_boxes_y = (gt_boxes[:, :, 3] - gt_boxes[:, :, 1] + 1)
+    gt_boxes_area = (gt_boxes_x * gt_boxes_y).view(batch_size, 1, K)
+    anchors_boxes_x = (anchors[:, :, 2] - anchors[:, :, 0] + 1)
+    anchors_boxes_y = (anchors[:, :, 3] - anchors[:, :, 1] + 1)
+    anchors_area = (anchors_boxes_x * anchors_boxes_y).view(batch_size, N, 1)
+    gt_area_zero = (gt_boxes_x == 1) & (gt_boxes_y == 1)
+    anchors_area_zero = (anchors_boxes_x == 1) & (anchors_boxes_y == 1)
+
+    boxes = anchors.view(batch_size, N, 1, 4).expand(batch_size, N, K, 4)
+    query_boxes = gt_boxes.view(batch_size, 1, K, 4).expand(batch_size, N, K, 4)
+    iw = (torch.min(boxes[:, :, :, 2], query_boxes[:, :, :, 2]) -
+          torch.max(boxes[:, :, :, 0], query_boxes[:, :, :, 0]) + 1)
+    iw[iw < 0] = 0
+    ih = (torch.min(boxes[:, :, :, 3], query_boxes[:, :, :, 3]) -
+          torch.max(boxes[:, :, :, 1], query_boxes[:, :, :, 1]) + 1)
+    ih[ih < 0] = 0
+    ua = anchors_area + gt_boxes_area - (iw * ih)
+    overlaps = iw * ih / ua
+
+    overlaps.masked_fill_(gt_area_zero.view(batch_size, 1, K).expand(batch_size, N, K), 0)
+    overlaps.masked_fill_(anchors_area_zero.view(batch_size, N, 1).expand(batch_size, N, K), -1)
+    return overlaps
+
+
+def overlaps_per_branch(anchors, gt_rois, durations):
+    # bbox_overlaps_time + bbox_overlaps_rois for every branch, a window at a time
+    batch_size, K, T = gt_rois.size(0), gt_rois.size(1), gt_rois.size(2)
+    present = (gt_rois[:, :, :, 2:4] - gt_rois[:, :, :, :2] != 0).any(3).float()
+    frames = torch.arange(T).float()
+    gt_time = torch.stack(((frames + (1 - present) * T).min(2)[0],
+                           (frames - (1 - present) * T).max(2)[0]), 2)
+    gt_boxes = torch.cat((gt_rois[:, :, :, :2].min(2)[0], gt_rois[:, :, :, 2:4].max(2)[0]), 2)
+    for d in durations:
+        bbox_overlaps_rois(anchors, gt_rois.view(batch_size, K * T, -1), d)
+        for s in range(T - d + 1):
+            bbox_overlaps_chunked(anchors, gt_boxes, gt_boxes.new_tensor([s, s + d - 1]), gt_time)
+
+
+def timed(fn, *args):
+    t = time.time()
+    fn(*args)
+    return time.time() - t
+
+
+def random_boxes(*size):
+    xy = torch.rand(*(size + (2, 2))) * 400
+    return torch.cat((xy.min(-2)[0], xy.max(-2)[0]), -1)
+
+
+if __name__ == '__main__':
+
+    multiprocessing.set_start_method('fork')
+    torch.manual_seed(0)
+
+    anchors = random_boxes(500)
+    gt_boxes = random_boxes(2, 5)
+    gt_boxes[1, 3:] = 0    # padding
+    print('max abs diff : {:.2e}'.format(
+        (bbox_overlaps_chunked(anchors, gt_boxes, chunk_size=64) - overlaps_expanded(anchors, gt_boxes)).abs().max().item()))
+
+    # an anchor aligned with a tube present in all 16 frames covers it in every window
+    box = torch.Tensor([10, 20, 60, 90])
+    gt_rois = torch.cat((box.expand(1, 1, 16, 4), torch.ones(1, 1, 16, 1)), 3)
+    overlaps = bbox_overlaps_windows(box.view(1, 4), gt_rois, [16, 8, 4])
+    print('aligned anchor min iou : ' + ', '.join(
+        '{:2d} frames {:.4f}'.format(d, overlaps[d].min().item()) for d in [16, 8, 4]))
+
+    # 9 anchors per location, 16 frames of boxes batched like the per frame gt rois
+    for im_size in [112, 224, 448]:
+        n_anchors = (im_size // 16) ** 2 * 9
+        for batch_size, K in [(16, 1), (16, 8), (64, 20)]:
+            anchors = random_boxes(n_anchors)
+            gt_boxes = random_boxes(batch_size, K)
+            mem_old, t_old = peak_memory(overlaps_expanded, anchors, gt_boxes)
+            mem_new, t_new = peak_memory(bbox_overlaps_chunked, anchors, gt_boxes)
+            print('{}px {:5d} anchors, b={:2d} K={:2d} : expanded {:6.1f}MB {:6.1f}ms, '
+                  'chunked {:6.1f}MB {:6.1f}ms'.format(im_size, n_anchors, batch_size, K,
+                                                       mem_old, t_old * 1000, mem_new, t_new * 1000))
+
+    for im_size in [112, 224]:
+        n_anchors = (im_size // 16) ** 2 * 9
+        for batch_size, K in [(1, 1), (1, 4), (8, 4)]:
+            anchors = random_boxes(n_anchors)
+            gt_rois = random_boxes(batch_size, K, 16)
+            t_branch = timed(overlaps_per_branch, anchors, gt_rois, [16, 8, 4])
+            t_16 = timed(bbox_overlaps_windows, anchors, gt_rois, [16])
+            t_all = timed(bbox_overlaps_windows, anchors, gt_rois, [16, 8, 4])
+            print('{}px {:5d} anchors, b={} K={} : 16/8/4 at every position per branch {:6.1f}ms, '
+                  'windows 16 {:5.1f}ms, 16/8/4 {:5.1f}ms'.format(im_size, n_anchors, batch_size, K,
+                                                                t_branch * 1000, t_16 * 1000, t_all * 1000))
@@ -0,0 +1,64 @@
+"""
+Proposal selection of _ProposalLayer (topk of the scores, then decoding only
+the selected tubes) against the full sort + decoding of every anchor of every
+frame it replaced, at the feature map sizes of 112, 224, 320 and 448 px inputs
+(stride 16) and the 16/8/4 frame branches of _RPN (batch B, 9B, 13B).
+"""
+import time
+
+import torch
+
+from bbox_transform import bbox_frames_transform_inv
+from proposal_layer import _ProposalLayer
+
+
+def full_sort(scores, bbox_frame, anchors, time_dim, pre_nms_topN):
+    # the previous path: decode every anchor of every frame, sort everything
+    B, KA = bbox_frame.size(0), anchors.size(0)
+    frame_anchors = anchors.view(1, 1, KA, 4).expand(B, time_dim, KA, 4).contiguous().view(B, -1, 4)
+    bbox_frame = bbox_frame.permute(0,2,3,1).contiguous().view(B, -1, 4)
+    proposals = bbox_frames_transform_inv(frame_anchors, bbox_frame, B)
+    proposals = proposals.view(B, time_dim, KA, 4).permute(0,2,1,3).contiguous().view(B, KA, time_dim*4)
+    scores = scores.permute(0,2,3,1).contiguous().view(B, KA)
+    scores, order = torch.sort(scores, 1, True)
+    if pre_nms_topN > 0 and pre_nms_topN < KA:
+        scores, order = scores[:, :pre_nms_topN], order[:, :pre_nms_topN]
+    return scores, proposals[torch.arange(B).view(-1,1), order]
+
+
+def timed(fn, *args, n_runs=10):
+    t = time.time()
+    for _ in range(n_runs):
+        fn(*args)
+    return (time.time() - t) / n_runs
+
+
+if __name__ == '__main__':
+
+    torch.manual_seed(0)
+    layer = _ProposalLayer([16, ], [4, 8, 16], [0.5, 1, 2])
+    A = layer._num_anchors
+    batch_size = 4
+
+    for cfg_key, pre_nms_topN in [('TRAIN', 12000), ('TEST', 6000)]:
+        for im_size in [112, 224, 320, 448]:
+            feat_size = im_size // 16
+            for time_dim, n_clips in [(16, 1), (8, 9), (4, 13)]:
+                B = batch_size * n_clips
+                # distinct scores, so both orders are the same
+                scores = torch.randperm(B * A * feat_size * feat_size).float().view(B, A, feat_size, feat_size)
+                bbox_frame = torch.randn(B, 4 * A * time_dim, feat_size, feat_size) * 0.1
+                anchors = layer._anchor_grid.anchors(feat_size, feat_size, 'cpu')
+
+                ref_scores, ref_proposals = full_sort(scores, bbox_frame, anchors, time_dim, pre_nms_topN)
+                new_scores, new_proposals = layer._select_proposals(scores, bbox_frame, anchors,
+                                                                    time_dim, pre_nms_topN)
+                same = torch.equal(ref_scores, new_scores) and \
+                       torch.allclose(ref_proposals, new_proposals)
+
+                t_sort = timed(full_sort, scores, bbox_frame, anchors, time_dim, pre_nms_topN)
+                t_topk = timed(layer._select_proposals, scores, bbox_frame, anchors, time_dim, pre_nms_topN)
+
+                print('{} {}px ({}x{}) T={:2d} B={:2d}, {:6d} anchors: sort {:.2f}ms, topk {:.2f}ms, same: {}'.format(
+                    cfg_key, im_size, feat_size, feat_size, time_dim, B, scores.numel(),
+                    t_sort * 1000, t_topk * 1000, same))
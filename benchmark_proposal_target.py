@@ -0,0 +1,103 @@
+"""
+Throughput of the roi sampling of _ProposalTargetLayer for 1 to 16 clips of
+2000 proposal tubes: the batched sampling with a seeded torch.Generator
+against the per clip loop drawing its indices with numpy it replaced.
+"""
+import time
+
+import numpy as np
+import torch
+
+from bbox_transform import bbox_overlaps_batch
+from config import cfg
+from proposal_target_layer_cascade import _ProposalTargetLayer
+
+
+def sample_rois_loop(layer, all_rois, gt_boxes, fg_rois_per_image, rois_per_image):
+    # the previous _sample_rois_pytorch body
+    overlaps = bbox_overlaps_batch(all_rois, gt_boxes)
+    max_overlaps, gt_assignment = torch.max(overlaps, 2)
+    batch_size = overlaps.size(0)
+
+    offset = torch.arange(0, batch_size) * gt_boxes.size(1)
+    offset = offset.view(-1, 1).type_as(gt_assignment) + gt_assignment
+    labels = gt_boxes[:, :, 4].contiguous().view(-1)[(offset.view(-1),)].view(batch_size, -1)
+
+    labels_batch = labels.new(batch_size, rois_per_image).zero_()
+    rois_batch = all_rois.new(batch_size, rois_per_image, all_rois.size(2)).zero_()
+    gt_rois_batch = all_rois.new(batch_size, rois_per_image, all_rois.size(2)).zero_()
+
+    for i in range(batch_size):
+        fg_inds = torch.nonzero(max_overlaps[i] >= cfg.TRAIN.FG_THRESH).view(-1)
+        bg_inds = torch.nonzero((max_overlaps[i] < cfg.TRAIN.BG_THRESH_HI) &
+                                (max_overlaps[i] >= cfg.TRAIN.BG_THRESH_LO)).view(-1)
+        fg_num_rois, bg_num_rois = fg_inds.numel(), bg_inds.numel()
+
+        if fg_num_rois > 0 and bg_num_rois > 0:
+            fg_rois_per_this_image = min(fg_rois_per_image, fg_num_rois)
+            rand_num = torch.from_numpy(np.random.permutation(fg_num_rois)).type_as(gt_boxes).long()
+            fg_inds = fg_inds[rand_num[:fg_rois_per_this_image]]
+            rand_num = np.floor(np.random.rand(rois_per_image - fg_rois_per_this_image) * bg_num_rois)
+            bg_inds = bg_inds[torch.from_numpy(rand_num).type_as(gt_boxes).long()]
+        elif fg_num_rois > 0:
+            rand_num = np.floor(np.random.rand(rois_per_image) * fg_num_rois)
+            fg_inds = fg_inds[torch.from_numpy(rand_num).type_as(gt_boxes).long()]
+            fg_rois_per_this_image = rois_per_image
+        else:
+            rand_num = np.floor(np.random.rand(rois_per_image) * bg_num_rois)
+            bg_inds = bg_inds[torch.from_numpy(rand_num).type_as(gt_boxes).long()]
+            fg_rois_per_this_image = 0
+
+        keep_inds = torch.cat([fg_inds, bg_inds], 0)
+        labels_batch[i].copy_(labels[i][keep_inds])
+        if fg_rois_per_this_image < rois_per_image:
+            labels_batch[i][fg_rois_per_this_image:] = 0
+        rois_batch[i] = all_rois[i, keep_inds]
+        rois_batch[i, :, 0] = i
+        gt_rois_batch[i] = gt_boxes[i][gt_assignment[i][keep_inds]]
+
+    bbox_target_data = layer._compute_targets_pytorch(rois_batch[:, :, 1:5], gt_rois_batch[:, :, :4])
+    return labels_batch, rois_batch, bbox_target_data
+
+
+def random_tubes(batch_size, n, time_dim, im_size):
+    xy = torch.rand(batch_size, n, time_dim, 2, 2) * im_size
+    return torch.cat((xy.min(3)[0], xy.max(3)[0]), 3).view(batch_size, n, -1)
+
+
+def timed(fn, device, n_runs=20):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    t = time.time()
+    for _ in range(n_runs):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - t) / n_runs
+
+
+if __name__ == '__main__':
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+
+    layer = _ProposalTargetLayer(25)
+    rois_per_image = cfg.TRAIN.BATCH_SIZE
+    fg_rois_per_image = int(np.round(cfg.TRAIN.FG_FRACTION * rois_per_image))
+
+    for batch_size in [1, 2, 4, 8, 16]:
+        # 2000 proposals and 2 gt tubes per clip, the proposals around the
+        # gt tubes so that there are fg, bg and ignored ones
+        gt_boxes = torch.cat((random_tubes(batch_size, 2, 16, 112), torch.ones(batch_size, 2, 1)), 2)
+        around = gt_boxes[:, torch.randint(0, 2, (2000,)), :64]
+        rois = around + torch.randn(batch_size, 2000, 64) * 20
+        all_rois = torch.cat((torch.zeros(batch_size, 2000, 1), rois), 2)
+        all_rois = torch.cat((all_rois, torch.cat((torch.zeros(batch_size, 2, 1), gt_boxes[:, :, :64]), 2)), 1)
+        all_rois, gt_boxes = all_rois.to(device), gt_boxes.to(device)
+
+        t_loop = timed(lambda: sample_rois_loop(layer, all_rois, gt_boxes, fg_rois_per_image, rois_per_image), device)
+        t_batch = timed(lambda: layer._sample_rois_pytorch(all_rois, gt_boxes, fg_rois_per_image,
+                                                           rois_per_image, 25), device)
+        print('b={:2d} : per clip loop {:6.1f}ms ({:6.1f} clips/s), batched {:6.1f}ms ({:6.1f} clips/s)'.format(
+            batch_size, t_loop * 1000, batch_size / t_loop, t_batch * 1000, batch_size / t_batch))
@@ -0,0 +1,125 @@
+"""
+Checks and cpu timings of the RoIAlign kernels.
+
+roi_align    : a box per frame, (N, 1 + 4 * T) tubes, used by ACT_net
+roi_align_3d : (N, 7) spatio-temporal rois
+
+The cpu extensions are compared with the pure pytorch versions (which follow
+the sampling of the old C kernels), gradchecked in double and timed at the
+act_base feature size of a 16 x 112 x 112 clip for 1..n threads. The fused
+RoIAlignAvg / RoIAlignMax are compared with oversampling + pooling.
+"""
+import time
+
+import torch
+import torch.nn.functional as F
+
+from roi_align.functions.roi_align import RoIAlignFunction, _roi_align_pytorch
+from roi_align.modules.roi_align import RoIAlignAvg, RoIAlignMax
+from roi_align_3d.functions.roi_align import RoIAlignFunction as RoIAlignFunction3d
+from roi_align_3d.functions.roi_align_pytorch import roi_align_3d
+
+
+def random_tubes(n, batch_size, time_dim, im_size):
+    # some boxes cross the border
+    xy = torch.rand(n, time_dim, 2, 2) * im_size * 1.2 - im_size * 0.1
+    boxes = torch.cat((xy.min(2)[0], xy.max(2)[0]), 2).view(n, -1)
+    return torch.cat((torch.randint(0, batch_size, (n, 1)).float(), boxes), 1)
+
+
+def random_rois_3d(n, batch_size, im_size, duration):
+    xy = torch.rand(n, 2, 2) * im_size * 1.2 - im_size * 0.1
+    t = torch.rand(n, 2) * duration
+    return torch.cat((torch.randint(0, batch_size, (n, 1)).float(),
+                      xy.min(1)[0], t.min(1, keepdim=True)[0],
+                      xy.max(1)[0], t.max(1, keepdim=True)[0]), 1)
+
+
+def timed(fn, n_runs=3):
+    fn()
+    t = time.time()
+    for _ in range(n_runs):
+        fn()
+    return (time.time() - t) / n_runs
+
+
+if __name__ == '__main__':
+
+    torch.manual_seed(0)
+
+    # checks, in double
+    features = torch.randn(2, 3, 4, 7, 7, dtype=torch.float64, requires_grad=True)
+    tubes = random_tubes(10, 2, 4, 112).double()
+    out = RoIAlignFunction.apply(features, tubes, 5, 6, 1. / 16)
+    ref = _roi_align_pytorch(features, tubes, 5, 6, 1. / 16)
+    print('roi_align    max abs diff : {:.2e}'.format((out - ref).abs().max().item()))
+    print('roi_align    gradcheck    :', torch.autograd.gradcheck(
+        lambda f: RoIAlignFunction.apply(f, tubes, 5, 6, 1. / 16), (features,)))
+
+    rois = random_rois_3d(10, 2, 112, 4).double()
+    out = RoIAlignFunction3d.apply(features, rois, 5, 6, 3, 1. / 16, 1.)
+    ref = roi_align_3d(features, rois, 5, 6, 3, 1. / 16)
+    print('roi_align_3d max abs diff : {:.2e}'.format((out - ref).abs().max().item()))
+    print('roi_align_3d gradcheck    :', torch.autograd.gradcheck(
+        lambda f: RoIAlignFunction3d.apply(f, rois, 5, 6, 3, 1. / 16, 1.), (features,)))
+
+    # fused pooling against oversampling + pooling, the unfused max pools every frame
+    def max_pool_frames(f):
+        x = RoIAlignFunction.apply(f, tubes, 6, 7, 1. / 16)
+        x = F.max_pool2d(x.view(-1, 6, 7), kernel_size=2, stride=1)
+        return x.view(tubes.size(0), f.size(1), -1, 5, 6)
+
+    roi_align_avg = RoIAlignAvg(5, 6, 1. / 16, 4, fused=False)
+    for name, fused, unfused in [('avg', RoIAlignAvg(5, 6, 1. / 16, 4), lambda f: roi_align_avg(f, tubes)),
+                                 ('max', RoIAlignMax(5, 6, 1. / 16), max_pool_frames)]:
+        out, ref = fused(features, tubes), unfused(features)
+        grad = torch.autograd.grad(out.sum(), features)[0]
+        grad_ref = torch.autograd.grad(ref.sum(), features)[0]
+        print('fused {}    max abs diff : {:.2e}, grad {:.2e}'.format(
+            name, (out - ref).abs().max().item(), (grad - grad_ref).abs().max().item()))
+        print('fused {}    gradcheck    :'.format(name), torch.autograd.gradcheck(
+            lambda f: fused(f, tubes), (features,)))
+
+    # timings, act_base features of a 16 x 112 x 112 clip, 300 rois (test) and
+    # 256 sampled rois + backward (train)
+    features = torch.randn(1, 256, 16, 7, 7)
+    tubes = random_tubes(300, 1, 16, 112)
+    rois = random_rois_3d(300, 1, 112, 16)
+    roi_align_avg = RoIAlignAvg(7, 7, 1. / 16, 16, fused=False)
+    roi_align_avg_fused = RoIAlignAvg(7, 7, 1. / 16, 16)
+
+    mb = 4. / 2 ** 20
+    print('RoIAlignAvg 300 tubes : output {:.1f}MB, oversampled intermediate {:.1f}MB (unfused only)'.format(
+        300 * 256 * 15 * 7 * 7 * mb, 300 * 256 * 16 * 8 * 8 * mb))
+
+    def backward(fn):
+        def run():
+            feats = features.clone().requires_grad_(True)
+            fn(feats).sum().backward()
+        return run
+
+    max_threads = torch.get_num_threads()
+    for n_threads in sorted(set([1, 2, 4, max_threads])):
+        if n_threads > max_threads:
+            continue
+        torch.set_num_threads(n_threads)
+        with torch.no_grad():
+            t_ext = timed(lambda: RoIAlignFunction.apply(features, tubes, 8, 8, 1. / 16))
+            t_ref = timed(lambda: _roi_align_pytorch(features, tubes, 8, 8, 1. / 16))
+            t_avg = timed(lambda: roi_align_avg(features, tubes))
+            t_avg_fused = timed(lambda: roi_align_avg_fused(features, tubes))
+            t_ext_3d = timed(lambda: RoIAlignFunction3d.apply(features, rois, 8, 8, 17, 1. / 16, 1.))
+            t_ref_3d = timed(lambda: roi_align_3d(features, rois, 8, 8, 17, 1. / 16))
+        t_bwd = timed(backward(lambda f: RoIAlignFunction.apply(f, tubes[:256], 8, 8, 1. / 16)))
+        t_avg_bwd = timed(backward(lambda f: roi_align_avg(f, tubes[:256])))
+        t_avg_fused_bwd = timed(backward(lambda f: roi_align_avg_fused(f, tubes[:256])))
+        t_bwd_3d = timed(backward(lambda f: RoIAlignFunction3d.apply(f, rois[:256], 8, 8, 17, 1. / 16, 1.)))
+
+        print('{} threads'.format(n_threads))
+        print('  roi_align    300 tubes : ext {:.1f}ms, pytorch {:.1f}ms, '
+              '256 + backward {:.1f}ms'.format(t_ext * 1000, t_ref * 1000, t_bwd * 1000))
+        print('  RoIAlignAvg  300 tubes : unfused {:.1f}ms, fused {:.1f}ms, '
+              '256 + backward unfused {:.1f}ms, fused {:.1f}ms'.format(
+                  t_avg * 1000, t_avg_fused * 1000, t_avg_bwd * 1000, t_avg_fused_bwd * 1000))
+        print('  roi_align_3d 300 rois  : ext {:.1f}ms, pytorch {:.1f}ms, '
+              '256 + backward {:.1f}ms'.format(t_ext_3d * 1000, t_ref_3d * 1000, t_bwd_3d * 1000))
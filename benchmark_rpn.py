@@ -0,0 +1,97 @@
+"""
+Cost of the temporal branches of the RPN (region_net._RPN) on act_base
+features of 16 frame clips.
+
+Per branch: the Conv3d and its score / per frame bbox heads, run separately
+or with cfg.RPN_COMBINED_HEADS. Then the whole forward in eval (only the 16
+frames branch, the one giving proposals), the three branches it used to run,
+and a training step (forward + backward) with the 16 frames branch only and
+with the 16, 8 and 4 frames ones, with separate and combined heads.
+"""
+import time
+
+import torch
+
+from config import cfg
+from region_net import _RPN
+
+
+def timed(fn, n_runs=3):
+    fn()
+    t = time.time()
+    for _ in range(n_runs):
+        fn()
+    return (time.time() - t) / n_runs
+
+
+def random_gt(batch_size, n_tubes, im_size, time_dim=16):
+    xy = torch.rand(batch_size, n_tubes, 1, 2, 2) * im_size
+    boxes = torch.cat((xy.min(3)[0], xy.max(3)[0]), 3)
+    gt_rois = (boxes + torch.randn(batch_size, n_tubes, time_dim, 4) * 2).clamp(0, im_size - 1)
+    gt_rois = torch.cat((gt_rois, torch.ones(batch_size, n_tubes, time_dim, 1)), 3)
+    gt_tubes = torch.cat((gt_rois[:, :, :, :2].min(2)[0], torch.zeros(batch_size, n_tubes, 1),
+                          gt_rois[:, :, :, 2:4].max(2)[0], torch.full((batch_size, n_tubes, 1), time_dim - 1.),
+                          torch.ones(batch_size, n_tubes, 1)), 2)
+    return gt_tubes, gt_rois
+
+
+if __name__ == '__main__':
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(0)
+
+    model = _RPN(256).to(device)
+    im_size = 112
+    im_info = torch.Tensor([[im_size, im_size]]).to(device)
+    combined = cfg.RPN_COMBINED_HEADS
+    durations = cfg.TRAIN.RPN_DURATIONS
+
+    def sync(fn):
+        def run():
+            fn()
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+        return run
+
+    for batch_size in [1, 4]:
+        feats = torch.randn(batch_size, 256, 16, 7, 7).to(device)
+        gt_tubes, gt_rois = [x.to(device) for x in random_gt(batch_size, 2, im_size)]
+        print('batch size {}'.format(batch_size))
+
+        model.eval()
+        with torch.no_grad():
+            cfg.RPN_COMBINED_HEADS = True
+            out = model.temporal_branches(feats, [16, 8, 4])
+            cfg.RPN_COMBINED_HEADS = False
+            ref = model.temporal_branches(feats, [16, 8, 4])
+            print('  combined heads max abs diff : {:.2e}'.format(
+                max((out[d][i] - ref[d][i]).abs().max().item() for d in ref for i in range(2))))
+
+            for duration in [16, 8, 4]:
+                times = []
+                for cfg.RPN_COMBINED_HEADS in [False, True]:
+                    times.append(timed(sync(lambda: model.temporal_branches(feats, [duration]))))
+                print('  branch {:2d} frames ({:2d} windows) : separate heads {:6.1f}ms, combined {:6.1f}ms'.format(
+                    duration, 17 - duration, times[0] * 1000, times[1] * 1000))
+            cfg.RPN_COMBINED_HEADS = combined
+
+            t_eval = timed(sync(lambda: model(feats, im_info, None, None, None)))
+            t_all = timed(sync(lambda: model.temporal_branches(feats, [16, 8, 4])))
+            t_16 = timed(sync(lambda: model.temporal_branches(feats, [16])))
+        print('  eval forward {:.1f}ms, of which branches {:.1f}ms (all three branches {:.1f}ms)'.format(
+            t_eval * 1000, t_16 * 1000, t_all * 1000))
+
+        model.train()
+
+        def train_step():
+            _, loss_cls, loss_box = model(feats, im_info, gt_tubes, gt_rois, None, im_size=(im_size, im_size))
+            (loss_cls + loss_box).backward()
+
+        for cfg.RPN_COMBINED_HEADS in [False, True]:
+            times = []
+            for cfg.TRAIN.RPN_DURATIONS in [[16], [16, 8, 4]]:
+                times.append(timed(sync(train_step)))
+            print('  train step, {} heads : 16 frames branch {:.1f}ms, 16/8/4 {:.1f}ms'.format(
+                'combined' if cfg.RPN_COMBINED_HEADS else 'separate', times[0] * 1000, times[1] * 1000))
+        cfg.TRAIN.RPN_DURATIONS = durations
+        cfg.RPN_COMBINED_HEADS = combined
@@ -0,0 +1,104 @@
+"""
+Per-clip caches for training on a frozen backbone.
+
+`FeatureCache` stores the output of the frozen 3D backbone (`act_base`, or the
+pretrained resnet34 in train_region_net.py) for every (video, clip start,
+transform) key as a `.npy` file, optionally in float16. Cached features are
+opened with `mmap_mode='c'` (copy-on-write, nothing is read up front), so
+after the first epoch the datasets return features instead of decoding and
+transforming pixels, and the training loop skips the backbone.
+
+`ProposalCache` stores the post-NMS proposals of a trained RPN under the same
+clip keys (see dump_proposals.py), so the second stage can be trained on fixed
+proposals, Fast R-CNN style, without running the RPN.
+"""
+
+import os
+
+import numpy as np
+import torch
+
+from annotation_store import save_npy
+
+
+class FeatureCache(object):
+
+    def __init__(self, cache_dir, transform_id='', half=False):
+        self.cache_dir = cache_dir
+        self.transform_id = transform_id  # features depend on the spatial transform
+        self.half = half
+
+    def key(self, video, clip_start):
+        return '{}/{:05d}_{}'.format(video, clip_start, self.transform_id)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def get(self, key):
+        # no copy, still float16 for half caches: CachedFeatureExtractor casts
+        # the features to float once they are on the device
+        return torch.from_numpy(np.load(self.path(key), mmap_mode='c'))
+
+    def put(self, key, feat):
+        feat = feat.detach().cpu().numpy()
+        if self.half:
+            feat = feat.astype(np.float16)
+        save_npy(self.path(key), feat)
+
+
+class CachedFeatureExtractor(object):
+    """Runs `backbone` on the clips that aren't cached yet and stores the
+    result. The backbone is run in eval mode, without gradients, since the
+    cache is only valid for a fixed backbone.
+
+    A batch is either all features (`cached` is all ones) or all pixel clips;
+    the two don't collate together, so use it with batch_size=1 or a sampler
+    that doesn't mix them.
+    """
+
+    def __init__(self, backbone, cache, normalize=None):
+        self.backbone = backbone
+        self.cache = cache
+        self.normalize = normalize  # e.g. BatchNormalize for uint8 clips
+
+    def __call__(self, clips, keys, cached, device=None):
+        if bool(cached.all()):
+            if device is not None:
+                clips = clips.to(device, non_blocking=True)
+            return clips.float()
+
+        if self.normalize is not None:
+            clips = self.normalize(clips, device)
+        elif device is not None:
+            clips = clips.to(device, non_blocking=True)
+
+        self.backbone.eval()
+        with torch.no_grad():
+            feats = self.backbone(clips)
+        for key, feat in zip(keys, feats):
+            self.cache.put(key, feat)
+        return feats
+
+
+class ProposalCache(FeatureCache):
+    """Post-NMS proposals (n_proposals x (1 + 4 * time_dim)) of a fixed RPN,
+    keyed by the dataset's clip keys. Kept in float32, they are box
+    coordinates.
+
+    The proposals depend on the pre/post-NMS counts of the proposal layer, so
+    they are stored under a `pre{}_post{}` directory of `cache_dir`.
+    """
+
+    def __init__(self, cache_dir, pre_nms_topN, post_nms_topN):
+        self.pre_nms_topN = pre_nms_topN
+        self.post_nms_topN = post_nms_topN
+        cache_dir = os.path.join(cache_dir, 'pre{}_post{}'.format(pre_nms_topN, post_nms_topN))
+        super(ProposalCache, self).__init__(cache_dir, half=False)
+
+    def get(self, key):
+        # about 0.5MB a clip, used as they are instead of going through
+        # CachedFeatureExtractor, so read them into memory
+        return torch.from_numpy(np.load(self.path(key)))
@@ -0,0 +1,174 @@
+"""
+Packed clip shards.
+
+Every video's frame directory is packed into a single `<video_dir>.shard` file
+that lives next to the directory:
+
+    [ frame bytes | frame bytes | ... | index | footer ]
+
+The frames are stored exactly as they were encoded on disk (jpg/png), so
+decoding is unchanged. The index is an int64 array of shape (n_frames, 3)
+holding (frame_number, offset, length) for every frame, and the footer holds
+(index_offset, n_frames, magic). Reading a clip only needs slices of one
+memory-mapped file instead of an `os.path.exists` + `open` per frame.
+"""
+
+import os
+import io
+import re
+import glob
+import functools
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from frame_loaders import draft_open
+
+
+SHARD_EXT = '.shard'
+SHARD_MAGIC = 0x44524148535043  # 'CPSHARD'
+_FOOTER_SIZE = 3 * 8
+
+_frame_number_re = re.compile(r'(\d+)\.[^.]+$')
+
+
+def shard_path_for(video_dir_path):
+    return video_dir_path.rstrip('/') + SHARD_EXT
+
+
+class ClipShard(object):
+    """Read-only view over a packed `.shard` file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        footer = np.frombuffer(self._data[-_FOOTER_SIZE:].tobytes(), dtype=np.int64)
+        index_offset, n_frames, magic = [int(x) for x in footer]
+        if magic != SHARD_MAGIC:
+            raise IOError('{} is not a clip shard'.format(path))
+
+        index_end = index_offset + n_frames * 3 * 8
+        self.index = np.frombuffer(self._data[index_offset:index_end].tobytes(),
+                                   dtype=np.int64).reshape(n_frames, 3)
+        self.frames = self.index[:, 0]
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def find(self, frame_number):
+        """Returns the row of `frame_number` in the index or -1."""
+        pos = int(np.searchsorted(self.frames, frame_number))
+        if pos < len(self) and self.frames[pos] == frame_number:
+            return pos
+        return -1
+
+    def frame_buffer(self, frame_number):
+        """Returns the encoded bytes of a frame, or None if it is missing."""
+        pos = self.find(frame_number)
+        if pos < 0:
+            return None
+        offset, length = self.index[pos, 1], self.index[pos, 2]
+        return self._data[offset:offset + length]
+
+
+def pil_buffer_loader(buf):
+    with Image.open(io.BytesIO(buf)) as img:
+        return img.convert('RGB')
+
+
+def draft_buffer_loader(buf, size):
+    return draft_open(io.BytesIO(buf), size)
+
+
+# memory maps are cheap to keep around, but every DataLoader worker keeps its
+# own copy of this cache, so it is bounded.
+_open_shards = OrderedDict()
+_max_open_shards = 64
+
+
+def open_shard(path):
+    shard = _open_shards.pop(path, None)
+    if shard is None:
+        shard = ClipShard(path)
+        if len(_open_shards) >= _max_open_shards:
+            _open_shards.popitem(last=False)
+    _open_shards[path] = shard
+    return shard
+
+
+def shard_video_loader(video_dir_path, frame_indices, buffer_loader):
+    shard = open_shard(shard_path_for(video_dir_path))
+    video = []
+    for i in frame_indices:
+        buf = shard.frame_buffer(i)
+        if buf is None:
+            return video
+        video.append(buffer_loader(buf))
+
+    return video
+
+
+def get_shard_video_loader(sample_size=None):
+    if sample_size is not None:
+        buffer_loader = functools.partial(draft_buffer_loader, size=sample_size)
+    else:
+        buffer_loader = pil_buffer_loader
+    return functools.partial(shard_video_loader, buffer_loader=buffer_loader)
+
+
+def write_shard(frame_files, shard_path):
+    """Packs `frame_files` (sorted by frame number) into `shard_path`."""
+    frame_files = sorted(frame_files, key=frame_number)
+    index = np.zeros((len(frame_files), 3), dtype=np.int64)
+    tmp_path = shard_path + '.tmp'
+    with open(tmp_path, 'wb') as fp:
+        offset = 0
+        for k, fl in enumerate(frame_files):
+            with open(fl, 'rb') as f:
+                buf = f.read()
+            fp.write(buf)
+            index[k] = (frame_number(fl), offset, len(buf))
+            offset += len(buf)
+        fp.write(index.tobytes())
+        fp.write(np.array([offset, len(frame_files), SHARD_MAGIC], dtype=np.int64).tobytes())
+    os.rename(tmp_path, shard_path)
+    return len(frame_files)
+
+
+def frame_number(path):
+    return int(_frame_number_re.search(os.path.basename(path)).group(1))
+
+
+def convert_video_dir(video_dir_path, pattern='image_*.jpg', overwrite=False):
+    shard_path = shard_path_for(video_dir_path)
+    if os.path.exists(shard_path) and not overwrite:
+        return shard_path
+    frame_files = glob.glob(os.path.join(video_dir_path, pattern))
+    write_shard(frame_files, shard_path)
+    return shard_path
+
+
+def convert_dataset(dataset_path, pattern='image_*.jpg', overwrite=False):
+    """Converts every `dataset_path/<class>/<video>` frame directory."""
+    classes = next(os.walk(dataset_path, True))[1]
+    n_videos = 0
+    for cls in sorted(classes):
+        class_path = os.path.join(dataset_path, cls)
+        videos = next(os.walk(class_path, True))[1]
+        for vid in sorted(videos):
+            convert_video_dir(os.path.join(class_path, vid), pattern, overwrite)
+            n_videos += 1
+    print('converted {} videos'.format(n_videos))
+    return n_videos
+
+
+if __name__ == '__main__':
+
+    # ucf-101-24
+    dataset_folder = '/gpu-data/sgal/UCF-101-frames'
+    convert_dataset(dataset_folder, pattern='image_*.jpg')
+
+    # jhmdb
+    # dataset_folder = '/gpu-data/sgal/JHMDB-act-detector-frames'
+    # convert_dataset(dataset_folder, pattern='*.png')
@@ -137,6 +137,8 @@ __C.TRAIN.RPN_CLOBBER_POSITIVES = False
 __C.TRAIN.RPN_FG_FRACTION = 0.5
 # Total number of examples
 __C.TRAIN.RPN_BATCHSIZE = 256
+# Temporal RPN branches (anchors lasting 16, 8 and 4 frames) trained
+__C.TRAIN.RPN_DURATIONS = [16, 8, 4]
 # NMS threshold used on RPN proposals
 __C.TRAIN.RPN_NMS_THRESH = 0.7
 # Number of top scoring boxes to keep before apply NMS to RPN proposals
@@ -277,6 +279,25 @@ __C.EXP_DIR = 'default'
 # Use GPU implementation of non-maximum suppression
 __C.USE_GPU_NMS = True
 
+# How the per-frame IoUs of two proposal tubes are combined in tube NMS, 'mean' or 'min'
+__C.TUBE_NMS_OVERLAP = 'mean'
+
+# NMS of the RPN proposals: 'greedy' (tube NMS) or 'matrix' (decays the scores
+# instead of removing tubes, see nms/tube_nms.py)
+__C.RPN_NMS_MODE = 'greedy'
+
+# Evaluate the score and per frame bbox heads of each temporal RPN branch as one
+# batched matmul on its Conv3d output, permuting only the head outputs
+__C.RPN_COMBINED_HEADS = False
+
+# Matrix NMS decay function, 'gaussian' or 'linear', and gaussian sigma
+__C.MATRIX_NMS_KERNEL = 'gaussian'
+__C.MATRIX_NMS_SIGMA = 2.0
+
+# Anchors (or rois) per chunk of the overlap computations in bbox_transform.py,
+# bounds their temporaries to ~batch x chunk x gt boxes values
+__C.OVERLAPS_CHUNK_SIZE = 1024
+
 # Default GPU device id
 __C.GPU_ID = 0
 
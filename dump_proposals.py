@@ -0,0 +1,98 @@
+import os
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from video_dataset import Video, get_draft_video_loader
+from clip_cache import FeatureCache, CachedFeatureExtractor, ProposalCache
+from spatial_transforms import (
+    Compose, ClipScale, ClipToTensor, BatchNormalize)
+from temporal_transforms import LoopPadding
+from action_net import ACT_net
+from config import cfg
+
+np.random.seed(42)
+
+if __name__ == '__main__':
+
+    # Dumps the post-nms proposals of a trained rpn, per clip, for training the
+    # action head on fixed proposals (see proposal_cache in train_action_net.py).
+    # Clip starts are sampled like in training, so every pass adds new clips.
+
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    print("Device being used:", device)
+
+    dataset_folder = '/gpu-data/sgal/UCF-101-frames'
+    boxes_file = './pyannot.pkl'
+    model_path = './action_model_005.pwf'
+
+    sample_size = 112
+    sample_duration = 16  # len(images)
+
+    batch_size = 1
+    n_threads = 4
+    n_passes = 5
+
+    mean = [112.07945832, 112.87372333, 106.90993363]  # ucf-101 24 classes
+
+    actions = ['Basketball','BasketballDunk','Biking','CliffDiving','CricketBowling',
+               'Diving','Fencing','FloorGymnastics','GolfSwing','HorseRiding','IceDancing',
+               'LongJump','PoleVault','RopeClimbing','SalsaSpin','SkateBoarding','Skiing',
+               'Skijet','SoccerJuggling','Surfing','TennisSwing','TrampolineJumping',
+               'VolleyballSpiking','WalkingWithDog']
+
+    cls2idx = {actions[i]: i for i in range(0, len(actions))}
+
+    clip_transform = Compose([ClipScale(sample_size),
+                              ClipToTensor(as_uint8=True)])
+    batch_normalize = BatchNormalize(mean, [1, 1, 1])
+    temporal_transform = LoopPadding(sample_duration)
+
+    # same caches as train_action_net.py
+    feature_cache = FeatureCache('./act_base_features', transform_id='scale{}'.format(sample_size),
+                                 half=True)
+    # the proposals the head is trained on, so the rpn is run in eval mode
+    # (batchnorm, dropout) but with the TRAIN pre/post-nms counts of
+    # _ProposalLayer
+    proposal_cache = ProposalCache('./rpn_proposals', cfg.TRAIN.RPN_PRE_NMS_TOP_N,
+                                   cfg.TRAIN.RPN_POST_NMS_TOP_N)
+
+    data = Video(dataset_folder, frames_dur=sample_duration, clip_transform=clip_transform,
+                 temporal_transform=temporal_transform, json_file=boxes_file,
+                 mode='train', classes_idx=cls2idx,
+                 get_loader=lambda: get_draft_video_loader(sample_size),
+                 feature_cache=feature_cache)
+    data_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
+                                              shuffle=True, num_workers=n_threads, pin_memory=True)
+
+    model = ACT_net(actions)
+    model = nn.DataParallel(model)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model = model.module.to(device)
+    model.eval()
+
+    feature_extractor = CachedFeatureExtractor(model.act_base, feature_cache, batch_normalize)
+
+    n_dumped = 0
+    with torch.no_grad():
+        for p in range(n_passes):
+            for step, data in enumerate(data_loader):
+
+                clips,  (h, w), gt_tubes, gt_rois, clip_keys, cached = data
+                if clip_keys[0] in proposal_cache:
+                    continue
+
+                gt_tubes = gt_tubes.to(device)
+                gt_rois = gt_rois.to(device)
+                base_feat = feature_extractor(clips, clip_keys, cached, device)
+
+                rois, _, _ = model.act_rpn(base_feat,
+                                           torch.Tensor([[h, w]] * gt_tubes.size(1)).to(device),
+                                           gt_tubes, gt_rois,
+                                           torch.Tensor(len(gt_tubes)).to(device),
+                                           cfg_key='TRAIN')
+                proposal_cache.put(clip_keys[0], rois[0])
+                n_dumped += 1
+
+            print('pass {}/{}: {} clips dumped'.format(p+1, n_passes, n_dumped))
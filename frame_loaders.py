@@ -0,0 +1,61 @@
+"""
+Frame decoding shared by the datasets (video_dataset.py, jhmdb_dataset.py)
+and the clip shards (clip_shards.py).
+
+`draft_pil_loader` decodes a jpeg frame at reduced size and keeps the size of
+the frame on disk, read back with `original_size`. `threaded_video_loader`
+decodes the frames of a clip concurrently on a per-worker thread pool.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+def draft_open(f, size):
+    # let the jpeg decoder downscale by 1/2, 1/4 or 1/8 while decoding, to the
+    # smallest scale that still covers `size`. Boxes are annotated on the full
+    # frame, so the original size is kept in the image info.
+    with Image.open(f) as img:
+        original_size = img.size
+        img.draft('RGB', (size, size))  # no-op for non-jpeg images
+        img_rgb = img.convert('RGB')
+    img_rgb.info['original_size'] = original_size
+    return img_rgb
+
+
+def draft_pil_loader(path, size):
+    with open(path, 'rb') as f:
+        return draft_open(f, size)
+
+
+def original_size(img):
+    """(w, h) of the frame on disk, even if it was decoded at reduced size."""
+    return getattr(img, 'info', {}).get('original_size', img.size)
+
+
+# one decoding pool per DataLoader worker: pools don't survive a fork, so they
+# are keyed by pid as well as by size
+_decode_pools = {}
+
+
+def get_decode_pool(n_threads):
+    key = (os.getpid(), n_threads)
+    if key not in _decode_pools:
+        _decode_pools[key] = ThreadPoolExecutor(max_workers=n_threads)
+    return _decode_pools[key]
+
+
+def threaded_video_loader(video_dir_path, frame_indices, image_loader, n_threads,
+                          frame_name='image_{:05d}.jpg'):
+    # PIL releases the GIL while decoding, so the frames of a clip are decoded
+    # concurrently. Like video_loader, stop at the first missing frame.
+    image_paths = []
+    for i in frame_indices:
+        image_path = os.path.join(video_dir_path, frame_name.format(i))
+        if not os.path.exists(image_path):
+            break
+        image_paths.append(image_path)
+
+    return list(get_decode_pool(n_threads).map(image_loader, image_paths))
@@ -9,6 +9,10 @@ import copy
 import glob
 import json
 from create_tubes_from_boxes import create_tube
+from clip_shards import get_shard_video_loader
+from frame_loaders import draft_pil_loader, original_size, threaded_video_loader
+from video_manifest import load_manifest
+from annotation_store import BoxStore
 
 from spatial_transforms import (Compose, Normalize, Scale, CenterCrop, ToTensor, Resize)
 from temporal_transforms import LoopPadding
@@ -59,6 +63,20 @@ def get_default_video_loader():
     return functools.partial(video_loader, image_loader=image_loader)
 
 
+def get_threaded_video_loader(n_threads=4):
+    image_loader = get_default_image_loader()
+    return functools.partial(threaded_video_loader, image_loader=image_loader,
+                             n_threads=n_threads, frame_name='{:05d}.png')
+
+
+def get_draft_video_loader(sample_size=112, n_threads=None):
+    image_loader = functools.partial(draft_pil_loader, size=sample_size)
+    if n_threads:
+        return functools.partial(threaded_video_loader, image_loader=image_loader,
+                                 n_threads=n_threads, frame_name='{:05d}.png')
+    return functools.partial(video_loader, image_loader=image_loader)
+
+
 def load_annotation_data(data_file_path):
     with open(data_file_path, 'r') as data_file:
         return json.load(data_file)
@@ -155,20 +173,22 @@ def make_dataset(dataset_path, split_txt_path, boxes_file, mode='train'):
         for vid in videos:
 
             video_path = os.path.join(dataset_path, cls, vid)
-            n_frames = len(glob.glob(video_path+'/*.png'))
-            begin_t = 1
-            end_t = n_frames
-
             video_sample = {
                 'video': vid,
                 'class': cls,
                 'abs_path' : video_path,
-                'begin_t' : begin_t,
-                'end_t' : n_frames
-
             }
 
             dataset.append(video_sample)
+
+    # frame counts come from the cached manifest instead of a glob per video
+    manifest = load_manifest(boxes_file, [v['abs_path'] for v in dataset], '*.png')
+    for video_sample in dataset:
+        entry = manifest[video_sample['abs_path']]
+        video_sample['begin_t'] = 1
+        video_sample['end_t'] = entry['n_frames']
+        video_sample['size'] = (entry['width'], entry['height'])
+
     print(len(dataset))
     return dataset
 
@@ -176,17 +196,21 @@ def make_dataset(dataset_path, split_txt_path, boxes_file, mode='train'):
 class Video(data.Dataset):
     def __init__(self, video_path, frames_dur=8, split_txt_path=None,
                  spatial_transform=None, temporal_transform=None, json_file = None,
-                 sample_duration=16, get_loader=get_default_video_loader, mode='train', classes_idx=None):
+                 sample_duration=16, get_loader=get_default_video_loader, mode='train', classes_idx=None,
+                 clip_transform=None, feature_cache=None):
 
         self.mode = mode
         self.data = make_dataset(video_path, split_txt_path, json_file, self.mode)
 
         self.spatial_transform = spatial_transform
+        self.clip_transform = clip_transform  # applied to the whole clip, instead of spatial_transform
         self.temporal_transform = temporal_transform
         self.loader = get_loader()
         self.sample_duration = frames_dur
         self.json_file = json_file
+        self.box_store = BoxStore(json_file)
         self.classes_idx = classes_idx
+        self.feature_cache = feature_cache
         
     def __getitem__(self, index):
         """
@@ -216,33 +240,48 @@ class Video(data.Dataset):
         # print(frame_indices)
         if self.temporal_transform is not None:
             frame_indices = self.temporal_transform(frame_indices)
-        clip = self.loader(path, frame_indices)
-
-        # # get original height and width
-        # print('clip.size :', clip[0].size)
-        w, h = clip[0].size
-        
-        if self.spatial_transform is not None:
-            clip = [self.spatial_transform(img) for img in clip]
-        clip = torch.stack(clip, 0).permute(1, 0, 2, 3)
 
         # get bbox
         cls = self.data[index]['class']
         name = self.data[index]['video']
         json_key = os.path.join(cls, name)
 
+        clip_key, cached = None, False
+        if self.feature_cache is not None:
+            clip_key = self.feature_cache.key(json_key, time_index)
+            cached = clip_key in self.feature_cache
+
+        if cached:
+            # backbone features of this clip, instead of its pixels
+            clip = self.feature_cache.get(clip_key)
+            w, h = self.data[index]['size']
+        else:
+            clip = self.loader(path, frame_indices)
+
+            # # get original height and width
+            # print('clip.size :', clip[0].size)
+            w, h = original_size(clip[0])
+
+            if self.clip_transform is not None:
+                clip = self.clip_transform(clip)
+            else:
+                if self.spatial_transform is not None:
+                    clip = [self.spatial_transform(img) for img in clip]
+                clip = torch.stack(clip, 0).permute(1, 0, 2, 3)
+
         # print(json_key)
-        with open(self.json_file, 'r') as fp:
-            data = json.load(fp)[json_key]
-            
-        boxes = data[time_index-1:time_index +self.sample_duration-1] # because time_index starts from 1
-        
+        boxes = self.box_store.boxes(json_key)[time_index-1:time_index +self.sample_duration-1] # because time_index starts from 1
+        boxes = torch.from_numpy(np.array(boxes))  # copy out of the memory map
+        n_boxes = boxes.size(0)
+
         class_int = self.classes_idx[cls]
         # frames = list(range( time_index, time_index + self.sample_duration))
         target = torch.IntTensor([class_int] * self.sample_duration)
         # print(len(boxes)
-        gt_bboxes = torch.Tensor([boxes[i] + [ class_int] for i in range(len(boxes))]).clamp_(min=0)
-        gt_bboxes_tube = torch.Tensor([boxes[i] + [i, class_int] for i in range(len(boxes))]).unsqueeze(0)
+        labels = boxes.new_full((n_boxes, 1), class_int)
+        frame_ids = torch.arange(n_boxes, dtype=boxes.dtype).unsqueeze(1)
+        gt_bboxes = torch.cat([boxes, labels], 1).clamp_(min=0)
+        gt_bboxes_tube = torch.cat([boxes, frame_ids, labels], 1).unsqueeze(0)
         gt_bboxes = torch.round(gt_bboxes)
         # print('gt_bboxes.shape :',gt_bboxes.shape)
         # im_info_tube = torch.Tensor([[w,h,frames[0],frames[-1]]*gt_bboxes.size(0)])
@@ -253,9 +292,13 @@ class Video(data.Dataset):
         
         # print(gt_bboxes)
         if self.mode == 'train':
-            return clip, (h,w), gt_tubes, gt_bboxes
+            ret = clip, (h,w), gt_tubes, gt_bboxes
         else:
-            return clip, (h,w), gt_tubes, gt_bboxes, self.data[index]['abs_path'], frame_indices
+            ret = clip, (h,w), gt_tubes, gt_bboxes, self.data[index]['abs_path'], frame_indices
+
+        if self.feature_cache is not None:
+            ret += (clip_key, cached)
+        return ret
         
         
     def __len__(self):
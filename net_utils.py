@@ -90,7 +90,27 @@ def _smooth_l1_loss(bbox_pred, bbox_targets, bbox_inside_weights, bbox_outside_w
     loss_box = loss_box.mean()
     return loss_box
 
-def _crop_pool_layer(bottom, rois, max_pool=True):
+def _crop_weights(start, end, n_samples, size, offset=None, n_cols=None):
+    # (n, n_samples, n_cols) bilinear weights of n_samples points evenly spaced
+    # from start to end (feature map coordinates) along an axis of length size,
+    # at columns offset + [0, size). Out of the map neighbours get no weight,
+    # like the zero padding of F.grid_sample
+    steps = torch.arange(n_samples, dtype=start.dtype, device=start.device) / max(n_samples - 1, 1)
+    pos = start.view(-1, 1) + (end - start).view(-1, 1) * steps.view(1, -1)
+    lower = pos.floor()
+    ratio = pos - lower
+    lower = lower.long()
+
+    weights = pos.new_zeros(pos.size(0), n_samples, n_cols or size)
+    for idx, w in ((lower, 1 - ratio), (lower + 1, ratio)):
+        inside = (idx >= 0) & (idx < size)
+        idx = idx.clamp(0, size - 1)
+        if offset is not None:
+            idx = idx + offset.view(-1, 1)
+        weights.scatter_add_(2, idx.unsqueeze(2), (w * inside.type_as(w)).unsqueeze(2))
+    return weights
+
+def _crop_pool_layer(bottom, rois, max_pool=True, spatial_scale=1.0/16):
     # code modified from 
     # https://github.com/ruotianluo/pytorch-faster-rcnn
     # implement it using stn
@@ -104,44 +124,69 @@ def _crop_pool_layer(bottom, rois, max_pool=True):
     [           y2-y1    y1 + y2 - H + 1  ]
     [    0      -----    ---------------  ]
     [           H - 1         H - 1      ]
+
+    bottom : (B, D, H, W) and rois (N, 5), or per frame (B, D, T, H, W) and
+             rois (N, 1 + 4 * T) (a box per frame)
+    Returns the (N, D, P, P) / (N, D, T, P, P) crops (P = cfg.POOLING_SIZE) and
+    the sampling grid of every box.
+
+    Same samples as F.grid_sample(bottom, F.affine_grid(theta), align_corners=True),
+    but the bilinear interpolation is done as two matmuls with per box weights.
+    The rows of the first one index the (batch, frame, row) of the shared
+    feature map, so every box reads its own clip and frame and the feature map
+    isn't copied once per roi. Rois are cropped in chunks, pooled and written
+    to the output, so the pre pooling crops are never all in memory.
     """
     rois = rois.detach()
-    batch_size = bottom.size(0)
-    D = bottom.size(1)
-    H = bottom.size(2)
-    W = bottom.size(3)
-    roi_per_batch = rois.size(0) / batch_size
-    x1 = rois[:, 1::4] / 16.0
-    y1 = rois[:, 2::4] / 16.0
-    x2 = rois[:, 3::4] / 16.0
-    y2 = rois[:, 4::4] / 16.0
-
-    height = bottom.size(2)
-    width = bottom.size(3)
-
-    # affine theta
-    zero = Variable(rois.data.new(rois.size(0), 1).zero_())
+    per_frame = bottom.dim() == 5
+    if not per_frame:
+        bottom = bottom.unsqueeze(2)
+    batch_size, D, T, H, W = bottom.size()
+    n_rois = rois.size(0)
+    x1 = rois[:, 1::4] * spatial_scale
+    y1 = rois[:, 2::4] * spatial_scale
+    x2 = rois[:, 3::4] * spatial_scale
+    y2 = rois[:, 4::4] * spatial_scale
+
+    height = bottom.size(3)
+    width = bottom.size(4)
+
+    # affine theta, for the returned grid
+    zero = x1.new_zeros(x1.numel(), 1)
     theta = torch.cat([\
-      (x2 - x1) / (width - 1),
+      (x2 - x1).view(-1, 1) / (width - 1),
       zero,
-      (x1 + x2 - width + 1) / (width - 1),
+      (x1 + x2 - width + 1).view(-1, 1) / (width - 1),
       zero,
-      (y2 - y1) / (height - 1),
-      (y1 + y2 - height + 1) / (height - 1)], 1).view(-1, 2, 3)
-
-    if max_pool:
-      pre_pool_size = cfg.POOLING_SIZE * 2
-      grid = F.affine_grid(theta, torch.Size((rois.size(0), 1, pre_pool_size, pre_pool_size)))
-      bottom = bottom.view(1, batch_size, D, H, W).contiguous().expand(roi_per_batch, batch_size, D, H, W)\
-                                                                .contiguous().view(-1, D, H, W)
-      crops = F.grid_sample(bottom, grid)
-      crops = F.max_pool2d(crops, 2, 2)
-    else:
-      grid = F.affine_grid(theta, torch.Size((rois.size(0), 1, cfg.POOLING_SIZE, cfg.POOLING_SIZE)))
-      bottom = bottom.view(1, batch_size, D, H, W).contiguous().expand(roi_per_batch, batch_size, D, H, W)\
-                                                                .contiguous().view(-1, D, H, W)
-      crops = F.grid_sample(bottom, grid)
-    
+      (y2 - y1).view(-1, 1) / (height - 1),
+      (y1 + y2 - height + 1).view(-1, 1) / (height - 1)], 1).view(-1, 2, 3)
+
+    pool_size = cfg.POOLING_SIZE * 2 if max_pool else cfg.POOLING_SIZE
+    grid = F.affine_grid(theta, torch.Size((theta.size(0), 1, pool_size, pool_size)), align_corners=True)
+
+    # rows of (batch, frame) b * T + t of every box
+    frame = (rois[:, :1].long() * T + torch.arange(T, device=rois.device).view(1, -1)).view(-1)
+    weights_y = _crop_weights(y1.reshape(-1), y2.reshape(-1), pool_size, H, frame * H, batch_size * T * H)
+    weights_x = _crop_weights(x1.reshape(-1), x2.reshape(-1), pool_size, W)
+    weights_y = weights_y.view(n_rois, T * pool_size, -1).type_as(bottom)
+    weights_x = weights_x.view(n_rois, T, pool_size, W).type_as(bottom)
+    rows = bottom.permute(0, 2, 3, 1, 4).reshape(batch_size * T * H, D * W)
+
+    # rois in chunks of ~4M values in the (pre pooling) crops
+    chunk_size = max(1, (1 << 22) // (T * pool_size * D * max(pool_size, W)))
+    crops = bottom.new_empty(n_rois, D, T, cfg.POOLING_SIZE, cfg.POOLING_SIZE)
+    for i in range(0, n_rois, chunk_size):
+      n = min(chunk_size, n_rois - i)
+      # (n*T*P, B*T*H) x (B*T*H, D*W) -> (n*T, P*D, W) x (n*T, W, P) -> (n, D, T, P, P)
+      x = torch.mm(weights_y[i:i+n].view(-1, rows.size(0)), rows).view(n * T, pool_size * D, W)
+      x = torch.bmm(x, weights_x[i:i+n].view(n * T, pool_size, W).transpose(1, 2))
+      x = x.view(n, T, pool_size, D, pool_size).permute(0, 3, 1, 2, 4)
+      if max_pool:
+        x = F.max_pool2d(x.reshape(n, D * T, pool_size, pool_size), 2, 2).view(n, D, T, cfg.POOLING_SIZE, cfg.POOLING_SIZE)
+      crops[i:i+n] = x
+
+    if not per_frame:
+      crops = crops.squeeze(2)
     return crops, grid
 
 def _affine_grid_gen(rois, input_size, grid_size):
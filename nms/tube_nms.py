@@ -0,0 +1,281 @@
+from __future__ import absolute_import
+
+import bisect
+from itertools import accumulate
+
+import torch
+
+
+def tube_overlaps(tubes_a, tubes_b, time_dim, mode='mean'):
+    """Pairwise overlaps of two sets of tubes.
+
+    tubes_a : (N, 4 * time_dim) x1,y1,x2,y2 of every frame
+    tubes_b : (M, 4 * time_dim)
+    Returns the (N, M) mean (or min) over frames of the per-frame IoUs.
+    """
+    a = tubes_a.view(-1, 1, time_dim, 4)
+    b = tubes_b.view(1, -1, time_dim, 4)
+
+    area_a = (a[..., 2] - a[..., 0] + 1) * (a[..., 3] - a[..., 1] + 1)
+    area_b = (b[..., 2] - b[..., 0] + 1) * (b[..., 3] - b[..., 1] + 1)
+
+    iw = torch.min(a[..., 2], b[..., 2]) - torch.max(a[..., 0], b[..., 0]) + 1
+    ih = torch.min(a[..., 3], b[..., 3]) - torch.max(a[..., 1], b[..., 1]) + 1
+    inter = iw.clamp_(min=0) * ih.clamp_(min=0)
+    iou = inter / (area_a + area_b - inter)  # N x M x time_dim
+
+    if mode == 'min':
+        return iou.min(2)[0]
+    return iou.mean(2)
+
+
+def _tube_stats(tubes, time_dim):
+    """Hull box (x1,y1,x2,y2 over all frames), smallest and largest box area
+    of every tube."""
+    t = tubes.view(-1, time_dim, 4)
+    hull = torch.cat((t[..., :2].min(1)[0], t[..., 2:].max(1)[0]), 1)
+    areas = (t[..., 2] - t[..., 0] + 1) * (t[..., 3] - t[..., 1] + 1)
+    return hull, areas.min(1)[0], areas.max(1)[0]
+
+
+def _index_stats(stats, idx):
+    return tuple(x[idx] for x in stats)
+
+
+def _overlap_mask(tubes_a, stats_a, tubes_b, stats_b, thresh, time_dim, mode):
+    """(N, M) mask of tube_overlaps(tubes_a, tubes_b) > thresh.
+
+    The intersection of two boxes is at most the intersection of the tubes'
+    hulls and at most the smaller box, and their union at least the larger
+    box, so every per-frame IoU is bounded by
+        min(|hull_a & hull_b|, max_area_a, max_area_b) / max(min_area_a, min_area_b)
+    Only the pairs where the bound is above `thresh` need the per-frame IoUs.
+    Proposals are mostly far apart, so this skips most of the work.
+    """
+    hull_a, min_area_a, max_area_a = stats_a
+    hull_b, min_area_b, max_area_b = stats_b
+
+    iw = torch.min(hull_a[:, None, 2], hull_b[None, :, 2]) - torch.max(hull_a[:, None, 0], hull_b[None, :, 0]) + 1
+    ih = torch.min(hull_a[:, None, 3], hull_b[None, :, 3]) - torch.max(hull_a[:, None, 1], hull_b[None, :, 1]) + 1
+    bound = iw.clamp_(min=0).mul_(ih.clamp_(min=0))
+    bound = torch.min(bound, torch.min(max_area_a[:, None], max_area_b[None, :]))
+    bound /= torch.max(min_area_a[:, None], min_area_b[None, :])
+
+    mask = bound > thresh
+    pairs = mask.nonzero()
+    if pairs.size(0) > 0:
+        ovr = _paired_overlaps(tubes_a[pairs[:, 0]], tubes_b[pairs[:, 1]], time_dim, mode)
+        mask[pairs[:, 0], pairs[:, 1]] = ovr > thresh
+    return mask
+
+
+def _paired_overlaps(tubes_a, tubes_b, time_dim, mode):
+    """Overlaps of tubes_a[i] with tubes_b[i]."""
+    a = tubes_a.view(-1, time_dim, 4)
+    b = tubes_b.view(-1, time_dim, 4)
+    area_a = (a[..., 2] - a[..., 0] + 1) * (a[..., 3] - a[..., 1] + 1)
+    area_b = (b[..., 2] - b[..., 0] + 1) * (b[..., 3] - b[..., 1] + 1)
+    iw = torch.min(a[..., 2], b[..., 2]) - torch.max(a[..., 0], b[..., 0]) + 1
+    ih = torch.min(a[..., 3], b[..., 3]) - torch.max(a[..., 1], b[..., 1]) + 1
+    inter = iw.clamp_(min=0) * ih.clamp_(min=0)
+    iou = inter / (area_a + area_b - inter)
+    if mode == 'min':
+        return iou.min(1)[0]
+    return iou.mean(1)
+
+
+def _offset_tubes(tubes, batch_idx):
+    """Moves the tubes of every sample to their own region of the image plane,
+    so that tubes of different samples never overlap and one nms pass over the
+    whole batch gives the per-sample results."""
+    offset = (tubes.max() - tubes.min() + 1) * batch_idx.to(tubes.dtype)
+    return tubes + offset.view(-1, 1)
+
+
+def rank_in_sample(batch_idx):
+    """Position of every entry among the entries of the same sample, keeping
+    their order, e.g. [0, 1, 0, 0, 1] -> [0, 0, 1, 2, 1]."""
+    n = batch_idx.numel()
+    order = torch.sort(batch_idx, stable=True, dim=0)[1]
+    sorted_idx = batch_idx[order]
+    # first position of every sample, without the sync of a bincount
+    starts = torch.searchsorted(sorted_idx, sorted_idx)
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(n, device=batch_idx.device) - starts
+    return rank
+
+
+def tube_nms(tubes, scores, thresh, time_dim, max_keep=0, mode='mean', block_size=512,
+             batch_idx=None):
+    """Greedy NMS over tubes, using `tube_overlaps` as the overlap.
+
+    Candidates are visited in blocks of `block_size` in score order. A block is
+    first suppressed against everything kept so far, then the greedy order
+    inside the block is resolved with a few vectorized fixed-point steps, so
+    the result is the same as the one-box-at-a-time loop. Stops as soon as
+    `max_keep` (> 0) tubes are kept.
+
+    With `batch_idx` (the sample of every tube), tubes of different samples
+    don't suppress each other and `max_keep` is per sample.
+
+    Returns the kept indices into `tubes`, sorted by score.
+    """
+    if tubes.size(0) == 0:
+        return tubes.new_zeros((0,), dtype=torch.long)
+
+    order = torch.sort(scores.view(-1), 0, True)[1]
+    if batch_idx is not None:
+        tubes = _offset_tubes(tubes, batch_idx)
+        batch_idx = batch_idx[order]
+        n_kept = tubes.new_zeros(int(batch_idx.max()) + 1, dtype=torch.long)
+    else:
+        n_kept = 0
+    tubes = tubes[order]
+    stats = _tube_stats(tubes, time_dim)
+
+    kept_idx = []
+    for start in range(0, tubes.size(0), block_size):
+        block = tubes[start:start + block_size]
+        block_stats = _index_stats(stats, slice(start, start + block_size))
+
+        # suppressed by a tube kept in a previous block
+        if len(kept_idx) > 0:
+            kept = torch.cat(kept_idx, 0)
+            keep = ~_overlap_mask(block, block_stats, tubes[kept], _index_stats(stats, kept),
+                                  thresh, time_dim, mode).any(1)
+        else:
+            keep = torch.ones(block.size(0), dtype=torch.bool, device=tubes.device)
+
+        # inside the block, a tube is suppressed only by higher scoring tubes
+        # that survive themselves, iterate until that is consistent
+        if block.size(0) > 1:
+            suppress = _overlap_mask(block, block_stats, block, block_stats, thresh, time_dim, mode)
+            suppress.triu_(diagonal=1)
+            alive = keep
+            while True:
+                new_alive = keep & ~(suppress & alive.view(-1, 1)).any(0)
+                if torch.equal(new_alive, alive):
+                    break
+                alive = new_alive
+            keep = alive
+
+        keep_block = keep.nonzero().view(-1) + start
+        kept_idx.append(keep_block)
+        if batch_idx is not None:
+            n_kept += torch.bincount(batch_idx[keep_block], minlength=n_kept.numel())
+            if max_keep > 0 and int(n_kept.min()) >= max_keep:
+                break
+        else:
+            n_kept += keep_block.numel()
+            if max_keep > 0 and n_kept >= max_keep:
+                break
+
+    kept_idx = torch.cat(kept_idx, 0)
+    keep = order[kept_idx]
+    if max_keep > 0:
+        if batch_idx is not None:
+            keep = keep[rank_in_sample(batch_idx[kept_idx]) < max_keep]
+        else:
+            keep = keep[:max_keep]
+    return keep
+
+
+def _frame_coords(tubes, time_dim):
+    """time_dim x 4 x N coordinates and time_dim x N areas, so that every
+    frame's coordinates are contiguous."""
+    coords = tubes.view(-1, time_dim, 4).permute(1, 2, 0).contiguous()
+    areas = (coords[:, 2] - coords[:, 0] + 1) * (coords[:, 3] - coords[:, 1] + 1)
+    return coords, areas
+
+
+def _block_overlaps(coords, areas, rows, cols, mode):
+    """Dense (rows x cols) tube overlaps, one frame at a time. Cheaper than
+    gathering pairs when most of them overlap, as in matrix nms."""
+    ovr = None
+    for t in range(coords.size(0)):
+        x1, y1, x2, y2 = coords[t]
+        iw = torch.min(x2[rows, None], x2[None, cols]).sub_(torch.max(x1[rows, None], x1[None, cols]))
+        ih = torch.min(y2[rows, None], y2[None, cols]).sub_(torch.max(y1[rows, None], y1[None, cols]))
+        inter = iw.add_(1).clamp_(min=0).mul_(ih.add_(1).clamp_(min=0))
+        iou = inter.div_((areas[t, rows, None] + areas[t, None, cols]).sub_(inter))
+        if ovr is None:
+            ovr = iou
+        elif mode == 'min':
+            ovr = torch.min(ovr, iou)
+        else:
+            ovr.add_(iou)
+    if mode != 'min':
+        ovr /= coords.size(0)
+    return ovr
+
+
+def matrix_nms(tubes, scores, time_dim, max_keep=0, mode='mean', kernel='gaussian',
+               sigma=2.0, block_size=512, batch_idx=None, sample_sizes=None):
+    """Matrix NMS (SOLOv2) over tubes: instead of removing overlapping tubes,
+    the score of every tube is decayed by its overlap with the higher scoring
+    ones, compensated by how much those were suppressed themselves:
+
+        decay_j = min_{i < j} f(iou_ij) / f(max_{k < i} iou_ki)
+
+    with f(x) = exp(-sigma * x^2) ('gaussian') or 1 - x ('linear'). The upper
+    triangle of the overlap matrix is computed once, in blocks of rows, and
+    reduced on the fly, so there is no loop over the kept tubes.
+
+    With `batch_idx`, the tubes are grouped by sample and a block of rows is
+    only compared with the tubes of its own samples, so the cost grows
+    linearly with the batch size. `max_keep` is per sample then.
+    `sample_sizes`, the number of tubes of every sample as ints, gives the block
+    bounds without reading `batch_idx` back to the host.
+
+    Returns (keep, decayed_scores): the indices of the `max_keep` best tubes by
+    decayed score and the decayed scores of all tubes, in the input order.
+    """
+    n = tubes.size(0)
+    if n == 0:
+        return tubes.new_zeros((0,), dtype=torch.long), scores.view(-1)
+
+    order = torch.sort(scores.view(-1), 0, True)[1]
+    if batch_idx is not None:
+        tubes = _offset_tubes(tubes, batch_idx)
+        order = order[torch.sort(batch_idx[order], stable=True, dim=0)[1]]
+        # the end of every sample in the grouped order
+        if sample_sizes is None:
+            sample_sizes = torch.bincount(batch_idx).tolist()
+        sample_ends = list(accumulate(sample_sizes))
+    coords, areas = _frame_coords(tubes[order], time_dim)
+
+    col_max = tubes.new_zeros(n)        # max iou with a higher scoring tube
+    decay = tubes.new_ones(n)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        # up to the end of the sample of the last row
+        cols_end = sample_ends[bisect.bisect_right(sample_ends, end - 1)] if batch_idx is not None else n
+
+        # iou of the block's rows with themselves and every later tube
+        iou = _block_overlaps(coords, areas, slice(start, end), slice(start, cols_end), mode)
+        iou.triu_(diagonal=1)
+
+        # compensation of the rows: earlier blocks are already in col_max, add
+        # the rows above them in this block
+        compensate = torch.max(col_max[start:end], iou[:, :end - start].max(0)[0])
+
+        if kernel == 'linear':
+            block_decay = (1 - iou).div_((1 - compensate).clamp(min=1e-6).view(-1, 1))
+        else:
+            block_decay = torch.exp((iou ** 2).sub_(compensate.view(-1, 1) ** 2).mul_(-sigma))
+
+        decay[start:cols_end] = torch.min(decay[start:cols_end], block_decay.min(0)[0].clamp_(max=1))
+        col_max[start:cols_end] = torch.max(col_max[start:cols_end], iou.max(0)[0])
+
+    decayed = scores.view(-1)[order] * decay
+    keep = order[torch.sort(decayed, 0, True)[1]]
+    if max_keep > 0:
+        if batch_idx is not None:
+            keep = keep[rank_in_sample(batch_idx[keep]) < max_keep]
+        else:
+            keep = keep[:max_keep]
+
+    decayed_scores = scores.new_empty(n)
+    decayed_scores[order] = decayed
+    return keep, decayed_scores
+
@@ -16,8 +16,10 @@ import math
 import yaml
 from config import cfg
 from generate_anchors import generate_anchors
+from anchor_cache import AnchorGrid
 from bbox_transform import bbox_transform_inv, clip_boxes, clip_boxes_batch, bbox_frames_transform_inv
 from nms.nms_wrapper import nms
+from nms.tube_nms import tube_nms, matrix_nms, rank_in_sample
 
 import pdb
 
@@ -33,10 +35,9 @@ class _ProposalLayer(nn.Module):
         super(_ProposalLayer, self).__init__()
 
         self._feat_stride = feat_stride
-        self._anchors = torch.from_numpy(generate_anchors(scales=np.array(scales), 
-                                                          ratios=np.array(ratios),
-                                                          base_size = 14)).float()
-        self._num_anchors = self._anchors.size(0)
+        self._anchor_grid = AnchorGrid(feat_stride, scales, ratios, base_size=14)
+        self._anchors = self._anchor_grid.base_anchors
+        self._num_anchors = self._anchor_grid.num_anchors
 
         # rois blob: holds R regions of interest, each is a 5-tuple
         # (n, x1, y1, x2, y2) specifying an image batch index n and a
@@ -74,20 +75,10 @@ class _ProposalLayer(nn.Module):
         # print('bbox_frame.shape :',bbox_frame.shape)
 
         batch_size = bbox_frame.size(0)
-        # pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N
-        # post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
-        # nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH
-        # min_size      = cfg[cfg_key].RPN_MIN_SIZE
-        if cfg_key == 'TRAIN':
-            pre_nms_topN  = 12000
-            post_nms_topN = 2000
-            nms_thresh    = 0.7
-            min_size      = 8
-        else:
-            pre_nms_topN  = 6000
-            post_nms_topN = 300
-            nms_thresh    = 0.7
-            min_size      = 16
+        pre_nms_topN  = cfg[cfg_key].RPN_PRE_NMS_TOP_N
+        post_nms_topN = cfg[cfg_key].RPN_POST_NMS_TOP_N
+        nms_thresh    = cfg[cfg_key].RPN_NMS_THRESH
+        min_size      = cfg[cfg_key].RPN_MIN_SIZE
 
         ##################
         # Create anchors #
@@ -95,129 +86,96 @@ class _ProposalLayer(nn.Module):
 
         # print('batch_size :', batch_size)
         feat_height, feat_width = scores.size(2), scores.size(3)
-        shift_x = np.arange(0, feat_width) * self._feat_stride
-        shift_y = np.arange(0, feat_height) * self._feat_stride
-        shift_x, shift_y = np.meshgrid(shift_x, shift_y)
-        shifts = torch.from_numpy(np.vstack((shift_x.ravel(), shift_y.ravel(),
-                                  shift_x.ravel(), shift_y.ravel())).transpose())
-        shifts = shifts.contiguous().type_as(scores).float()
-
-        
-        A = self._num_anchors
-        K = shifts.size(0)
-
-        self._anchors = self._anchors.type_as(scores)
-
-        # print('self._anchors.shape :',self._anchors.shape)
-
-        anchors = self._anchors.view(1, A, 4) + shifts.view(K, 1, 4)
-        anchors = anchors.view(1, K * A, 4)
-        # anchors = anchors.expand(batch_size, K * A, 4)
-
-        frame_anchors = anchors.expand(1,time_dim,K*A,4).contiguous()
-        frame_anchors = anchors.expand(batch_size,time_dim,K*A,4).contiguous()
-        frame_anchors = frame_anchors.view(batch_size,-1,4) ## same anchors for #time_dim frames
-        # print('frame_anchors.shape :',frame_anchors.shape)
-
-
-        # Transpose and reshape predicted bbox transformations to get them
-        # into the same order as the anchors:
-        # print('bbox_deltas.shape :', bbox_deltas.shape)
-
-        # bbox_deltas = bbox_deltas.permute(0, 2, 3, 1).contiguous()
-        # bbox_deltas = bbox_deltas.view(batch_size, -1, 4)
-
-        # Now for bbox_frame
-        # print('bbox_frame.shape :',bbox_frame.shape )
+        anchors = self._anchor_grid.anchors(feat_height, feat_width, scores.device, scores.dtype)
 
-        bbox_frame = bbox_frame.permute(0,2,3,1).contiguous()
-        bbox_frame = bbox_frame.view(batch_size,-1,4)
-
-        # Same story for the scores:
-        scores = scores.permute(0, 2, 3, 1).contiguous()
-        scores = scores.view(batch_size, -1)
-
-        ###############################
-        # Until now, everything is ok #
-        ###############################
-        """
-        we have for 16 frames, 7056 anchors,
-        first 441 correspond to 441 anchors for the first frame,
-        second 441 to the 441 for the sencond frame etc.
-        """
-        # Convert anchors into proposals via bbox transformations
-        # proposals = bbox_frames_transform_inv(anchors, bbox_deltas, batch_size)
-        proposals = bbox_frames_transform_inv(frame_anchors, bbox_frame, batch_size) # proposals have 441 * time_dim shape
-        # print('proposals.shape :',proposals.shape)
-        # print('proposals :',proposals)
+        # 1. take top pre_nms_topN (e.g. 6000) (proposal, score) pairs of every
+        # sample and convert their anchors into proposals via bbox transformations
+        scores_keep, proposals = self._select_proposals(scores, bbox_frame, anchors,
+                                                        time_dim, pre_nms_topN)
 
         # 2. clip predicted boxes to image
         ## if any dimension exceeds the dims of the original image, clamp_ them
-        proposals = clip_boxes(proposals, torch.Tensor(im_info.tolist() * 1).cuda(), 1)
-
-        # print('proposals.shape :',proposals.shape)
-        # print('proposals :',proposals)
-
-        # assign the score to 0 if it's non keep.
-        # keep = self._filter_boxes(proposals, min_size * im_info[:, 2])
-
-        # trim keep index to make it euqal over batch
-        # keep_idx = torch.cat(tuple(keep_idx), 0)
-
-        # scores_keep = scores.view(-1)[keep_idx].view(batch_size, trim_size)
-        # proposals_keep = proposals.view(-1, 4)[keep_idx, :].contiguous().view(batch_size, trim_size, 4)
-        
-        # _, order = torch.sort(scores_keep, 1, True)
-        # print('proposals.shape :',proposals.shape)
-        proposals_reshaped = proposals.view(batch_size,time_dim, K*A,4)
-        proposals_reshaped = proposals_reshaped.permute(0,2,1,3).contiguous()
-        proposals_reshaped = proposals_reshaped.view(batch_size,K*A,time_dim*4)
-        proposals_reshaped = proposals_reshaped.view(-1,time_dim*4)
-        # print('reshaped_proposals.shape :',proposals_reshaped.shape)        
-
-        scores_single = scores.view(-1)
-        # print('scores_single.shape :',scores_single.shape)
-        _, order_single = torch.sort(scores_single, 0, True)
-
-        
-        output = scores.new(post_nms_topN, 4*time_dim + 1).zero_()
+        ## (all the clips of a batch have the same size)
+        im_shape = im_info[:1].type_as(proposals).expand(batch_size, -1)
+        proposals = clip_boxes(proposals, im_shape, batch_size)
 
         # # 3. remove predicted boxes with either height or width < threshold
         # # (NOTE: convert min_size to input image scale stored in im_info[2])
-        # # 4. sort all (proposal, score) pairs by score from highest to lowest
-        # # 5. take top pre_nms_topN (e.g. 6000)
-
-        if pre_nms_topN > 0 and pre_nms_topN < scores_single.numel():
-            order_single = order_single[:pre_nms_topN]
-
-        proposals_reshaped = proposals_reshaped[order_single, :]
-        scores_single = scores_single[order_single].view(-1,1)
 
         # 6. apply nms (e.g. threshold = 0.7)
         # 7. take after_nms_topN (e.g. 300)
         # 8. return the top proposals (-> RoIs top)
 
-        keep_idx_i = nms(torch.cat((proposals_reshaped, scores_single), 1), nms_thresh, force_cpu=not cfg.USE_GPU_NMS)
-        # keep_idx_i = nms(torch.cat((proposals_reshaped, scores_single), 1), nms_thresh, force_cpu=True)
-        keep_idx_i = keep_idx_i.long().view(-1)
+        # one nms pass over the whole batch, tubes of different samples don't
+        # suppress each other and post_nms_topN is per sample
+        n_keep = scores_keep.size(1)
+        proposals = proposals.view(-1, time_dim*4)
+        scores_keep = scores_keep.contiguous().view(-1)
+        batch_idx = torch.arange(batch_size, device=proposals.device).view(-1,1).expand(-1, n_keep).contiguous().view(-1)
+
+        # nms() only looks at the first box (frame 0) and reads a box column as the score,
+        # suppress using the overlap of the whole tubes instead
+        # keep_idx_i = nms(torch.cat((proposals_reshaped, scores_single), 1), nms_thresh, force_cpu=not cfg.USE_GPU_NMS)
+        if cfg.RPN_NMS_MODE == 'matrix':
+            # no thresholding, rank by the decayed scores
+            keep_idx, _ = matrix_nms(proposals, scores_keep, time_dim, post_nms_topN,
+                                     mode=cfg.TUBE_NMS_OVERLAP, kernel=cfg.MATRIX_NMS_KERNEL,
+                                     sigma=cfg.MATRIX_NMS_SIGMA, batch_idx=batch_idx,
+                                     sample_sizes=[n_keep] * batch_size)
+        else:
+            keep_idx = tube_nms(proposals, scores_keep, nms_thresh, time_dim, post_nms_topN,
+                                mode=cfg.TUBE_NMS_OVERLAP, batch_idx=batch_idx)
+        keep_idx = keep_idx.long().view(-1)
 
-        if post_nms_topN > 0:
-            keep_idx_i = keep_idx_i[:post_nms_topN]
-        proposals_reshaped = proposals_reshaped[keep_idx_i, :]
-        scores_single = scores_single[keep_idx_i, :]
-        # print('scores_single.shape :',scores_single.shape)
-        # # padding 0 at the end.
-        # print(' scores_single[:,0].shape :', scores_single[:,0].shape)
-        # print('output[:,0].shape :',output[:,0].shape)
-        num_proposal = proposals_reshaped.size(0)
-        output[:num_proposal,0] = scores_single[:,0]
-        output[:num_proposal,1:] = proposals_reshaped
+        # scatter the kept tubes of every sample, in score order, padding 0 at the end.
+        # The first column is the batch index, as roi align expects
+        keep_batch = batch_idx[keep_idx]
+        keep_rank = rank_in_sample(keep_batch)
 
+        output = scores.new(batch_size, post_nms_topN, 4*time_dim + 1).zero_()
+        output[:, :, 0] = torch.arange(batch_size).type_as(output).view(-1,1)
+        output[keep_batch, keep_rank, 1:] = proposals[keep_idx]
 
         # print('output.shape :',output.shape)
         # print('output :',output)
         return output
 
+    def _select_proposals(self, scores, bbox_frame, anchors, time_dim, pre_nms_topN):
+        """Returns the top pre_nms_topN scores of every sample, sorted from
+        highest to lowest, (B, N), and their decoded (B, N, time_dim * 4) tubes.
+
+        Only the selected tubes are decoded, with a single gather of their
+        deltas, instead of transforming every anchor of every frame and
+        sorting all the scores. It doesn't depend on time_dim, so the same
+        path serves the 16, 8 and 4 frame branches (batch 9B / 13B there).
+        """
+        batch_size = bbox_frame.size(0)
+        KA = anchors.size(0)
+
+        # Transpose and reshape predicted bbox transformations to get them
+        # into the same order as the anchors: row t*K*A + k*A + a holds the
+        # deltas of frame t for anchor a at location k
+        bbox_frame = bbox_frame.permute(0,2,3,1).contiguous()
+        bbox_frame = bbox_frame.view(batch_size, time_dim * KA, 4)
+
+        # Same story for the scores:
+        scores = scores.permute(0, 2, 3, 1).contiguous()
+        scores = scores.view(batch_size, KA)
+
+        if pre_nms_topN > 0 and pre_nms_topN < KA:
+            scores_keep, order = torch.topk(scores, pre_nms_topN, 1)
+        else:
+            scores_keep, order = torch.sort(scores, 1, True)
+
+        frame_idx = order.unsqueeze(2) + \
+                    torch.arange(0, time_dim * KA, KA).type_as(order).view(1,1,-1)
+        batch_idx = torch.arange(batch_size).type_as(order).view(-1,1,1)
+
+        deltas = bbox_frame[batch_idx, frame_idx].view(batch_size, -1, time_dim * 4)
+        proposals = bbox_frames_transform_inv(anchors[order], deltas, batch_size)
+
+        return scores_keep, proposals
+
     def backward(self, top, propagate_down, bottom):
         """This layer does not propagate gradients."""
         pass
@@ -232,3 +190,4 @@ class _ProposalLayer(nn.Module):
         hs = boxes[:, :, 3] - boxes[:, :, 1] + 1
         keep = ((ws >= min_size.view(-1,1).expand_as(ws)) & (hs >= min_size.view(-1,1).expand_as(hs)))
         return keep
+
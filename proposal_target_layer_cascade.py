@@ -29,6 +29,14 @@ class _ProposalTargetLayer(nn.Module):
         self.BBOX_NORMALIZE_MEANS = torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_MEANS)
         self.BBOX_NORMALIZE_STDS = torch.FloatTensor(cfg.TRAIN.BBOX_NORMALIZE_STDS)
         self.BBOX_INSIDE_WEIGHTS = torch.FloatTensor(cfg.TRAIN.BBOX_INSIDE_WEIGHTS)
+        self._generator = None
+
+    def _get_generator(self, device):
+        # seeded with cfg.RNG_SEED, one per device
+        if self._generator is None or self._generator.device != device:
+            self._generator = torch.Generator(device=device)
+            self._generator.manual_seed(cfg.RNG_SEED)
+        return self._generator
 
     def forward(self, all_rois, gt_boxes,num_boxes):
 
@@ -78,21 +86,9 @@ class _ProposalTargetLayer(nn.Module):
             bbox_target (ndarray): b x N x 4K blob of regression targets
             bbox_inside_weights (ndarray): b x N x 4K blob of loss weights
         """
-        batch_size = labels_batch.size(0)
-        rois_per_image = labels_batch.size(1)
-        clss = labels_batch
-        bbox_targets = bbox_target_data.new(batch_size, rois_per_image, 4).zero_()
-        bbox_inside_weights = bbox_target_data.new(bbox_targets.size()).zero_()
-
-        for b in range(batch_size):
-            # assert clss[b].sum() > 0
-            if clss[b].sum() == 0:
-                continue
-            inds = torch.nonzero(clss[b] > 0).view(-1)
-            for i in range(inds.numel()):
-                ind = inds[i]
-                bbox_targets[b, ind, :] = bbox_target_data[b, ind, :]
-                bbox_inside_weights[b, ind, :] = self.BBOX_INSIDE_WEIGHTS
+        fg = (labels_batch > 0).unsqueeze(2).type_as(bbox_target_data)
+        bbox_targets = bbox_target_data[:, :, :4] * fg
+        bbox_inside_weights = self.BBOX_INSIDE_WEIGHTS.view(1, 1, 4) * fg
 
         return bbox_targets, bbox_inside_weights
 
@@ -131,86 +127,54 @@ class _ProposalTargetLayer(nn.Module):
         num_proposal = overlaps.size(1)
         num_boxes_per_img = overlaps.size(2)
 
-        offset = torch.arange(0, batch_size)*gt_boxes.size(1)
-        offset = offset.view(-1, 1).type_as(gt_assignment) + gt_assignment
-
-        labels = gt_boxes[:,:,4].contiguous().view(-1)[(offset.view(-1),)].view(batch_size, -1)
-
-        n_last_dim = all_rois.size(2)
-        # print('n_last_dim :',n_last_dim)
-        labels_batch = labels.new(batch_size, rois_per_image).zero_()
-        rois_batch  = all_rois.new(batch_size, rois_per_image, n_last_dim).zero_()
-        gt_rois_batch = all_rois.new(batch_size, rois_per_image, n_last_dim).zero_()
-        # Guard against the case when an image has fewer than max_fg_rois_per_image
-        # foreground RoIs
-
-        for i in range(batch_size):
-            # print('max_overlaps :',max_overlaps)
-            fg_inds = torch.nonzero(max_overlaps[i] >= cfg.TRAIN.FG_THRESH).view(-1)
-            fg_num_rois = fg_inds.numel()
-
-            # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
-            bg_inds = torch.nonzero((max_overlaps[i] < cfg.TRAIN.BG_THRESH_HI) &
-                                    (max_overlaps[i] >= cfg.TRAIN.BG_THRESH_LO)).view(-1)
-            bg_num_rois = bg_inds.numel()
-
-            if fg_num_rois > 0 and bg_num_rois > 0:
-                # sampling fg
-                fg_rois_per_this_image = min(fg_rois_per_image, fg_num_rois)
-
-                # torch.randperm seems has a bug on multi-gpu setting that cause the segfault.
-                # See https://github.com/pytorch/pytorch/issues/1868 for more details.
-                # use numpy instead.
-                #rand_num = torch.randperm(fg_num_rois).long().cuda()
-                rand_num = torch.from_numpy(np.random.permutation(fg_num_rois)).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num[:fg_rois_per_this_image]]
-
-                # sampling bg
-                bg_rois_per_this_image = rois_per_image - fg_rois_per_this_image
-
-                # Seems torch.rand has a bug, it will generate very large number and make an error.
-                # We use numpy rand instead.
-                #rand_num = (torch.rand(bg_rois_per_this_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(bg_rois_per_this_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                bg_inds = bg_inds[rand_num]
-
-            elif fg_num_rois > 0 and bg_num_rois == 0:
-                # sampling fg
-                #rand_num = torch.floor(torch.rand(rois_per_image) * fg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * fg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-                fg_inds = fg_inds[rand_num]
-                fg_rois_per_this_image = rois_per_image
-                bg_rois_per_this_image = 0
-            elif bg_num_rois > 0 and fg_num_rois == 0:
-                # sampling bg
-                #rand_num = torch.floor(torch.rand(rois_per_image) * bg_num_rois).long().cuda()
-                rand_num = np.floor(np.random.rand(rois_per_image) * bg_num_rois)
-                rand_num = torch.from_numpy(rand_num).type_as(gt_boxes).long()
-
-                bg_inds = bg_inds[rand_num]
-                bg_rois_per_this_image = rois_per_image
-                fg_rois_per_this_image = 0
-            else:
-                raise ValueError("bg_num_rois = 0 and fg_num_rois = 0, this should not happen!")
-
-            # The indices that we're selecting (both fg and bg)
-            keep_inds = torch.cat([fg_inds, bg_inds], 0)
-
-            # Select sampled values from various arrays:
-            labels_batch[i].copy_(labels[i][keep_inds])
-
-            # Clamp labels for the background RoIs to 0
-            if fg_rois_per_this_image < rois_per_image:
-                labels_batch[i][fg_rois_per_this_image:] = 0
-            # print('all_rois.shape :', all_rois.shape)
-            # print('kee_inds :', keep_inds)
-            # print('all_rois[i,keep_inds] :',all_rois[i,keep_inds])
-            rois_batch[i] = all_rois[i,keep_inds]
-            rois_batch[i,:,0] = i
-
-            gt_rois_batch[i] = gt_boxes[i][gt_assignment[i][keep_inds]]
+        labels = torch.gather(gt_boxes[:,:,4], 1, gt_assignment)
+
+        # All the images are sampled at once with self._generator, on the
+        # device of the rois. Per image:
+        #   fg and bg : min(fg_rois_per_image, fg) fg without replacement,
+        #               the rest bg with replacement
+        #   fg only   : rois_per_image fg with replacement
+        #   bg only   : rois_per_image bg with replacement
+        # An image with neither (no gt box and no roi in [BG_THRESH_LO,
+        # BG_THRESH_HI)) samples its bg among all its rois.
+        generator = self._get_generator(all_rois.device)
+
+        fg_mask = max_overlaps >= cfg.TRAIN.FG_THRESH
+        # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
+        bg_mask = (max_overlaps < cfg.TRAIN.BG_THRESH_HI) & (max_overlaps >= cfg.TRAIN.BG_THRESH_LO)
+        fg_num_rois = fg_mask.sum(1, keepdim=True)
+        bg_mask = bg_mask | ((fg_num_rois == 0) & (bg_mask.sum(1, keepdim=True) == 0))
+        bg_num_rois = bg_mask.sum(1, keepdim=True)
+
+        fg_rois_per_this_image = torch.where(bg_num_rois > 0, fg_num_rois.clamp(max=fg_rois_per_image),
+                                             fg_num_rois.clamp(max=1) * rois_per_image)
+
+        # fg rois without replacement: the ones of smallest random keys,
+        # with replacement: the k-th fg / bg roi is found in the cumulative
+        # count of the fg / bg rois
+        keys = torch.rand(max_overlaps.size(), device=max_overlaps.device, generator=generator)
+        n_top = min(fg_rois_per_image, num_proposal)
+        fg_top = torch.topk(keys.masked_fill_(~fg_mask, 2), n_top, 1, largest=False)[1]
+
+        slots = torch.arange(rois_per_image, device=max_overlaps.device).view(1, -1)
+        rand_num = torch.rand(batch_size, rois_per_image, device=max_overlaps.device, generator=generator)
+        fg_rand = torch.searchsorted(fg_mask.cumsum(1), (rand_num * fg_num_rois).long() + 1).clamp_(max=num_proposal - 1)
+        bg_rand = torch.searchsorted(bg_mask.cumsum(1), (rand_num * bg_num_rois).long() + 1).clamp_(max=num_proposal - 1)
+        fg_inds = torch.where(bg_num_rois > 0, fg_top[:, slots.clamp(max=n_top - 1).view(-1)], fg_rand)
+
+        # The indices that we're selecting (both fg and bg)
+        is_fg = slots < fg_rois_per_this_image
+        keep_inds = torch.where(is_fg, fg_inds, bg_rand)
+
+        # Select sampled values from various arrays:
+        # Clamp labels for the background RoIs to 0
+        labels_batch = torch.gather(labels, 1, keep_inds) * is_fg.type_as(labels)
+
+        rois_batch = torch.gather(all_rois, 1, keep_inds.unsqueeze(2).expand(-1, -1, all_rois.size(2))).clone()
+        rois_batch[:, :, 0] = torch.arange(batch_size, device=all_rois.device).view(-1, 1).type_as(all_rois)
+
+        gt_rois_batch = torch.gather(gt_boxes, 1, torch.gather(gt_assignment, 1, keep_inds).unsqueeze(2).expand(
+            -1, -1, gt_boxes.size(2)))
 
         bbox_target_data = self._compute_targets_pytorch(
                 rois_batch[:,:,1:5], gt_rois_batch[:,:,:4])
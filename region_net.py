@@ -28,25 +28,25 @@ class _RPN(nn.Module):
         # # define the convrelu layers processing input feature map
 
         ## convolutions with kernels 16,8,4
-        self.RPN_time_16 = nn.Conv3d(self.din, 512, (16,3,3), stride=1, padding=(0,1,1), bias=True).cuda()
-        self.RPN_time_8  = nn.Conv3d(self.din, 512, (8,3,3),  stride=1, padding=(0,1,1), bias=True).cuda()
-        self.RPN_time_4  = nn.Conv3d(self.din, 512, (4,3,3),  stride=1, padding=(0,1,1), bias=True).cuda()
+        self.RPN_time_16 = nn.Conv3d(self.din, 512, (16,3,3), stride=1, padding=(0,1,1), bias=True)
+        self.RPN_time_8  = nn.Conv3d(self.din, 512, (8,3,3),  stride=1, padding=(0,1,1), bias=True)
+        self.RPN_time_4  = nn.Conv3d(self.din, 512, (4,3,3),  stride=1, padding=(0,1,1), bias=True)
 
         # define bg/fg classifcation score layer for each kernel 
         self.nc_score_out = len(self.anchor_scales) * len(self.anchor_ratios) * 2 # 2(bg/fg) * 9 (anchors)
 
-        self.RPN_cls_score_16 = nn.Conv2d(512, self.nc_score_out, 1, 1, 0).cuda()
-        self.RPN_cls_score_8  = nn.Conv2d(512, self.nc_score_out, 1, 1, 0).cuda()
-        self.RPN_cls_score_4  = nn.Conv2d(512, self.nc_score_out, 1, 1, 0).cuda()
+        self.RPN_cls_score_16 = nn.Conv2d(512, self.nc_score_out, 1, 1, 0)
+        self.RPN_cls_score_8  = nn.Conv2d(512, self.nc_score_out, 1, 1, 0)
+        self.RPN_cls_score_4  = nn.Conv2d(512, self.nc_score_out, 1, 1, 0)
 
         # define anchor box offset prediction layer
         self.nc_bbox_out = len(self.anchor_scales) * len(self.anchor_ratios) * 4 # 4(coords) * 9 (anchors)
 
         # this convolutions are for each frame regression
         ## it is 4(coords for each frame) * 9 (anchors) * 1/9/13 map
-        self.RPN_bbox_frame_pred_16 = nn.Conv2d(512, self.nc_bbox_out * 16, 1, stride=1, padding=0).cuda()
-        self.RPN_bbox_frame_pred_8  = nn.Conv2d(512, self.nc_bbox_out *  8, 1, stride=1, padding=0).cuda()
-        self.RPN_bbox_frame_pred_4  = nn.Conv2d(512, self.nc_bbox_out *  4, 1, stride=1, padding=0).cuda()
+        self.RPN_bbox_frame_pred_16 = nn.Conv2d(512, self.nc_bbox_out * 16, 1, stride=1, padding=0)
+        self.RPN_bbox_frame_pred_8  = nn.Conv2d(512, self.nc_bbox_out *  8, 1, stride=1, padding=0)
+        self.RPN_bbox_frame_pred_4  = nn.Conv2d(512, self.nc_bbox_out *  4, 1, stride=1, padding=0)
 
         ## temporal regression
         # self.RPN_temporal_pred = nn.Conv3d(
@@ -70,193 +70,116 @@ class _RPN(nn.Module):
         )
         return x
 
-    def forward(self, base_feat, im_info, gt_boxes, rois, num_boxes):
-
-        batch_size = base_feat.size(0)
-
-        # print('rpn_conv1.shape :', rpn_conv1.shape)
-
-        feat_time_16 = F.relu(self.RPN_time_16(base_feat), inplace=True)
-        feat_time_8 = F.relu(self.RPN_time_8(base_feat), inplace=True)
-        feat_time_4 = F.relu(self.RPN_time_4(base_feat), inplace=True)
-
-        # get bbox regression for each frame of the tubes
-
-        # print('feat_time_16.shape :',feat_time_16.shape)
-        # print('feat_time_8.shape :',feat_time_8.shape)
-        # print('feat_time_4.shape :',feat_time_4.shape)
-
-        # ## permute features to the batch_size
-
-        feat_time_16 = feat_time_16.permute(0,2,1,3,4).contiguous().view(-1,512,7,7)
-        feat_time_8 = feat_time_8.permute(0,2,1,3,4).contiguous().view(-1,512,7,7)
-        feat_time_4 = feat_time_4.permute(0,2,1,3,4).contiguous().view(-1,512,7,7)
-
-        # print('feat_time_16.shape :',feat_time_16.shape)
-        # print('feat_time_8.shape :',feat_time_8.shape)
-        # print('feat_time_4.shape :',feat_time_4.shape)
-
-        rpn_bbox_frame_16 = self.RPN_bbox_frame_pred_16(feat_time_16)
-        rpn_bbox_frame_8 = self.RPN_bbox_frame_pred_8(feat_time_8)
-        rpn_bbox_frame_4 = self.RPN_bbox_frame_pred_4(feat_time_4)
+    def temporal_branches(self, base_feat, durations):
+        """ {duration : (rpn_cls_score, rpn_bbox_frame)} of the temporal
+        branches of the durations, a row per position of their kernel in
+        each clip, (batch_size * n_windows, C, H, W) """
+
+        outputs = {}
+        for duration in durations:
+            feat_time = F.relu(getattr(self, 'RPN_time_%d' % duration)(base_feat), inplace=True)
+            cls_score = getattr(self, 'RPN_cls_score_%d' % duration)
+            bbox_frame_pred = getattr(self, 'RPN_bbox_frame_pred_%d' % duration)
+            batch_size, n_windows, height, width = (feat_time.size(0), feat_time.size(2),
+                                                    feat_time.size(3), feat_time.size(4))
+
+            if cfg.RPN_COMBINED_HEADS:
+                # both 1x1 heads as one batched matmul on the (b, 512, n_windows * H * W)
+                # features, only the head outputs are permuted to the batch
+                weight = torch.cat((cls_score.weight, bbox_frame_pred.weight), 0).flatten(1)
+                bias = torch.cat((cls_score.bias, bbox_frame_pred.bias), 0)
+                out = torch.baddbmm(bias.view(1, -1, 1), weight.expand(batch_size, -1, -1),
+                                    feat_time.view(batch_size, feat_time.size(1), -1))
+                out = out.view(batch_size, -1, n_windows, height * width).transpose(1, 2).contiguous()
+                out = out.view(batch_size * n_windows, -1, height, width)
+                outputs[duration] = (out[:, :self.nc_score_out], out[:, self.nc_score_out:])
+            else:
+                # ## permute features to the batch_size
+                feat_time = feat_time.permute(0,2,1,3,4).contiguous().view(-1, feat_time.size(1), height, width)
+                outputs[duration] = (cls_score(feat_time), bbox_frame_pred(feat_time))
+
+        return outputs
+
+    def forward(self, base_feat, im_info, gt_boxes, rois, num_boxes, cfg_key=None, im_size=None):
+
+        # only the 16 frames branch gives proposals, the 8 and 4 frames ones
+        # are run for their losses when training
+        durations = [16]
+        if self.training:
+            durations += [d for d in cfg.TRAIN.RPN_DURATIONS if d != 16]
 
-        # print('bbox_frame_16.shape :',rpn_bbox_frame_16.shape)
-        # print('bbox_frame_8.shape  :',rpn_bbox_frame_8.shape)
-        # print('bbox_frame_4.shape  :',rpn_bbox_frame_4.shape)
+        branches = self.temporal_branches(base_feat, durations)
 
-        # get rpn classification score
-        rpn_cls_score_16 = self.RPN_cls_score_16(feat_time_16)
-        rpn_cls_score_8 = self.RPN_cls_score_16(feat_time_8)
-        # print('rpn_cls_score_8.shape :',rpn_cls_score_8.shape)
-        rpn_cls_score_4 = self.RPN_cls_score_16(feat_time_4)
+        # get bbox regression for each frame of the tubes and rpn classification score
+        rpn_cls_score_16, rpn_bbox_frame_16 = branches[16]
 
         rpn_cls_score_reshape_16 = self.reshape(rpn_cls_score_16, 2)
         rpn_cls_prob_reshape_16 = F.softmax(rpn_cls_score_reshape_16, 1)
         rpn_cls_prob_16 = self.reshape(rpn_cls_prob_reshape_16, self.nc_score_out)
 
-        rpn_cls_score_reshape_8 = self.reshape(rpn_cls_score_8, 2)
-        rpn_cls_prob_reshape_8 = F.softmax(rpn_cls_score_reshape_8, 1)
-        rpn_cls_prob_8 = self.reshape(rpn_cls_prob_reshape_8, self.nc_score_out)
-
-        rpn_cls_score_reshape_4 = self.reshape(rpn_cls_score_4, 2)
-        rpn_cls_prob_reshape_4 = F.softmax(rpn_cls_score_reshape_4, 1)
-        rpn_cls_prob_4 = self.reshape(rpn_cls_prob_reshape_4, self.nc_score_out)
-
-        # proposal layer
-        cfg_key = 'TRAIN' if self.training else 'TEST'
+        # proposal layer, cfg_key picks its pre/post nms counts and defaults
+        # to the mode of the module
+        if cfg_key is None:
+            cfg_key = 'TRAIN' if self.training else 'TEST'
 
         rois_16 = self.RPN_proposal((rpn_cls_prob_16.data, rpn_bbox_frame_16.data,
                                      im_info, cfg_key,16))
-        # rois_8 = self.RPN_proposal((rpn_cls_prob_8.data, rpn_bbox_frame_8.data,
-        #                             im_info, cfg_key,8))
-        # rois_4 = self.RPN_proposal((rpn_cls_prob_4.data, rpn_bbox_frame_4.data,
-        #                             im_info, cfg_key,4))
-        # print('rois_16.shape :',rois_16.shape)
-        # print('rois_8.shape :',rois_8.shape)
-        # print('rois_4.shape :',rois_4.shape)
-        self.rpn_loss_cls_16 = 0
-        self.rpn_loss_box_16 = 0
+
+        self.rpn_loss_cls = 0
+        self.rpn_loss_box = 0
 
         # generating training labels a# nd build the rpn loss
         if self.training:
 
             assert gt_boxes is not None
-            # print('gt_boxes.shape :',gt_boxes.shape)
-            duration = (gt_boxes[:,:,5] - gt_boxes[:,:,2] + 1).tolist()
-
-            # print('duration :',duration)
-
-
-            for tube_idx in range(1): # only for 1 video until now
-                
-                gt_tube =  gt_boxes[0,tube_idx,:].unsqueeze(0).unsqueeze(0)
-                tube_rois = rois[tube_idx,:,:].unsqueeze(1)
-                # print('tube_rois.shape :,', tube_rois.shape)
-
-                # ### for 16 frames tube
-
-                rpn_data_16 = self.RPN_anchor_target((rpn_cls_score_16.data, gt_tube, im_info, tube_rois, num_boxes, 16)) # time_limit = 16
-
-                rpn_cls_score_16 = rpn_cls_score_reshape_16.permute(0, 2, 3, 1).contiguous()
-                rpn_cls_score_16 = rpn_cls_score_16.view(batch_size, -1, 2) ## exw [1, 441, 2]
-
-                rpn_label_16 = rpn_data_16[0].view(batch_size, -1)
-                rpn_keep_16 = Variable(rpn_label_16.view(-1).ne(-1).nonzero().view(-1))
 
-                rpn_cls_score_16 = torch.index_select(rpn_cls_score_16.view(-1,2), 0, rpn_keep_16)
+            # all the gt tubes of all the clips at once, rois are their boxes
+            # at each frame, (b, K, T, 5) or (K, T, 5) for a single clip
+            if rois.dim() == 3:
+                rois = rois.unsqueeze(0)
 
-                rpn_label_16 = torch.index_select(rpn_label_16.view(-1), 0, rpn_keep_16.data)
-                rpn_label_16 = Variable(rpn_label_16.long())
+            # the targets of the 16, 8 and 4 frames anchors at every position,
+            # from the same per frame overlaps
+            durations = cfg.TRAIN.RPN_DURATIONS
 
-                # print('rpn_cls_score_16.shape :',rpn_cls_score_16.shape)
-                # print('rpn_label_16.shape :',rpn_label_16.shape)
+            # im_size, the (height, width) of im_info as ints, spares reading
+            # im_info back from the device
+            rpn_data = self.RPN_anchor_target((rpn_cls_score_16.data, gt_boxes,
+                                               im_info if im_size is None else im_size,
+                                               rois, num_boxes, durations))
 
-                self.rpn_loss_cls_16 =  F.cross_entropy(rpn_cls_score_16, rpn_label_16)
+            for duration, data in zip(durations, rpn_data):
+                rpn_loss_cls, rpn_loss_box = self._branch_loss(branches[duration][0], branches[duration][1], data)
+                self.rpn_loss_cls = self.rpn_loss_cls + rpn_loss_cls
+                self.rpn_loss_box = self.rpn_loss_box + rpn_loss_box
 
-                fg_cnt_16 = torch.sum(rpn_label_16.data.ne(0))
+        return rois_16, self.rpn_loss_cls, self.rpn_loss_box
 
-                rpn_bbox_frame_targets_16, rpn_bbox_frame_inside_weights_16, rpn_bbox_frame_outside_weights_16 = rpn_data_16[1:]
+    def _branch_loss(self, rpn_cls_score, rpn_bbox_frame, rpn_data):
+        """ classification and per frame regression losses of a temporal
+        branch, rpn_data are its anchor targets """
 
-                rpn_bbox_inside_weights_16 = Variable(rpn_bbox_frame_inside_weights_16)
-                rpn_bbox_outside_weights_16 = Variable(rpn_bbox_frame_outside_weights_16)
-                rpn_bbox_targets_16 = Variable(rpn_bbox_frame_targets_16)
+        batch_size = rpn_cls_score.size(0)
+        rpn_cls_score_reshape = self.reshape(rpn_cls_score, 2)
 
-                self.rpn_loss_box_16 =  _smooth_l1_loss(rpn_bbox_frame_16, rpn_bbox_frame_targets_16, rpn_bbox_inside_weights_16,
-                                                                   rpn_bbox_outside_weights_16, sigma=3, dim=[1,2,3])
+        rpn_cls_score = rpn_cls_score_reshape.permute(0, 2, 3, 1).contiguous()
+        rpn_cls_score = rpn_cls_score.view(batch_size, -1, 2) ## exw [1, 441, 2]
 
-                # print('self.rpn_loss_box_16 :',self.rpn_loss_box_16)
-                # print('self.rpn_loss_cls_16 :',self.rpn_loss_cls_16)
-                
-                # print('----------\nEKSWWWW 16\n----------')
-                # # #### for 8 frames tube
+        rpn_label = rpn_data[0].view(batch_size, -1)
+        rpn_keep = Variable(rpn_label.view(-1).ne(-1).nonzero().view(-1))
 
-                # rpn_data_8  = self.RPN_anchor_target((rpn_cls_score_8.data , gt_tube, im_info, tube_rois, num_boxes,  8))
+        rpn_cls_score = torch.index_select(rpn_cls_score.view(-1,2), 0, rpn_keep)
+        rpn_label = torch.index_select(rpn_label.view(-1), 0, rpn_keep.data)
+        rpn_label = Variable(rpn_label.long())
 
-                # rpn_cls_score_8 = rpn_cls_score_reshape_8.permute(0, 2, 3, 1).contiguous()
-                # rpn_cls_score_8 = rpn_cls_score_8.view(batch_size, -1, 2) ## exw [1, 441, 2]
+        rpn_loss_cls = F.cross_entropy(rpn_cls_score, rpn_label)
 
-                # rpn_label_8 = rpn_data_8[0].view(batch_size, -1)
-                # rpn_keep_8 = Variable(rpn_label_8.view(-1).ne(-1).nonzero().view(-1))
+        rpn_bbox_targets, rpn_bbox_inside_weights, rpn_bbox_outside_weights = rpn_data[1:]
 
-                # rpn_cls_score_8 = torch.index_select(rpn_cls_score_8.view(-1,2), 0, rpn_keep_8)
-                # rpn_label_8 = torch.index_select(rpn_label_8.view(-1), 0, rpn_keep_8.data)
-                # rpn_label_8 = Variable(rpn_label_8.long())
+        rpn_loss_box = _smooth_l1_loss(rpn_bbox_frame, rpn_bbox_targets, rpn_bbox_inside_weights,
+                                       rpn_bbox_outside_weights, sigma=3, dim=[1,2,3])
 
-                # self.rpn_loss_cls_8  =  F.cross_entropy(rpn_cls_score_8, rpn_label_8)
-
-                # fg_cnt_8  = torch.sum(rpn_label_8.data.ne(0))
-
-                # rpn_bbox_frame_targets_8 , rpn_bbox_frame_inside_weights_8 , rpn_bbox_frame_outside_weights_8  = rpn_data_8[1:]              
-
-                # rpn_bbox_inside_weights_8 = Variable(rpn_bbox_frame_inside_weights_8)
-                # rpn_bbox_outside_weights_8 = Variable(rpn_bbox_frame_outside_weights_8)
-                # rpn_bbox_targets_8 = Variable(rpn_bbox_frame_targets_8)
-
-                # self.rpn_loss_box_8  =  _smooth_l1_loss(rpn_bbox_frame_8, rpn_bbox_frame_targets_8, rpn_bbox_inside_weights_8,
-                #                                     rpn_bbox_outside_weights_8, sigma=3, dim=[1,2,3])
-
-                # print('self.rpn_loss_box_8 :',self.rpn_loss_box_8)
-
-                # print('----------\nEKSWWWW 8\n----------')
-                # # #### for 4 frames tube
-
-                # rpn_data_4  = self.RPN_anchor_target((rpn_cls_score_4.data , gt_tube, im_info, tube_rois, num_boxes,  4))
-
-                # rpn_cls_score_4 = rpn_cls_score_reshape_4.permute(0, 2, 3, 1).contiguous()
-                # rpn_cls_score_4 = rpn_cls_score_4.view(batch_size, -1, 2) ## exw [1, 441, 2]
-
-                # rpn_label_4 = rpn_data_4[0].view(batch_size, -1)
-                # rpn_keep_4 = Variable(rpn_label_4.view(-1).ne(-1).nonzero().view(-1))
-
-                # rpn_cls_score_4 = torch.index_select(rpn_cls_score_4.view(-1,2), 0, rpn_keep_4)
-                # rpn_label_4 = torch.index_select(rpn_label_4.view(-1), 0, rpn_keep_4.data)
-                # rpn_label_4 = Variable(rpn_label_4.long())
-
-                # self.rpn_loss_cls_4  =  F.cross_entropy(rpn_cls_score_4, rpn_label_4)
-
-                # fg_cnt_4  = torch.sum(rpn_label_4.data.ne(0))
-
-                # rpn_bbox_frame_targets_4 , rpn_bbox_frame_inside_weights_4 , rpn_bbox_frame_outside_weights_4  = rpn_data_4[1:]
-
-                # rpn_bbox_inside_weights_4 = Variable(rpn_bbox_frame_inside_weights_4)
-                # rpn_bbox_outside_weights_4 = Variable(rpn_bbox_frame_outside_weights_4)
-                # rpn_bbox_targets_4 = Variable(rpn_bbox_frame_targets_4)
-
-                # self.rpn_loss_box_4  =  _smooth_l1_loss(rpn_bbox_frame_4, rpn_bbox_frame_targets_4, rpn_bbox_inside_weights_4,
-                #                                     rpn_bbox_outside_weights_4, sigma=3, dim=[1,2,3])
-
-                # print('self.rpn_loss_box_4 :',self.rpn_loss_box_4)
-
-                # print('----------\nEKSWWWW 4\n----------')
-
-                # self.rpn_loss_cls = self.rpn_loss_cls_16 + self.rpn_loss_cls_8 + self.rpn_loss_cls_4
-                # self.rpn_loss_box = self.rpn_loss_box_16 + self.rpn_loss_box_8 + self.rpn_loss_box_4
-
-                # # compute bbox regression loss
-                # print('self.rpn_loss_cls :',self.rpn_loss_cls)
-                # print('self.rpn_loss_box :',self.rpn_loss_box)
-
-        return rois_16, self.rpn_loss_cls_16, self.rpn_loss_box_16
+        return rpn_loss_cls, rpn_loss_box
 
 
 if __name__ == '__main__':
@@ -265,10 +188,11 @@ if __name__ == '__main__':
     # a good example is v_TrampolineJumping_g17_c01
     # feats = torch.rand(1,512,16,4,4).cuda()
     # feats = torch.rand(1,512,8,4,4).cuda().float()
-    feats = torch.rand(1,256,16,7,7).cuda().float()
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    feats = torch.rand(1,256,16,7,7).to(device).float()
 
-    h = torch.Tensor([240]).cuda()
-    w = torch.Tensor([320]).cuda()
+    h = 240
+    w = 320
     gt_bboxes = torch.Tensor([[[160.7641,  70.0822, 242.5207, 175.3398,   1.]],
                              [[161.1543,  70.5410, 242.4840, 175.2963,    1.]],
                              [[161.1610,  70.5489, 242.4820, 175.2937,    1.]],
@@ -284,7 +208,7 @@ if __name__ == '__main__':
                              [[161.0921,  70.4580, 243.3863, 176.4650,    1.]],
                              [[161.5888,  73.5920, 242.9024, 176.6015,    1.]],
                              [[161.5971,  73.5839, 242.9018, 177.6026,    1.]],
-                             [[161.6053,  73.5757, 242.9014, 177.6040,    1.]]]).cuda().float()
+                             [[161.6053,  73.5757, 242.9014, 177.6040,    1.]]]).to(device).float()
 
     # gt_bboxes = torch.Tensor([[[160.7641,  70.0822, 242.5207, 175.3398,   1.]],
     #                          [[161.1543,  70.5410, 242.4840, 175.2963,    1.]],
@@ -296,8 +220,17 @@ if __name__ == '__main__':
     #                          [[161.6053,  73.5757, 242.9014, 177.6040,    1.]]]).cuda().float()
 
 
-    print(gt_bboxes.shape)
-    print('h {}, w {}, gt_bboxes.shape {}'.format(h,w,gt_bboxes.shape))
-    model = _RPN(256)
-    out = model(feats,torch.Tensor([[h,w]]*gt_bboxes.size(1)).cuda(), gt_bboxes, len(gt_bboxes))
+    # 2 actors: the boxes above and the same person 100 pixels to the left
+    gt_rois = gt_bboxes.permute(1,0,2)
+    gt_rois = torch.cat((gt_rois, gt_rois - gt_rois.new_tensor([100, 0, 100, 0, 0])), 0)
+    gt_tubes = torch.cat((gt_rois[:,:,:2].min(1)[0], gt_rois.new_zeros(2,1),
+                          gt_rois[:,:,2:4].max(1)[0], gt_rois.new_full((2,1), 15),
+                          gt_rois[:,0,4:]), 1).unsqueeze(0)
+
+    print('h {}, w {}, gt_tubes.shape {}, gt_rois.shape {}'.format(h,w,gt_tubes.shape, gt_rois.shape))
+    model = _RPN(256).to(device)
+    rois, rpn_loss_cls, rpn_loss_box = model(feats,torch.Tensor([[h,w]]).to(device), gt_tubes, gt_rois,
+                                             torch.Tensor([gt_tubes.size(1)]).to(device))
+    print('rois.shape {}, rpn_loss_cls {:.4f}, rpn_loss_box {:.4f}'.format(rois.shape, rpn_loss_cls.item(),
+                                                                          rpn_loss_box.item()))
 
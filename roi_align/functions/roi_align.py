@@ -1,55 +1,121 @@
+import os
+
 import torch
+import torch.nn.functional as F
 from torch.autograd import Function
-from .._ext import roi_align
+
+# The _ext ffi build needs torch.utils.ffi, which is gone from pytorch. The cpu
+# kernels are a torch extension now (src/roi_align_cpu.cpp), built on first use
+# with torch.utils.cpp_extension and cached in ~/.cache/torch_extensions.
+_src_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+_roi_align_cpu = None
+
+
+def _load_cpu_ext():
+    global _roi_align_cpu
+    if _roi_align_cpu is None:
+        from torch.utils.cpp_extension import load
+        _roi_align_cpu = load(name='roi_align_cpu',
+                              sources=[os.path.join(_src_dir, 'roi_align_cpu.cpp')],
+                              extra_cflags=['-O3', '-fopenmp'],
+                              extra_ldflags=['-fopenmp'])
+    return _roi_align_cpu
 
 
-# TODO use save_for_backward instead
 class RoIAlignFunction(Function):
-    def __init__(self, aligned_height, aligned_width, spatial_scale, time_dim):
-        self.aligned_width = int(aligned_width)
-        self.aligned_height = int(aligned_height)
-        self.spatial_scale = float(spatial_scale)
-        self.time_dim = float(time_dim)
-        self.rois = None
-        self.feature_size = None
-
-    def forward(self, features, rois):
-        self.rois = rois
-        # print('self.rois.shape :',self.rois.shape)
-        self.feature_size = features.size()
-        # print('features_size :',features.size())
-        batch_size, num_channels, data_time, data_height, data_width = features.size()
-        num_rois = rois.size(0)
-        # print('num_rois {}, num_channels {}, data_time {}, self.aligned_height {}, self.aligned_width {}'.format(
-        #     num_rois, num_channels, data_time, self.aligned_height, self.aligned_width))
-        output = features.new(num_rois, num_channels, data_time, self.aligned_height, self.aligned_width).zero_()
-        # print('output.shape :', output.shape)
-        if features.is_cuda:
-            roi_align.roi_align_forward_cuda(self.aligned_height,
-                                             self.aligned_width,
-                                             self.spatial_scale, features,
-                                             rois, output)
-        else:
-            roi_align.roi_align_forward(self.aligned_height,
-                                        self.aligned_width,
-                                        self.spatial_scale, features,
-                                        rois, output)
-#            raise NotImplementedError
+    """features : (B, C, T, H, W), rois : (N, 1 + 4 * T), a box per frame
+    -> (N, C, T, aligned_height, aligned_width)"""
+
+    @staticmethod
+    def forward(ctx, features, rois, aligned_height, aligned_width, spatial_scale):
+        ctx.save_for_backward(rois)
+        ctx.feature_size = features.size()
+        ctx.aligned_height = int(aligned_height)
+        ctx.aligned_width = int(aligned_width)
+        ctx.spatial_scale = float(spatial_scale)
+
+        return _load_cpu_ext().forward(features, rois, ctx.aligned_height,
+                                       ctx.aligned_width, ctx.spatial_scale)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        rois, = ctx.saved_tensors
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            grad_input = _load_cpu_ext().backward(grad_output, rois, *ctx.feature_size,
+                                                  ctx.aligned_height, ctx.aligned_width,
+                                                  ctx.spatial_scale)
+        return grad_input, None, None, None, None
 
+
+class RoIAlignPooledFunction(Function):
+    """RoIAlign on a (pooled + 1) x (pooled + 1) grid fused with the pooling of
+    RoIAlignAvg (2 x 2 x 2 mean, -> (N, C, T - 1, pooled, pooled)) or
+    RoIAlignMax (2 x 2 max per frame, -> (N, C, T, pooled, pooled))"""
+
+    @staticmethod
+    def forward(ctx, features, rois, pooled_height, pooled_width, spatial_scale, max_pool):
+        ctx.feature_size = features.size()
+        ctx.params = (int(pooled_height), int(pooled_width), float(spatial_scale), bool(max_pool))
+
+        output, argmax = _load_cpu_ext().pooled_forward(features, rois, *ctx.params)
+        ctx.save_for_backward(rois, argmax)
         return output
 
-    def backward(self, grad_output):
-        assert(self.feature_size is not None and grad_output.is_cuda)
+    @staticmethod
+    def backward(ctx, grad_output):
+        rois, argmax = ctx.saved_tensors
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            grad_input = _load_cpu_ext().pooled_backward(grad_output, rois, argmax,
+                                                         *(tuple(ctx.feature_size) + ctx.params))
+        return grad_input, None, None, None, None, None
+
 
-        batch_size, num_channels, data_height, data_width = self.feature_size
+def _roi_align_pytorch(features, rois, aligned_height, aligned_width, spatial_scale):
+    # same sampling with plain tensor ops, for the gpu
+    from roi_align_3d.functions.roi_align_pytorch import _interpolation_weights
 
-        grad_input = self.rois.new(batch_size, num_channels, data_height,
-                                  data_width).zero_()
-        roi_align.roi_align_backward_cuda(self.aligned_height,
-                                          self.aligned_width,
-                                          self.spatial_scale, grad_output,
-                                          self.rois, grad_input)
+    batch_size, channels, time, height, width = features.size()
+    num_rois = rois.size(0)
+    rois = rois.type_as(features)
+    boxes = rois[:, 1:].contiguous().view(-1, 4) * spatial_scale
+    weights_h = _interpolation_weights(boxes[:, 1], boxes[:, 3], aligned_height, height)
+    weights_w = _interpolation_weights(boxes[:, 0], boxes[:, 2], aligned_width, width)
 
-        # print grad_input
+    frames = features.transpose(1, 2)[rois[:, 0].long()].reshape(-1, channels, height, width)
+    x = torch.matmul(torch.matmul(weights_h.unsqueeze(1), frames), weights_w.transpose(1, 2).unsqueeze(1))
+    return x.view(num_rois, time, channels, aligned_height, aligned_width).transpose(1, 2).contiguous()
 
-        return grad_input, None
+
+def roi_align(features, rois, aligned_height, aligned_width, spatial_scale):
+    """RoIAlign of a box per frame, or of (N, 5) rois on (B, C, H, W) features."""
+    planar = features.dim() == 4
+    if planar:
+        features = features.unsqueeze(2)
+    if features.is_cuda:
+        output = _roi_align_pytorch(features, rois, aligned_height, aligned_width, spatial_scale)
+    else:
+        output = RoIAlignFunction.apply(features, rois, aligned_height, aligned_width, spatial_scale)
+    return output.squeeze(2) if planar else output
+
+
+def roi_align_pooled(features, rois, pooled_height, pooled_width, spatial_scale, max_pool=False):
+    """Same as pooling roi_align(..., pooled_height + 1, pooled_width + 1, ...)
+    with avg_pool3d / max_pool2d(kernel_size=2, stride=1), without the
+    oversampled intermediate on the cpu."""
+    planar = features.dim() == 4
+    if planar:
+        features = features.unsqueeze(2)
+    if features.is_cuda:
+        x = _roi_align_pytorch(features, rois, pooled_height + 1, pooled_width + 1, spatial_scale)
+        if max_pool:
+            n_rois, channels, time = x.size()[:3]
+            output = F.max_pool2d(x.view(-1, pooled_height + 1, pooled_width + 1), kernel_size=2, stride=1)
+            output = output.view(n_rois, channels, time, pooled_height, pooled_width)
+        else:
+            output = F.avg_pool3d(x, kernel_size=2, stride=1)
+    else:
+        output = RoIAlignPooledFunction.apply(features, rois, pooled_height, pooled_width,
+                                              spatial_scale, max_pool)
+    return output.squeeze(2) if planar else output
@@ -1,6 +1,6 @@
 from torch.nn.modules.module import Module
 from torch.nn.functional import avg_pool2d, max_pool2d, avg_pool3d
-from ..functions.roi_align import RoIAlignFunction
+from ..functions.roi_align import roi_align, roi_align_pooled
 
 
 class RoIAlign(Module):
@@ -12,31 +12,41 @@ class RoIAlign(Module):
         self.spatial_scale = float(spatial_scale)
 
     def forward(self, features, rois):
-        return RoIAlignFunction(self.aligned_height, self.aligned_width,
-                                self.spatial_scale)(features, rois)
+        return roi_align(features, rois, self.aligned_height, self.aligned_width,
+                         self.spatial_scale)
 
+# fused : sample and pool in one pass (roi_align_pooled), same output without
+#         the (aligned + 1) x (aligned + 1) intermediate
 class RoIAlignAvg(Module):
-    def __init__(self, aligned_height, aligned_width, spatial_scale, time_dim):
+    def __init__(self, aligned_height, aligned_width, spatial_scale, time_dim, fused=True):
         super(RoIAlignAvg, self).__init__()
 
         self.aligned_width = int(aligned_width)
         self.aligned_height = int(aligned_height)
         self.spatial_scale = float(spatial_scale)
         self.time_dim = float(time_dim)
+        self.fused = fused
     def forward(self, features, rois):
-        x =  RoIAlignFunction(self.aligned_height+1, self.aligned_width+1,
-                                self.spatial_scale,self.time_dim)(features, rois )
+        if self.fused and features.dim() == 5:
+            return roi_align_pooled(features, rois, self.aligned_height, self.aligned_width,
+                                    self.spatial_scale)
+        x = roi_align(features, rois, self.aligned_height+1, self.aligned_width+1,
+                      self.spatial_scale)
         return avg_pool3d(x, kernel_size=2, stride=1)
 
 class RoIAlignMax(Module):
-    def __init__(self, aligned_height, aligned_width, spatial_scale):
+    def __init__(self, aligned_height, aligned_width, spatial_scale, fused=True):
         super(RoIAlignMax, self).__init__()
 
         self.aligned_width = int(aligned_width)
         self.aligned_height = int(aligned_height)
         self.spatial_scale = float(spatial_scale)
+        self.fused = fused
 
     def forward(self, features, rois):
-        x =  RoIAlignFunction(self.aligned_height+1, self.aligned_width+1,
-                                self.spatial_scale)(features, rois)
+        if self.fused:
+            return roi_align_pooled(features, rois, self.aligned_height, self.aligned_width,
+                                    self.spatial_scale, max_pool=True)
+        x = roi_align(features, rois, self.aligned_height+1, self.aligned_width+1,
+                      self.spatial_scale)
         return max_pool2d(x, kernel_size=2, stride=1)
@@ -0,0 +1,391 @@
+// RoIAlign on cpu as a torch extension, JIT built by functions/roi_align.py
+//
+// Same sampling as ROIAlignForwardCpu in roi_align.c, done frame by frame for
+// the action tubes:
+//   features : (B, C, T, H, W)
+//   rois     : (N, 1 + 4 * T) batch_ind, then x1, y1, x2, y2 of every frame
+//   output   : (N, C, T, aligned_height, aligned_width)
+// the plain 2d case is T = 1 (features (B, C, H, W), rois (N, 5)).
+//
+// The sample positions and weights of every roi are computed once, then the
+// forward runs in parallel over rois x channels and the backward over channels
+// (rois of the same channel can add to the same feature cell, channels can't).
+//
+// pooled_forward / pooled_backward fuse the oversampled RoIAlign with the
+// pooling of RoIAlignAvg / RoIAlignMax.
+
+#include <torch/extension.h>
+#include <omp.h>
+
+#include <algorithm>
+#include <cmath>
+#include <vector>
+
+template <typename scalar_t>
+struct Samples {
+    // per (roi, frame, ph, pw): offset of the up left neighbour in the
+    // (b, 0, t) plane of the features and the 4 bilinear weights
+    std::vector<int64_t> offset;
+    std::vector<scalar_t> weight;
+};
+
+template <typename scalar_t>
+Samples<scalar_t> roi_samples(const scalar_t* rois, int64_t num_rois, int64_t time,
+                              int64_t channels, int64_t height, int64_t width,
+                              int64_t aligned_height, int64_t aligned_width,
+                              scalar_t spatial_scale)
+{
+    const int64_t roi_cols = 1 + 4 * time;
+    const int64_t n_samples = time * aligned_height * aligned_width;
+
+    Samples<scalar_t> s;
+    s.offset.assign(num_rois * n_samples, 0);
+    s.weight.assign(num_rois * n_samples * 4, 0);
+
+    #pragma omp parallel for
+    for (int64_t n = 0; n < num_rois; ++n)
+    {
+        const scalar_t* roi = rois + n * roi_cols;
+        const int64_t roi_batch_ind = (int64_t)roi[0];
+
+        for (int64_t t = 0; t < time; ++t)
+        {
+            const scalar_t* box = roi + 1 + 4 * t;
+            scalar_t roi_start_w = box[0] * spatial_scale;
+            scalar_t roi_start_h = box[1] * spatial_scale;
+            scalar_t roi_end_w = box[2] * spatial_scale;
+            scalar_t roi_end_h = box[3] * spatial_scale;
+
+            // Force malformed ROI to be 1x1
+            scalar_t roi_width = std::max<scalar_t>(roi_end_w - roi_start_w + 1, 0);
+            scalar_t roi_height = std::max<scalar_t>(roi_end_h - roi_start_h + 1, 0);
+            scalar_t bin_size_h = roi_height / (aligned_height - 1);
+            scalar_t bin_size_w = roi_width / (aligned_width - 1);
+
+            const int64_t plane = (roi_batch_ind * channels * time + t) * height * width;
+
+            for (int64_t ph = 0; ph < aligned_height; ++ph)
+            {
+                for (int64_t pw = 0; pw < aligned_width; ++pw)
+                {
+                    const int64_t idx = n * n_samples + (t * aligned_height + ph) * aligned_width + pw;
+
+                    scalar_t h = ph * bin_size_h + roi_start_h;
+                    scalar_t w = pw * bin_size_w + roi_start_w;
+
+                    // 0 outside the feature map
+                    if (h < 0 || h >= height || w < 0 || w >= width)
+                        continue;
+
+                    int64_t hstart = std::min<int64_t>((int64_t)std::floor(h), height - 2);
+                    int64_t wstart = std::min<int64_t>((int64_t)std::floor(w), width - 2);
+                    scalar_t h_ratio = h - hstart;
+                    scalar_t w_ratio = w - wstart;
+
+                    s.offset[idx] = plane + hstart * width + wstart;
+                    scalar_t* weight = s.weight.data() + idx * 4;
+                    weight[0] = (1 - h_ratio) * (1 - w_ratio);
+                    weight[1] = (1 - h_ratio) * w_ratio;
+                    weight[2] = h_ratio * (1 - w_ratio);
+                    weight[3] = h_ratio * w_ratio;
+                }
+            }
+        }
+    }
+    return s;
+}
+
+template <typename scalar_t>
+inline void sample_channel(const Samples<scalar_t>& s, const scalar_t* channel_data, int64_t n,
+                           int64_t n_samples, int64_t width, scalar_t* top)
+{
+    const int64_t* offset = s.offset.data() + n * n_samples;
+    const scalar_t* weight = s.weight.data() + n * n_samples * 4;
+
+    for (int64_t i = 0; i < n_samples; ++i, weight += 4)
+    {
+        const scalar_t* data = channel_data + offset[i];
+        top[i] = data[0] * weight[0] + data[1] * weight[1]
+            + data[width] * weight[2] + data[width + 1] * weight[3];
+    }
+}
+
+template <typename scalar_t>
+inline void scatter_channel(const Samples<scalar_t>& s, const scalar_t* top, int64_t n,
+                            int64_t n_samples, int64_t width, scalar_t* channel_diff)
+{
+    const int64_t* offset = s.offset.data() + n * n_samples;
+    const scalar_t* weight = s.weight.data() + n * n_samples * 4;
+
+    for (int64_t i = 0; i < n_samples; ++i, weight += 4)
+    {
+        scalar_t* diff = channel_diff + offset[i];
+        diff[0] += top[i] * weight[0];
+        diff[1] += top[i] * weight[1];
+        diff[width] += top[i] * weight[2];
+        diff[width + 1] += top[i] * weight[3];
+    }
+}
+
+// the omp pragmas can't be inside the AT_DISPATCH macro, hence the kernels
+template <typename scalar_t>
+void forward_kernel(const Samples<scalar_t>& s, const scalar_t* bottom_data, scalar_t* top_data,
+                    int64_t num_rois, int64_t channels, int64_t n_samples,
+                    int64_t channel_size, int64_t width)
+{
+    #pragma omp parallel for
+    for (int64_t nc = 0; nc < num_rois * channels; ++nc)
+    {
+        const int64_t n = nc / channels, c = nc % channels;
+        sample_channel(s, bottom_data + c * channel_size, n, n_samples, width, top_data + nc * n_samples);
+    }
+}
+
+template <typename scalar_t>
+void backward_kernel(const Samples<scalar_t>& s, const scalar_t* top_diff, scalar_t* bottom_diff,
+                     int64_t num_rois, int64_t channels, int64_t n_samples,
+                     int64_t channel_size, int64_t width)
+{
+    #pragma omp parallel for
+    for (int64_t c = 0; c < channels; ++c)
+    {
+        for (int64_t n = 0; n < num_rois; ++n)
+            scatter_channel(s, top_diff + (n * channels + c) * n_samples, n, n_samples, width,
+                            bottom_diff + c * channel_size);
+    }
+}
+
+// Fused RoIAlignAvg / RoIAlignMax: the (pooled + 1) x (pooled + 1) samples of a
+// (roi, channel) go to a small per thread buffer and are pooled from there,
+// the oversampled output is never written out.
+//   avg : mean of 2 x 2 samples x 2 frames, like avg_pool3d(kernel_size=2, stride=1),
+//         (N, C, T - 1, pooled_height, pooled_width)
+//   max : max of 2 x 2 samples per frame, like max_pool2d(kernel_size=2, stride=1),
+//         (N, C, T, pooled_height, pooled_width), argmax is the winning sample
+template <typename scalar_t>
+void pooled_forward_kernel(const Samples<scalar_t>& s, const scalar_t* bottom_data, scalar_t* top_data,
+                           int64_t* argmax_data, int64_t num_rois, int64_t channels, int64_t time,
+                           int64_t pooled_height, int64_t pooled_width,
+                           int64_t channel_size, int64_t width, bool max_pool)
+{
+    const int64_t sample_height = pooled_height + 1, sample_width = pooled_width + 1;
+    const int64_t frame_samples = sample_height * sample_width;
+    const int64_t n_samples = time * frame_samples;
+    const int64_t pooled_time = max_pool ? time : time - 1;
+    const int64_t n_pooled = pooled_time * pooled_height * pooled_width;
+    const int64_t window[4] = {0, 1, sample_width, sample_width + 1};
+
+    #pragma omp parallel
+    {
+        std::vector<scalar_t> buffer(n_samples);
+
+        #pragma omp for
+        for (int64_t nc = 0; nc < num_rois * channels; ++nc)
+        {
+            const int64_t n = nc / channels, c = nc % channels;
+            sample_channel(s, bottom_data + c * channel_size, n, n_samples, width, buffer.data());
+
+            scalar_t* top = top_data + nc * n_pooled;
+            int64_t* argmax = max_pool ? argmax_data + nc * n_pooled : nullptr;
+            for (int64_t t = 0, i = 0; t < pooled_time; ++t)
+            {
+                for (int64_t ph = 0; ph < pooled_height; ++ph)
+                {
+                    for (int64_t pw = 0; pw < pooled_width; ++pw, ++i)
+                    {
+                        const int64_t first = t * frame_samples + ph * sample_width + pw;
+                        const scalar_t* b = buffer.data() + first;
+                        if (max_pool)
+                        {
+                            int k_max = 0;
+                            for (int k = 1; k < 4; ++k)
+                                if (b[window[k]] > b[window[k_max]])
+                                    k_max = k;
+                            top[i] = b[window[k_max]];
+                            argmax[i] = first + window[k_max];
+                        }
+                        else
+                        {
+                            scalar_t sum = 0;
+                            for (int k = 0; k < 4; ++k)
+                                sum += b[window[k]] + b[frame_samples + window[k]];
+                            top[i] = sum / 8;
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+template <typename scalar_t>
+void pooled_backward_kernel(const Samples<scalar_t>& s, const scalar_t* top_diff, scalar_t* bottom_diff,
+                            const int64_t* argmax_data, int64_t num_rois, int64_t channels, int64_t time,
+                            int64_t pooled_height, int64_t pooled_width,
+                            int64_t channel_size, int64_t width, bool max_pool)
+{
+    const int64_t sample_height = pooled_height + 1, sample_width = pooled_width + 1;
+    const int64_t frame_samples = sample_height * sample_width;
+    const int64_t n_samples = time * frame_samples;
+    const int64_t pooled_time = max_pool ? time : time - 1;
+    const int64_t n_pooled = pooled_time * pooled_height * pooled_width;
+    const int64_t window[4] = {0, 1, sample_width, sample_width + 1};
+
+    #pragma omp parallel
+    {
+        std::vector<scalar_t> buffer(n_samples);
+
+        #pragma omp for
+        for (int64_t c = 0; c < channels; ++c)
+        {
+            for (int64_t n = 0; n < num_rois; ++n)
+            {
+                const int64_t nc = n * channels + c;
+                const scalar_t* top = top_diff + nc * n_pooled;
+                std::fill(buffer.begin(), buffer.end(), (scalar_t)0);
+
+                if (max_pool)
+                {
+                    const int64_t* argmax = argmax_data + nc * n_pooled;
+                    for (int64_t i = 0; i < n_pooled; ++i)
+                        buffer[argmax[i]] += top[i];
+                }
+                else
+                {
+                    for (int64_t t = 0, i = 0; t < pooled_time; ++t)
+                        for (int64_t ph = 0; ph < pooled_height; ++ph)
+                            for (int64_t pw = 0; pw < pooled_width; ++pw, ++i)
+                            {
+                                scalar_t* b = buffer.data() + t * frame_samples + ph * sample_width + pw;
+                                const scalar_t g = top[i] / 8;
+                                for (int k = 0; k < 4; ++k)
+                                {
+                                    b[window[k]] += g;
+                                    b[frame_samples + window[k]] += g;
+                                }
+                            }
+                }
+                scatter_channel(s, buffer.data(), n, n_samples, width, bottom_diff + c * channel_size);
+            }
+        }
+    }
+}
+
+static void check_inputs(const torch::Tensor& features, const torch::Tensor& rois)
+{
+    TORCH_CHECK(!features.is_cuda() && !rois.is_cuda(), "roi_align_cpu: cpu tensors only");
+    TORCH_CHECK(features.dim() == 5, "roi_align_cpu: features must be (B, C, T, H, W)");
+    TORCH_CHECK(rois.dim() == 2 && rois.size(1) == 1 + 4 * features.size(2),
+                "roi_align_cpu: rois must be (N, 1 + 4 * T)");
+    TORCH_CHECK(features.size(3) >= 2 && features.size(4) >= 2,
+                "roi_align_cpu: feature map smaller than 2x2");
+}
+
+torch::Tensor roi_align_forward(torch::Tensor features, torch::Tensor rois,
+                                int64_t aligned_height, int64_t aligned_width, double spatial_scale)
+{
+    check_inputs(features, rois);
+    features = features.contiguous();
+    rois = rois.to(features.scalar_type()).contiguous();
+
+    const int64_t num_rois = rois.size(0);
+    const int64_t channels = features.size(1), time = features.size(2);
+    const int64_t height = features.size(3), width = features.size(4);
+
+    auto output = features.new_zeros({num_rois, channels, time, aligned_height, aligned_width});
+
+    AT_DISPATCH_FLOATING_TYPES(features.scalar_type(), "roi_align_forward", [&] {
+        auto s = roi_samples<scalar_t>(rois.data_ptr<scalar_t>(), num_rois, time, channels,
+                                       height, width, aligned_height, aligned_width,
+                                       (scalar_t)spatial_scale);
+        forward_kernel<scalar_t>(s, features.data_ptr<scalar_t>(), output.data_ptr<scalar_t>(),
+                                 num_rois, channels, time * aligned_height * aligned_width,
+                                 time * height * width, width);
+    });
+    return output;
+}
+
+torch::Tensor roi_align_backward(torch::Tensor top_grad, torch::Tensor rois,
+                                 int64_t batch_size, int64_t channels, int64_t time,
+                                 int64_t height, int64_t width,
+                                 int64_t aligned_height, int64_t aligned_width, double spatial_scale)
+{
+    top_grad = top_grad.contiguous();
+    rois = rois.to(top_grad.scalar_type()).contiguous();
+
+    const int64_t num_rois = rois.size(0);
+    auto bottom_grad = top_grad.new_zeros({batch_size, channels, time, height, width});
+    check_inputs(bottom_grad, rois);
+
+    AT_DISPATCH_FLOATING_TYPES(top_grad.scalar_type(), "roi_align_backward", [&] {
+        auto s = roi_samples<scalar_t>(rois.data_ptr<scalar_t>(), num_rois, time, channels,
+                                       height, width, aligned_height, aligned_width,
+                                       (scalar_t)spatial_scale);
+        backward_kernel<scalar_t>(s, top_grad.data_ptr<scalar_t>(), bottom_grad.data_ptr<scalar_t>(),
+                                  num_rois, channels, time * aligned_height * aligned_width,
+                                  time * height * width, width);
+    });
+    return bottom_grad;
+}
+
+std::vector<torch::Tensor> roi_align_pooled_forward(torch::Tensor features, torch::Tensor rois,
+                                                     int64_t pooled_height, int64_t pooled_width,
+                                                     double spatial_scale, bool max_pool)
+{
+    check_inputs(features, rois);
+    TORCH_CHECK(max_pool || features.size(2) >= 2, "roi_align_cpu: the avg pooling needs 2 frames or more");
+    features = features.contiguous();
+    rois = rois.to(features.scalar_type()).contiguous();
+
+    const int64_t num_rois = rois.size(0);
+    const int64_t channels = features.size(1), time = features.size(2);
+    const int64_t height = features.size(3), width = features.size(4);
+    const int64_t pooled_time = max_pool ? time : time - 1;
+
+    auto output = features.new_empty({num_rois, channels, pooled_time, pooled_height, pooled_width});
+    auto argmax = max_pool ? torch::empty(output.sizes(), features.options().dtype(torch::kLong))
+                           : torch::empty({0}, features.options().dtype(torch::kLong));
+
+    AT_DISPATCH_FLOATING_TYPES(features.scalar_type(), "roi_align_pooled_forward", [&] {
+        auto s = roi_samples<scalar_t>(rois.data_ptr<scalar_t>(), num_rois, time, channels,
+                                       height, width, pooled_height + 1, pooled_width + 1,
+                                       (scalar_t)spatial_scale);
+        pooled_forward_kernel<scalar_t>(s, features.data_ptr<scalar_t>(), output.data_ptr<scalar_t>(),
+                                        argmax.data_ptr<int64_t>(), num_rois, channels, time,
+                                        pooled_height, pooled_width, time * height * width, width,
+                                        max_pool);
+    });
+    return {output, argmax};
+}
+
+torch::Tensor roi_align_pooled_backward(torch::Tensor top_grad, torch::Tensor rois, torch::Tensor argmax,
+                                        int64_t batch_size, int64_t channels, int64_t time,
+                                        int64_t height, int64_t width,
+                                        int64_t pooled_height, int64_t pooled_width,
+                                        double spatial_scale, bool max_pool)
+{
+    top_grad = top_grad.contiguous();
+    rois = rois.to(top_grad.scalar_type()).contiguous();
+
+    const int64_t num_rois = rois.size(0);
+    auto bottom_grad = top_grad.new_zeros({batch_size, channels, time, height, width});
+    check_inputs(bottom_grad, rois);
+
+    AT_DISPATCH_FLOATING_TYPES(top_grad.scalar_type(), "roi_align_pooled_backward", [&] {
+        auto s = roi_samples<scalar_t>(rois.data_ptr<scalar_t>(), num_rois, time, channels,
+                                       height, width, pooled_height + 1, pooled_width + 1,
+                                       (scalar_t)spatial_scale);
+        pooled_backward_kernel<scalar_t>(s, top_grad.data_ptr<scalar_t>(), bottom_grad.data_ptr<scalar_t>(),
+                                         argmax.data_ptr<int64_t>(), num_rois, channels, time,
+                                         pooled_height, pooled_width, time * height * width, width,
+                                         max_pool);
+    });
+    return bottom_grad;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("forward", &roi_align_forward, "RoIAlign forward (cpu)");
+    m.def("backward", &roi_align_backward, "RoIAlign backward (cpu)");
+    m.def("pooled_forward", &roi_align_pooled_forward, "fused RoIAlign + avg / max pooling forward (cpu)");
+    m.def("pooled_backward", &roi_align_pooled_backward, "fused RoIAlign + avg / max pooling backward (cpu)");
+}
@@ -1,55 +1,55 @@
+import os
+
 import torch
 from torch.autograd import Function
-from .._ext import roi_align
+
+from .roi_align_pytorch import roi_align_3d
+
+# The _ext ffi build needs torch.utils.ffi, which is gone from pytorch. The cpu
+# kernels are a torch extension now (src/roi_align_cpu.cpp), built on first use
+# with torch.utils.cpp_extension and cached in ~/.cache/torch_extensions.
+_src_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+_roi_align_cpu = None
+
+
+def _load_cpu_ext():
+    global _roi_align_cpu
+    if _roi_align_cpu is None:
+        from torch.utils.cpp_extension import load
+        _roi_align_cpu = load(name='roi_align_3d_cpu',
+                              sources=[os.path.join(_src_dir, 'roi_align_cpu.cpp')],
+                              extra_cflags=['-O3', '-fopenmp'],
+                              extra_ldflags=['-fopenmp'])
+    return _roi_align_cpu
 
 
-# TODO use save_for_backward instead
 class RoIAlignFunction(Function):
-    def __init__(self, aligned_height, aligned_width, spatial_scale, time_dim):
-        self.aligned_width = int(aligned_width)
-        self.aligned_height = int(aligned_height)
-        self.spatial_scale = float(spatial_scale)
-        self.time_dim = float(time_dim)
-        self.rois = None
-        self.feature_size = None
-
-    def forward(self, features, rois):
-        self.rois = rois
-        # print('self.rois.shape :',self.rois.shape)
-        self.feature_size = features.size()
-        # print('features_size :',features.size())
-        batch_size, num_channels, data_time, data_height, data_width = features.size()
-        num_rois = rois.size(0)
-        # print('num_rois {}, num_channels {}, data_time {}, self.aligned_height {}, self.aligned_width {}'.format(
-        #     num_rois, num_channels, data_time, self.aligned_height, self.aligned_width))
-        output = features.new(num_rois, num_channels, data_time, self.aligned_height, self.aligned_width).zero_()
-        # print('output.shape :', output.shape)
-        if features.is_cuda:
-            roi_align.roi_align_forward_cuda(self.aligned_height,
-                                             self.aligned_width,
-                                             self.spatial_scale, features,
-                                             rois, output)
-        else:
-            roi_align.roi_align_forward(self.aligned_height,
-                                        self.aligned_width,
-                                        self.spatial_scale, features,
-                                        rois, output)
-#            raise NotImplementedError
-
-        return output
-
-    def backward(self, grad_output):
-        assert(self.feature_size is not None and grad_output.is_cuda)
-
-        batch_size, num_channels, data_height, data_width = self.feature_size
-
-        grad_input = self.rois.new(batch_size, num_channels, data_height,
-                                  data_width).zero_()
-        roi_align.roi_align_backward_cuda(self.aligned_height,
-                                          self.aligned_width,
-                                          self.spatial_scale, grad_output,
-                                          self.rois, grad_input)
-
-        # print grad_input
-
-        return grad_input, None
+    """features : (B, C, T, H, W), rois : (N, 7) batch_ind, x1, y1, t1, x2, y2, t2
+    -> (N, C, time_dim, aligned_height, aligned_width)"""
+
+    @staticmethod
+    def forward(ctx, features, rois, aligned_height, aligned_width, time_dim,
+                spatial_scale, temp_scale=1.0):
+        ctx.save_for_backward(rois)
+        ctx.feature_size = features.size()
+        ctx.params = (int(aligned_height), int(aligned_width), int(time_dim),
+                      float(spatial_scale), float(temp_scale))
+
+        return _load_cpu_ext().forward(features, rois, *ctx.params)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        rois, = ctx.saved_tensors
+        grad_input = None
+        if ctx.needs_input_grad[0]:
+            grad_input = _load_cpu_ext().backward(grad_output, rois, *(tuple(ctx.feature_size) + ctx.params))
+        return grad_input, None, None, None, None, None, None
+
+
+def roi_align(features, rois, aligned_height, aligned_width, time_dim, spatial_scale, temp_scale=1.0):
+    """The cpu extension for cpu tensors, roi_align_pytorch otherwise."""
+    if features.is_cuda:
+        return roi_align_3d(features, rois, aligned_height, aligned_width, time_dim,
+                            spatial_scale, temp_scale)
+    return RoIAlignFunction.apply(features, rois, aligned_height, aligned_width, time_dim,
+                                  spatial_scale, temp_scale)
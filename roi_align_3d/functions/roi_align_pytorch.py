@@ -0,0 +1,153 @@
+"""
+Spatio-temporal RoIAlign in plain pytorch.
+
+Same sampling as the CPU kernel in src/roi_align.c: every roi
+[batch_ind, x1, y1, t1, x2, y2, t2] is sampled on an
+aligned_height x aligned_width x time_dim grid that spans the roi end to end
+(bins of (x2 - x1 + 1) / (aligned_width - 1)), each sample is the trilinear
+interpolation of its 8 neighbours, the lower neighbour is clamped to
+size - 2 (so the last row / column / frame extrapolates) and samples outside
+the feature map are 0.
+
+Trilinear interpolation is separable, so instead of gathering the 8
+neighbours of every sample, every roi gets a (bins x size) interpolation
+matrix per axis (2 non zeros per row, a zero row for a sample outside the
+map). The time matrices index the (batch * time) frames, so one matmul
+samples the frames of all the rois from their own clip, then a batched
+matmul with the (ah * aw) x (H * W) product of the height and width matrices
+samples the cells. Autograd gives the backward, and it runs on any device.
+Rois are processed in chunks to bound the memory of the sampled frames.
+"""
+
+import torch
+
+
+def _interpolation_weights(start, end, n_bins, size, offset=None, n_cols=None):
+    """(n_rois, n_bins, n_cols) linear interpolation weights of the n_bins
+    sample positions of every roi along one axis of length `size`, placed at
+    columns offset + [0, size) (offset 0 and n_cols = size by default)."""
+    bin_size = (end - start + 1).clamp(min=0) / (n_bins - 1.)
+    pos = torch.arange(n_bins, dtype=start.dtype, device=start.device).view(1, -1) * bin_size.view(-1, 1) \
+        + start.view(-1, 1)
+    lower = pos.floor().clamp(max=size - 2)
+    ratio = pos - lower
+    valid = ((pos >= 0) & (pos < size)).type_as(pos)
+
+    lower = lower.clamp(min=0).long()
+    if offset is not None:
+        lower = lower + offset.view(-1, 1)
+    lower = lower.unsqueeze(2)
+    weights = pos.new_zeros(pos.size(0), n_bins, n_cols or size)
+    weights.scatter_add_(2, lower, ((1 - ratio) * valid).unsqueeze(2))
+    weights.scatter_add_(2, lower + 1, (ratio * valid).unsqueeze(2))
+    return weights
+
+
+def roi_align_3d(features, rois, aligned_height, aligned_width, time_dim,
+                 spatial_scale, temp_scale=1.0, chunk_size=0):
+    """features : (B, C, T, H, W)
+    rois     : (N, 7) batch_ind, x1, y1, t1, x2, y2, t2
+    Returns the (N, C, time_dim, aligned_height, aligned_width) samples.
+    """
+    batch_size, channels, time, height, width = features.size()
+    num_rois = rois.size(0)
+    if chunk_size <= 0:
+        # ~16M values in the sampled frames
+        chunk_size = max(1, (1 << 24) // (time_dim * channels * height * width))
+    if num_rois > chunk_size:
+        return torch.cat([roi_align_3d(features, rois[i:i + chunk_size], aligned_height, aligned_width,
+                                       time_dim, spatial_scale, temp_scale, chunk_size)
+                          for i in range(0, num_rois, chunk_size)], 0)
+
+    rois = rois.type_as(features)
+    batch_ind = rois[:, 0].long()
+    weights_t = _interpolation_weights(rois[:, 3] * temp_scale, rois[:, 6] * temp_scale,
+                                       time_dim, time, batch_ind * time, batch_size * time)
+    weights_h = _interpolation_weights(rois[:, 2] * spatial_scale, rois[:, 5] * spatial_scale,
+                                       aligned_height, height)
+    weights_w = _interpolation_weights(rois[:, 1] * spatial_scale, rois[:, 4] * spatial_scale,
+                                       aligned_width, width)
+    weights_hw = (weights_h.unsqueeze(2).unsqueeze(4) * weights_w.unsqueeze(1).unsqueeze(3)).view(
+        num_rois, aligned_height * aligned_width, height * width)
+
+    # frames: (N*td, B*T) x (B*T, C*H*W) -> (N, td*C, H*W)
+    frames = features.permute(0, 2, 1, 3, 4).reshape(batch_size * time, -1)
+    x = torch.mm(weights_t.view(num_rois * time_dim, -1), frames)
+    x = x.view(num_rois, time_dim * channels, height * width)
+
+    # cells: (N, td*C, H*W) x (N, H*W, ah*aw) -> (N, td, C, ah, aw)
+    x = torch.bmm(x, weights_hw.transpose(1, 2))
+    x = x.view(num_rois, time_dim, channels, aligned_height, aligned_width)
+
+    return x.permute(0, 2, 1, 3, 4).contiguous()
+
+
+if __name__ == '__main__':
+
+    import math
+    import time
+
+    def roi_align_loop(features, rois, aligned_height, aligned_width, time_dim, spatial_scale, temp_scale):
+        # ROIAlignForwardCpu of src/roi_align.c, element by element
+        _, channels, data_time, height, width = features.size()
+        output = features.new_zeros(rois.size(0), channels, time_dim, aligned_height, aligned_width)
+        for n in range(rois.size(0)):
+            roi = rois[n].tolist()
+            b = int(roi[0])
+            start_w, start_h, start_t = roi[1] * spatial_scale, roi[2] * spatial_scale, roi[3] * temp_scale
+            end_w, end_h, end_t = roi[4] * spatial_scale, roi[5] * spatial_scale, roi[6] * temp_scale
+            bin_size_w = max(end_w - start_w + 1., 0.) / (aligned_width - 1.)
+            bin_size_h = max(end_h - start_h + 1., 0.) / (aligned_height - 1.)
+            bin_size_t = max(end_t - start_t + 1., 0.) / (time_dim - 1.)
+            for pt in range(time_dim):
+                for ph in range(aligned_height):
+                    for pw in range(aligned_width):
+                        h = ph * bin_size_h + start_h
+                        w = pw * bin_size_w + start_w
+                        t = pt * bin_size_t + start_t
+                        if h < 0 or h >= height or w < 0 or w >= width or t < 0 or t >= data_time:
+                            continue
+                        hs = int(min(math.floor(h), height - 2))
+                        ws = int(min(math.floor(w), width - 2))
+                        ts = int(min(math.floor(t), data_time - 2))
+                        hr, wr, tr = h - hs, w - ws, t - ts
+                        f = features[b]
+                        front = f[:, ts, hs, ws] * (1 - hr) * (1 - wr) + f[:, ts, hs, ws + 1] * (1 - hr) * wr \
+                            + f[:, ts, hs + 1, ws] * hr * (1 - wr) + f[:, ts, hs + 1, ws + 1] * hr * wr
+                        back = f[:, ts + 1, hs, ws] * (1 - hr) * (1 - wr) + f[:, ts + 1, hs, ws + 1] * (1 - hr) * wr \
+                            + f[:, ts + 1, hs + 1, ws] * hr * (1 - wr) + f[:, ts + 1, hs + 1, ws + 1] * hr * wr
+                        output[n, :, pt, ph, pw] = front * (1 - tr) + back * tr
+        return output
+
+    def random_rois(n, batch_size, im_size, duration):
+        xy = torch.rand(n, 2, 2) * im_size * 1.2 - im_size * 0.1   # some rois cross the border
+        t = torch.rand(n, 2) * duration
+        return torch.cat((torch.randint(0, batch_size, (n, 1)).double(),
+                          xy.min(1)[0], t.min(1, keepdim=True)[0],
+                          xy.max(1)[0], t.max(1, keepdim=True)[0]), 1)
+
+    torch.manual_seed(0)
+
+    # against the kernel's semantics, in double
+    features = torch.randn(2, 3, 6, 7, 7, dtype=torch.float64)
+    rois = random_rois(20, 2, 112, 6).double()
+    out = roi_align_3d(features, rois, 4, 5, 3, 1. / 16, chunk_size=7)
+    ref = roi_align_loop(features, rois, 4, 5, 3, 1. / 16, 1.)
+    print('max abs diff to the kernel loop : {:.2e}'.format((out - ref).abs().max().item()))
+
+    features.requires_grad_(True)
+    ok = torch.autograd.gradcheck(lambda f: roi_align_3d(f, rois[:6], 4, 5, 3, 1. / 16), (features,))
+    print('gradcheck :', ok)
+
+    # cpu throughput at the act_base feature size of a 16 x 112 x 112 clip
+    features = torch.randn(1, 256, 16, 7, 7)
+    for n_rois, grad in [(300, False), (2000, False), (256, True)]:
+        rois = random_rois(n_rois, 1, 112, 16).float()
+        feats = features.clone().requires_grad_(grad)
+        t = time.time()
+        out = roi_align_3d(feats, rois, 8, 8, 17, 1. / 16)
+        if grad:
+            out.sum().backward()
+        elapsed = time.time() - t
+        print('{} rois{} : {:.3f}s, {:.0f} rois/s'.format(n_rois, ' + backward' if grad else '',
+                                                           elapsed, n_rois / elapsed))
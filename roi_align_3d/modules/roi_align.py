@@ -1,8 +1,11 @@
 from torch.nn.modules.module import Module
-from torch.nn.functional import avg_pool2d, max_pool2d, avg_pool3d
-from ..functions.roi_align import RoIAlignFunction
+from torch.nn.functional import avg_pool2d, max_pool2d, avg_pool3d, max_pool3d
+from ..functions.roi_align import roi_align
 
 
+# cpu tensors go through the torch extension, gpu tensors through the pure
+# pytorch version (same sampling). Like the old RoIAlignFunction, every roi is
+# sampled at as many frames as the features have.
 class RoIAlign(Module):
     def __init__(self, aligned_height, aligned_width, spatial_scale):
         super(RoIAlign, self).__init__()
@@ -12,8 +15,8 @@ class RoIAlign(Module):
         self.spatial_scale = float(spatial_scale)
 
     def forward(self, features, rois):
-        return RoIAlignFunction(self.aligned_height, self.aligned_width,
-                                self.spatial_scale)(features, rois)
+        return roi_align(features, rois, self.aligned_height, self.aligned_width,
+                         features.size(2), self.spatial_scale)
 
 class RoIAlignAvg(Module):
     def __init__(self, aligned_height, aligned_width, spatial_scale, time_dim):
@@ -24,8 +27,8 @@ class RoIAlignAvg(Module):
         self.spatial_scale = float(spatial_scale)
         self.time_dim = float(time_dim)
     def forward(self, features, rois):
-        x =  RoIAlignFunction(self.aligned_height+1, self.aligned_width+1,
-                                self.spatial_scale,self.time_dim)(features, rois )
+        x = roi_align(features, rois, self.aligned_height+1, self.aligned_width+1,
+                      features.size(2), self.spatial_scale)
         return avg_pool3d(x, kernel_size=2, stride=1)
 
 class RoIAlignMax(Module):
@@ -37,6 +40,7 @@ class RoIAlignMax(Module):
         self.spatial_scale = float(spatial_scale)
 
     def forward(self, features, rois):
-        x =  RoIAlignFunction(self.aligned_height+1, self.aligned_width+1,
-                                self.spatial_scale)(features, rois)
-        return max_pool2d(x, kernel_size=2, stride=1)
+        x = roi_align(features, rois, self.aligned_height+1, self.aligned_width+1,
+                      features.size(2), self.spatial_scale)
+        # max_pool2d over every frame
+        return max_pool3d(x, kernel_size=(1, 2, 2), stride=1)
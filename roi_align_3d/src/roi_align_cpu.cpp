@@ -0,0 +1,219 @@
+// Spatio-temporal RoIAlign on cpu as a torch extension, JIT built by
+// functions/roi_align.py
+//
+// Same sampling as ROIAlignForwardCpu in roi_align.c (and roi_align_pytorch.py):
+//   features : (B, C, T, H, W)
+//   rois     : (N, 7) batch_ind, x1, y1, t1, x2, y2, t2
+//   output   : (N, C, time_dim, aligned_height, aligned_width)
+//
+// The sample positions and weights of every roi are computed once, then the
+// forward runs in parallel over rois x channels and the backward over channels
+// (rois of the same channel can add to the same feature cell, channels can't).
+
+#include <torch/extension.h>
+#include <omp.h>
+
+#include <algorithm>
+#include <cmath>
+#include <vector>
+
+template <typename scalar_t>
+struct Samples {
+    // per (roi, pt, ph, pw): offset of the up left front neighbour in the
+    // (b, 0) volume of the features and the 8 trilinear weights
+    std::vector<int64_t> offset;
+    std::vector<scalar_t> weight;
+};
+
+template <typename scalar_t>
+Samples<scalar_t> roi_samples(const scalar_t* rois, int64_t num_rois,
+                              int64_t channels, int64_t time, int64_t height, int64_t width,
+                              int64_t aligned_height, int64_t aligned_width, int64_t time_dim,
+                              scalar_t spatial_scale, scalar_t temp_scale)
+{
+    const int64_t n_samples = time_dim * aligned_height * aligned_width;
+
+    Samples<scalar_t> s;
+    s.offset.assign(num_rois * n_samples, 0);
+    s.weight.assign(num_rois * n_samples * 8, 0);
+
+    #pragma omp parallel for
+    for (int64_t n = 0; n < num_rois; ++n)
+    {
+        const scalar_t* roi = rois + n * 7;
+        const int64_t roi_batch_ind = (int64_t)roi[0];
+        scalar_t roi_start_w = roi[1] * spatial_scale;
+        scalar_t roi_start_h = roi[2] * spatial_scale;
+        scalar_t roi_start_t = roi[3] * temp_scale;
+        scalar_t roi_end_w = roi[4] * spatial_scale;
+        scalar_t roi_end_h = roi[5] * spatial_scale;
+        scalar_t roi_end_t = roi[6] * temp_scale;
+
+        // Force malformed ROI to be 1x1
+        scalar_t roi_width = std::max<scalar_t>(roi_end_w - roi_start_w + 1, 0);
+        scalar_t roi_height = std::max<scalar_t>(roi_end_h - roi_start_h + 1, 0);
+        scalar_t roi_time = std::max<scalar_t>(roi_end_t - roi_start_t + 1, 0);
+        scalar_t bin_size_h = roi_height / (aligned_height - 1);
+        scalar_t bin_size_w = roi_width / (aligned_width - 1);
+        scalar_t bin_size_t = roi_time / (time_dim - 1);
+
+        const int64_t volume = roi_batch_ind * channels * time * height * width;
+
+        for (int64_t pt = 0; pt < time_dim; ++pt)
+        {
+            for (int64_t ph = 0; ph < aligned_height; ++ph)
+            {
+                for (int64_t pw = 0; pw < aligned_width; ++pw)
+                {
+                    const int64_t idx = n * n_samples + (pt * aligned_height + ph) * aligned_width + pw;
+
+                    scalar_t h = ph * bin_size_h + roi_start_h;
+                    scalar_t w = pw * bin_size_w + roi_start_w;
+                    scalar_t t = pt * bin_size_t + roi_start_t;
+
+                    // 0 outside the feature map
+                    if (h < 0 || h >= height || w < 0 || w >= width || t < 0 || t >= time)
+                        continue;
+
+                    int64_t hstart = std::min<int64_t>((int64_t)std::floor(h), height - 2);
+                    int64_t wstart = std::min<int64_t>((int64_t)std::floor(w), width - 2);
+                    int64_t tstart = std::min<int64_t>((int64_t)std::floor(t), time - 2);
+                    scalar_t h_ratio = h - hstart;
+                    scalar_t w_ratio = w - wstart;
+                    scalar_t t_ratio = t - tstart;
+
+                    s.offset[idx] = volume + (tstart * height + hstart) * width + wstart;
+                    scalar_t* weight = s.weight.data() + idx * 8;
+                    scalar_t bilinear[4] = {(1 - h_ratio) * (1 - w_ratio), (1 - h_ratio) * w_ratio,
+                                            h_ratio * (1 - w_ratio), h_ratio * w_ratio};
+                    for (int k = 0; k < 4; ++k)
+                    {
+                        weight[k] = bilinear[k] * (1 - t_ratio);    // front
+                        weight[k + 4] = bilinear[k] * t_ratio;      // back
+                    }
+                }
+            }
+        }
+    }
+    return s;
+}
+
+// the omp pragmas can't be inside the AT_DISPATCH macro, hence the kernels
+template <typename scalar_t>
+void forward_kernel(const Samples<scalar_t>& s, const scalar_t* bottom_data, scalar_t* top_data,
+                    int64_t num_rois, int64_t channels, int64_t n_samples,
+                    int64_t channel_size, int64_t height, int64_t width)
+{
+    const int64_t plane = height * width;
+    const int64_t neighbours[8] = {0, 1, width, width + 1,
+                                   plane, plane + 1, plane + width, plane + width + 1};
+
+    #pragma omp parallel for
+    for (int64_t nc = 0; nc < num_rois * channels; ++nc)
+    {
+        const int64_t n = nc / channels, c = nc % channels;
+        const int64_t* offset = s.offset.data() + n * n_samples;
+        const scalar_t* weight = s.weight.data() + n * n_samples * 8;
+        scalar_t* top = top_data + nc * n_samples;
+
+        for (int64_t i = 0; i < n_samples; ++i, weight += 8)
+        {
+            const scalar_t* data = bottom_data + c * channel_size + offset[i];
+            scalar_t value = 0;
+            for (int k = 0; k < 8; ++k)
+                value += data[neighbours[k]] * weight[k];
+            top[i] = value;
+        }
+    }
+}
+
+template <typename scalar_t>
+void backward_kernel(const Samples<scalar_t>& s, const scalar_t* top_diff, scalar_t* bottom_diff,
+                     int64_t num_rois, int64_t channels, int64_t n_samples,
+                     int64_t channel_size, int64_t height, int64_t width)
+{
+    const int64_t plane = height * width;
+    const int64_t neighbours[8] = {0, 1, width, width + 1,
+                                   plane, plane + 1, plane + width, plane + width + 1};
+
+    #pragma omp parallel for
+    for (int64_t c = 0; c < channels; ++c)
+    {
+        for (int64_t n = 0; n < num_rois; ++n)
+        {
+            const int64_t* offset = s.offset.data() + n * n_samples;
+            const scalar_t* weight = s.weight.data() + n * n_samples * 8;
+            const scalar_t* top = top_diff + (n * channels + c) * n_samples;
+
+            for (int64_t i = 0; i < n_samples; ++i, weight += 8)
+            {
+                scalar_t* diff = bottom_diff + c * channel_size + offset[i];
+                for (int k = 0; k < 8; ++k)
+                    diff[neighbours[k]] += top[i] * weight[k];
+            }
+        }
+    }
+}
+
+static void check_inputs(const torch::Tensor& features, const torch::Tensor& rois)
+{
+    TORCH_CHECK(!features.is_cuda() && !rois.is_cuda(), "roi_align_3d_cpu: cpu tensors only");
+    TORCH_CHECK(features.dim() == 5, "roi_align_3d_cpu: features must be (B, C, T, H, W)");
+    TORCH_CHECK(rois.dim() == 2 && rois.size(1) == 7, "roi_align_3d_cpu: rois must be (N, 7)");
+    TORCH_CHECK(features.size(2) >= 2 && features.size(3) >= 2 && features.size(4) >= 2,
+                "roi_align_3d_cpu: feature map smaller than 2x2x2");
+}
+
+torch::Tensor roi_align_forward(torch::Tensor features, torch::Tensor rois,
+                                int64_t aligned_height, int64_t aligned_width, int64_t time_dim,
+                                double spatial_scale, double temp_scale)
+{
+    check_inputs(features, rois);
+    features = features.contiguous();
+    rois = rois.to(features.scalar_type()).contiguous();
+
+    const int64_t num_rois = rois.size(0);
+    const int64_t channels = features.size(1), time = features.size(2);
+    const int64_t height = features.size(3), width = features.size(4);
+
+    auto output = features.new_zeros({num_rois, channels, time_dim, aligned_height, aligned_width});
+
+    AT_DISPATCH_FLOATING_TYPES(features.scalar_type(), "roi_align_3d_forward", [&] {
+        auto s = roi_samples<scalar_t>(rois.data_ptr<scalar_t>(), num_rois, channels, time,
+                                       height, width, aligned_height, aligned_width, time_dim,
+                                       (scalar_t)spatial_scale, (scalar_t)temp_scale);
+        forward_kernel<scalar_t>(s, features.data_ptr<scalar_t>(), output.data_ptr<scalar_t>(),
+                                 num_rois, channels, time_dim * aligned_height * aligned_width,
+                                 time * height * width, height, width);
+    });
+    return output;
+}
+
+torch::Tensor roi_align_backward(torch::Tensor top_grad, torch::Tensor rois,
+                                 int64_t batch_size, int64_t channels, int64_t time,
+                                 int64_t height, int64_t width,
+                                 int64_t aligned_height, int64_t aligned_width, int64_t time_dim,
+                                 double spatial_scale, double temp_scale)
+{
+    top_grad = top_grad.contiguous();
+    rois = rois.to(top_grad.scalar_type()).contiguous();
+
+    const int64_t num_rois = rois.size(0);
+    auto bottom_grad = top_grad.new_zeros({batch_size, channels, time, height, width});
+    check_inputs(bottom_grad, rois);
+
+    AT_DISPATCH_FLOATING_TYPES(top_grad.scalar_type(), "roi_align_3d_backward", [&] {
+        auto s = roi_samples<scalar_t>(rois.data_ptr<scalar_t>(), num_rois, channels, time,
+                                       height, width, aligned_height, aligned_width, time_dim,
+                                       (scalar_t)spatial_scale, (scalar_t)temp_scale);
+        backward_kernel<scalar_t>(s, top_grad.data_ptr<scalar_t>(), bottom_grad.data_ptr<scalar_t>(),
+                                  num_rois, channels, time_dim * aligned_height * aligned_width,
+                                  time * height * width, height, width);
+    });
+    return bottom_grad;
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("forward", &roi_align_forward, "3D RoIAlign forward (cpu)");
+    m.def("backward", &roi_align_backward, "3D RoIAlign backward (cpu)");
+}
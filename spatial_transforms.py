@@ -207,3 +207,129 @@ class Resize(object):
         w, h = self.size
         print(w,h)
         return img.resize((w,h))
+
+
+# Clip-level transforms. They take the whole clip at once, either as a list of
+# PIL images (as returned by the video loaders) or as a T x H x W x C uint8
+# array, and keep it as one uint8 array until ClipToTensor writes the final
+# C x T x H x W tensor.
+
+def clip_frames(clip):
+    """Returns the frames of a clip as H x W x C uint8 arrays."""
+    if isinstance(clip, np.ndarray):
+        return clip
+    return [np.asarray(img) for img in clip]
+
+
+class ClipScale(object):
+    """Clip counterpart of ``Scale``: resizes every frame keeping the aspect
+    ratio and pads it to (w, h) with `pad_value`, like ``imresizeAndPad``.
+    """
+
+    def __init__(self, size, pad_value=114, interpolation=cv2.INTER_LINEAR):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        self.pad_value = pad_value
+        self.interpolation = interpolation
+
+    def __call__(self, clip):
+        frames = clip_frames(clip)
+        width, height = self.size
+        imgHeight, imgWidth, nchannel = frames[0].shape
+        scale = min(float(width) / float(imgWidth), float(height) / float(imgHeight))
+        resizedWidth, resizedHeight = int(imgWidth * scale), int(imgHeight * scale)
+
+        top  = int(max(0, np.round((height - resizedHeight) / 2)))
+        left = int(max(0, np.round((width - resizedWidth) / 2)))
+
+        out = np.full((len(frames), height, width, nchannel), self.pad_value, dtype=np.uint8)
+        for t, frame in enumerate(frames):
+            out[t, top:top + resizedHeight, left:left + resizedWidth] = cv2.resize(
+                frame, (resizedWidth, resizedHeight), interpolation=self.interpolation)
+        return out
+
+
+class ClipCenterCrop(object):
+    """Clip counterpart of ``CenterCrop``, size is (h, w)."""
+
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, clip):
+        if not isinstance(clip, np.ndarray):
+            clip = np.stack(clip_frames(clip))
+        h, w = clip.shape[1:3]
+        th, tw = self.size
+        x1 = int(round((w - tw) / 2.))
+        y1 = int(round((h - th) / 2.))
+        return clip[:, y1:y1 + th, x1:x1 + tw]
+
+
+class ClipResize(object):
+    """Clip counterpart of ``Resize``, size is (w, h)."""
+
+    def __init__(self, size, interpolation=cv2.INTER_LINEAR):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+        self.interpolation = interpolation
+
+    def __call__(self, clip):
+        frames = clip_frames(clip)
+        w, h = self.size
+        out = np.empty((len(frames), h, w, frames[0].shape[2]), dtype=np.uint8)
+        for t, frame in enumerate(frames):
+            out[t] = cv2.resize(frame, (w, h), interpolation=self.interpolation)
+        return out
+
+
+class ClipToTensor(object):
+    """Converts a T x H x W x C uint8 clip to a C x T x H x W FloatTensor in
+    the range [0, 255], doing the transpose and the cast in one copy.
+    With `as_uint8=True` the clip stays a ByteTensor, which is 4x less to send
+    from the DataLoader workers; normalize it with ``BatchNormalize`` then.
+    """
+
+    def __init__(self, as_uint8=False):
+        self.dtype = torch.uint8 if as_uint8 else torch.float32
+
+    def __call__(self, clip):
+        if not isinstance(clip, np.ndarray):
+            clip = np.stack(clip_frames(clip))
+        clip = torch.from_numpy(clip).permute(3, 0, 1, 2)
+        return torch.empty(clip.shape, dtype=self.dtype).copy_(clip)
+
+
+class ClipNormalize(object):
+    """Clip counterpart of ``Normalize`` for C x T x H x W tensors."""
+
+    def __init__(self, mean, std):
+        self.mean = torch.Tensor(mean).view(-1, 1, 1, 1)
+        self.std = torch.Tensor(std).view(-1, 1, 1, 1)
+
+    def __call__(self, tensor):
+        return tensor.sub_(self.mean).div_(self.std)
+
+
+class BatchNormalize(object):
+    """Normalizes a batch of N x C x T x H x W uint8 clips on the training
+    side. The clips are moved to `device` while still uint8 and cast there.
+    """
+
+    def __init__(self, mean, std):
+        self.mean = torch.Tensor(mean).view(1, -1, 1, 1, 1)
+        self.std = torch.Tensor(std).view(1, -1, 1, 1, 1)
+
+    def __call__(self, clips, device=None):
+        if device is not None:
+            clips = clips.to(device, non_blocking=True)
+        if self.mean.device != clips.device:
+            self.mean = self.mean.to(clips.device)
+            self.std = self.std.to(clips.device)
+        return clips.float().sub_(self.mean).div_(self.std)
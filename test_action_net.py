@@ -10,7 +10,7 @@ from torch.utils.data import DataLoader
 
 
 # from video_dataset import Video
-from jhmdb_dataset import Video
+from jhmdb_dataset import Video, get_threaded_video_loader
 from spatial_transforms import (
     Compose, Normalize, Scale, CenterCrop, ToTensor, Resize)
 from temporal_transforms import LoopPadding
@@ -77,7 +77,8 @@ if __name__ == '__main__':
 
     data = Video(dataset_folder, frames_dur=sample_duration, spatial_transform=spatial_transform,
                  temporal_transform=temporal_transform, json_file = boxes_file,
-                 split_txt_path=splt_txt_path, mode='test', classes_idx=cls2idx)
+                 split_txt_path=splt_txt_path, mode='test', classes_idx=cls2idx,
+                 get_loader=get_threaded_video_loader)
     data_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
                                               shuffle=True, num_workers=n_threads, pin_memory=True)
 
@@ -104,7 +105,7 @@ if __name__ == '__main__':
     model = nn.DataParallel(model)
     model.to(device)
 
-    model_data = torch.load('./jmdb_model_020.pwf')
+    model_data = torch.load('./jmdb_model_020.pwf', map_location=device)
     model.load_state_dict(model_data)
     model.eval()
 
@@ -9,7 +9,7 @@ from torch.autograd import Variable
 from torch.utils.data import DataLoader
 
 from resnet_3D import resnet34
-from video_dataset import Video
+from video_dataset import Video, get_threaded_video_loader
 from spatial_transforms import (
     Compose, Normalize, Scale, CenterCrop, ToTensor, Resize)
 from temporal_transforms import LoopPadding
@@ -59,7 +59,8 @@ if __name__ == '__main__':
 
     data = Video(dataset_folder, frames_dur=sample_duration, spatial_transform=spatial_transform,
                  temporal_transform=temporal_transform, json_file=boxes_file,
-                 mode='test', classes_idx=cls2idx, scale_size = scale_size)
+                 mode='test', classes_idx=cls2idx, scale_size = scale_size,
+                 get_loader=get_threaded_video_loader)
     # data_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
     #                                           shuffle=True, num_workers=n_threads, pin_memory=True)
 
@@ -117,6 +118,7 @@ if __name__ == '__main__':
                                                  torch.Tensor(
                                                      [[w,h]] * gt_tubes.size(1)).cuda(),
                                                  None,None,None)
+    rois = rois[0]
     print('h %d w %d ' % (h,w))
     rois[:,[0,2]] =rois[:,[0,2]].clamp_(min=0, max=w)
     rois[:,[1,3]] =rois[:,[1,3]].clamp_(min=0, max=h)
@@ -10,11 +10,14 @@ from torch.autograd import Variable
 from torch.utils.data import DataLoader
 
 from resnet_3D import resnet34
-from video_dataset import Video
+from video_dataset import Video, get_draft_video_loader
+from clip_cache import FeatureCache, CachedFeatureExtractor, ProposalCache
 from spatial_transforms import (
-    Compose, Normalize, Scale, CenterCrop, ToTensor, Resize)
+    Compose, Normalize, Scale, CenterCrop, ToTensor, Resize,
+    ClipScale, ClipToTensor, ClipNormalize, BatchNormalize)
 from temporal_transforms import LoopPadding
 from action_net import ACT_net
+from config import cfg
 from resize_rpn import resize_rpn, resize_tube
 import pdb
 
@@ -58,14 +61,28 @@ if __name__ == '__main__':
 
     cls2idx = {actions[i]: i for i in range(0, len(actions))}
 
-    spatial_transform = Compose([Scale(sample_size),  # [Resize(sample_size),
-                                 ToTensor(),
-                                 Normalize(mean, [1, 1, 1])])
+    # spatial_transform = Compose([Scale(sample_size),  # [Resize(sample_size),
+    #                              ToTensor(),
+    #                              Normalize(mean, [1, 1, 1])])
+    # workers send uint8 clips, they are normalized on the gpu
+    clip_transform = Compose([ClipScale(sample_size),
+                              ClipToTensor(as_uint8=True)])
+    batch_normalize = BatchNormalize(mean, [1, 1, 1])
+    # act_base is frozen, so its features are computed once per clip
+    feature_cache = FeatureCache('./act_base_features', transform_id='scale{}'.format(sample_size),
+                                 half=True)
+    # to train only the head on a fixed rpn, dump its proposals with
+    # dump_proposals.py and use them instead of running the rpn
+    proposal_cache = None
+    # proposal_cache = ProposalCache('./rpn_proposals', cfg.TRAIN.RPN_PRE_NMS_TOP_N,
+    #                                cfg.TRAIN.RPN_POST_NMS_TOP_N)
     temporal_transform = LoopPadding(sample_duration)
 
-    data = Video(dataset_folder, frames_dur=sample_duration, spatial_transform=spatial_transform,
+    data = Video(dataset_folder, frames_dur=sample_duration, clip_transform=clip_transform,
                  temporal_transform=temporal_transform, json_file=boxes_file,
-                 mode='train', classes_idx=cls2idx)
+                 mode='train', classes_idx=cls2idx,
+                 get_loader=lambda: get_draft_video_loader(sample_size),
+                 feature_cache=feature_cache)
     data_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
                                               shuffle=True, num_workers=n_threads, pin_memory=True)
 
@@ -84,6 +101,9 @@ if __name__ == '__main__':
 
     model.to(device)
 
+    act_model = model.module if isinstance(model, nn.DataParallel) else model
+    feature_extractor = CachedFeatureExtractor(act_model.act_base, feature_cache, batch_normalize)
+
     params = []
     for key, value in dict(model.named_parameters()).items():
         # print(key, value.requires_grad)
@@ -112,22 +132,29 @@ if __name__ == '__main__':
         # (    clips,  (h, w), gt_tubes, gt_rois) = next(data_loader.__iter__())
         # (    clips,  (h, w), gt_tubes, gt_rois) = data[525]
             # print('&&&&&&&&&&')
-            clips,  (h, w), gt_tubes, gt_rois = data
+            clips,  (h, w), gt_tubes, gt_rois, clip_keys, cached = data
+            base_feat = feature_extractor(clips, clip_keys, cached, device)
+            rois = None
+            if proposal_cache is not None and clip_keys[0] in proposal_cache:
+                rois = proposal_cache.get(clip_keys[0]).unsqueeze(0).to(device)
             # print('gt_tubes : ',gt_tubes)
             # print('gt_rois.shape : ',gt_rois.shape)
-            gt_tubes = gt_tubes[:,0,:].unsqueeze(1).to(device)
-            gt_rois = gt_rois[:,0,:,:].unsqueeze(1).to(device)
+            # every actor of the clip whose tube lasts the whole clip
+            full_tubes = (gt_tubes[0,:,5] - gt_tubes[0,:,2]+1 == 16)
+            gt_tubes = gt_tubes[:,full_tubes].to(device)
+            gt_rois = gt_rois[:,full_tubes].to(device)
 
             # print('gt_tubes : ',gt_tubes)
             # print('gt_tubes.shape : ',gt_tubes.shape)
             # print('gt_tubes[0,0,5] - gt_tube[0,0,2]+1 :',gt_tubes[0,0,5] - gt_tubes[0,0,2]+1)
             # print('gt_tubes[0,0,5] - gt_tube[0,0,2]+1 != 16 :',gt_tubes[0,0,5] - gt_tubes[0,0,2]+1 != 16)
-            if (gt_tubes[0,0,5] - gt_tubes[0,0,2]+1 != 16):
+            if gt_tubes.size(1) == 0:
                 # print('Only background, continue...')
                 continue
             
             # print('gt_tubes :',gt_tubes)
             gt_rois =  gt_rois.squeeze(0)
+            im_size = (int(h), int(w))  # on the host, for the anchor targets
             h = h.to(device)
             w = w.to(device)
             # print('gt_tubes.shape :',gt_tubes.shape )
@@ -146,10 +173,11 @@ if __name__ == '__main__':
             print('torch.Tensor([[h, w]] * gt_tubes.size(1)).to(device).shape :',torch.Tensor([[h, w]] * gt_tubes.size(1)).to(device))
 
             rois,  bbox_pred, rpn_loss_cls, \
-            rpn_loss_bbox,  act_loss_bbox, rois_label = model(clips,
+            rpn_loss_bbox,  act_loss_bbox, rois_label = model(None,
                                                               torch.Tensor([[h, w]] * gt_tubes.size(1)).to(device),
                                                               gt_tubes, gt_rois,
-                                                              torch.Tensor(len(gt_tubes)).to(device))
+                                                              torch.Tensor(len(gt_tubes)).to(device),
+                                                              base_feat=base_feat, rois=rois, im_size=im_size)
 
             loss = rpn_loss_cls.mean() + rpn_loss_bbox.mean() + act_loss_bbox.mean()
             loss_temp += loss.item()
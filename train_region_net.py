@@ -10,9 +10,11 @@ from torch.autograd import Variable
 from torch.utils.data import DataLoader
 
 from resnet_3D import resnet34
-from video_dataset import Video
+from video_dataset import Video, get_draft_video_loader
+from clip_cache import FeatureCache, CachedFeatureExtractor
 from spatial_transforms import (
-    Compose, Normalize, Scale, CenterCrop, ToTensor, Resize)
+    Compose, Normalize, Scale, CenterCrop, ToTensor, Resize,
+    ClipScale, ClipToTensor, ClipNormalize, BatchNormalize)
 from temporal_transforms import LoopPadding
 from region_net import _RPN
 from resize_rpn import resize_rpn, resize_tube
@@ -58,14 +60,24 @@ if __name__ == '__main__':
 
     cls2idx = {actions[i]: i for i in range(0, len(actions))}
 
-    spatial_transform = Compose([Scale(sample_size),  # [Resize(sample_size),
-                                 ToTensor(),
-                                 Normalize(mean, [1, 1, 1])])
+    # spatial_transform = Compose([Scale(sample_size),  # [Resize(sample_size),
+    #                              ToTensor(),
+    #                              Normalize(mean, [1, 1, 1])])
+    # workers send uint8 clips, they are normalized on the gpu
+    clip_transform = Compose([ClipScale(sample_size),
+                              ClipToTensor(as_uint8=True)])
+    batch_normalize = BatchNormalize(mean, [1, 1, 1])
+    # the pretrained resnet34 is only run in eval mode, so its features are
+    # computed once per clip
+    feature_cache = FeatureCache('./resnet34_features', transform_id='scale{}'.format(sample_size),
+                                 half=True)
     temporal_transform = LoopPadding(sample_duration)
 
-    data = Video(dataset_folder, frames_dur=sample_duration, spatial_transform=spatial_transform,
+    data = Video(dataset_folder, frames_dur=sample_duration, clip_transform=clip_transform,
                  temporal_transform=temporal_transform, json_file=boxes_file,
-                 mode='train', classes_idx=cls2idx)
+                 mode='train', classes_idx=cls2idx,
+                 get_loader=lambda: get_draft_video_loader(sample_size),
+                 feature_cache=feature_cache)
     data_loader = torch.utils.data.DataLoader(data, batch_size=batch_size,
                                               shuffle=True, num_workers=n_threads, pin_memory=True)
 
@@ -82,6 +94,7 @@ if __name__ == '__main__':
     model_data = torch.load('../temporal_localization/resnet-34-kinetics.pth')
     model.load_state_dict(model_data['state_dict'])
     model.eval()
+    feature_extractor = CachedFeatureExtractor(model, feature_cache, batch_normalize)
 
     lr = 0.001
 
@@ -112,10 +125,9 @@ if __name__ == '__main__':
         model.eval()
 
         ## 2 rois : 1450
-        for step, (    clips,  (h, w), gt_tubes, gt_rois) in tqdm(enumerate(data_loader)):
+        for step, (    clips,  (h, w), gt_tubes, gt_rois, clip_keys, cached) in tqdm(enumerate(data_loader)):
         # (    clips,  (h, w), gt_tubes, gt_rois) = next(data_loader.__iter__())
         # (    clips,  (h, w), gt_tubes, gt_rois) = data[525]
-            clips = clips.cuda()
             gt_tubes = gt_tubes.cuda()
             gt_rois =  gt_rois.squeeze(0).cuda()
             h = h.cuda()
@@ -126,15 +138,15 @@ if __name__ == '__main__':
             gt_tubes_r = resize_tube(gt_tubes, h,w,sample_size)
             gt_rois_r = resize_rpn(gt_rois, h,w,112)
 
-            inputs = Variable(clips)
             # print('gt_tubes.shape :',gt_tubes.shape )
             # print('gt_rois.shape :',gt_rois.shape)
-            outputs = model(inputs)
+            outputs = feature_extractor(clips, clip_keys, cached, 'cuda')
             # print('step {}'.format(step))
             rois, rpn_loss_cls, rpn_loss_box = rpn_model(outputs,
                                                          torch.Tensor(
                                                              [[sample_size, sample_size]] * gt_tubes.size(1)).cuda(),
-                                                         gt_tubes, gt_rois, len(gt_tubes))
+                                                         gt_tubes, gt_rois, len(gt_tubes),
+                                                         im_size=(sample_size, sample_size))
 
             loss = rpn_loss_cls.mean() + rpn_loss_box.mean()
             # print(' rpn_loss_cls {}, rpn_loss_box {} ==> loss : {}'.format(rpn_loss_cls, rpn_loss_box,loss))
@@ -11,6 +11,10 @@ import json
 import pickle
 from itertools import groupby
 from create_tubes_from_boxes import create_tube_list
+from clip_shards import get_shard_video_loader
+from frame_loaders import draft_pil_loader, original_size, threaded_video_loader
+from video_manifest import load_manifest
+from annotation_store import BoxStore, TubeStore
 
 np.random.seed(42)
 
@@ -58,6 +62,20 @@ def get_default_video_loader():
     return functools.partial(video_loader, image_loader=image_loader)
 
 
+def get_threaded_video_loader(n_threads=4):
+    image_loader = get_default_image_loader()
+    return functools.partial(threaded_video_loader, image_loader=image_loader,
+                             n_threads=n_threads)
+
+
+def get_draft_video_loader(sample_size=112, n_threads=None):
+    image_loader = functools.partial(draft_pil_loader, size=sample_size)
+    if n_threads:
+        return functools.partial(threaded_video_loader, image_loader=image_loader,
+                                 n_threads=n_threads)
+    return functools.partial(video_loader, image_loader=image_loader)
+
+
 def load_annotation_data(data_file_path):
     with open(data_file_path, 'r') as data_file:
         return json.load(data_file)
@@ -122,43 +140,35 @@ def create_tcn_dataset(split_txt_path, json_path, classes, mode):
     return dataset
 
 
-def make_correct_ucf_dataset(dataset_path,  boxes_file, mode='train'):
+def make_correct_ucf_dataset(dataset_path,  boxes_file, mode='train', tube_store=None):
     dataset = []
     classes = next(os.walk(dataset_path, True))[1]
 
-    with open(boxes_file, 'rb') as fp:
-        boxes_data = pickle.load(fp)
+    # the rois of every clip are built lazily from the memory-mapped store
+    if tube_store is None:
+        tube_store = TubeStore(boxes_file)
 
     assert classes != (None), 'classes must not be None, Check dataset path'
 
-    for vid, values in boxes_data.items():
+    for vid in tube_store.videos:
         name = vid.split('/')[-1]
-        n_frames = values['numf']
-        annots = values['annotations']
-        n_actions = len(annots)
-        rois = np.zeros((n_actions,n_frames,5))
-        rois[:,:,4] = -1 
-        cls = values['label']
-
-        for k  in range(n_actions):
-            sample = annots[k]
-            s_frame = sample['sf']
-            e_frame = sample['ef']
-            s_label = sample['label']
-            boxes   = sample['boxes']
-            rois[k,s_frame:e_frame,:4] = boxes
-            rois[k,s_frame:e_frame,4]  = s_label
 
         # name = vid.split('/')[-1].split('.')[0]
         video_sample = {
             'video_name' : name,
+            'video_key' : vid,
             'abs_path' : os.path.join(dataset_path, vid),
-            'class' : cls,
-            'n_frames' : n_frames,
-            'rois' : rois
+            'class' : tube_store.label(vid),
+            'n_frames' : tube_store.n_frames(vid),
             }
         dataset.append(video_sample)
 
+    manifest = load_manifest(boxes_file, [v['abs_path'] for v in dataset], 'image_*.jpg')
+    for video_sample in dataset:
+        entry = manifest[video_sample['abs_path']]
+        video_sample['n_images'] = entry['n_frames']  # frames on disk
+        video_sample['size'] = (entry['width'], entry['height'])
+
     print('len(dataset) :',len(dataset))
     return dataset
 
@@ -201,19 +211,23 @@ def make_dataset(dataset_path,  boxes_file, mode='train'):
 class Video(data.Dataset):
     def __init__(self, video_path, frames_dur=8, 
                  spatial_transform=None, temporal_transform=None, json_file=None,
-                 sample_duration=16, get_loader=get_default_video_loader, mode='train', classes_idx=None, scale_size=None):
+                 sample_duration=16, get_loader=get_default_video_loader, mode='train', classes_idx=None, scale_size=None,
+                 clip_transform=None, feature_cache=None):
 
         self.mode = mode
+        self.tube_store = TubeStore(json_file)
         self.data = make_correct_ucf_dataset(
-                    video_path, json_file, self.mode)
+                    video_path, json_file, self.mode, self.tube_store)
 
         self.spatial_transform = spatial_transform
+        self.clip_transform = clip_transform  # applied to the whole clip, instead of spatial_transform
         self.temporal_transform = temporal_transform
         self.loader = get_loader()
         self.sample_duration = frames_dur
         self.json_file = json_file
         self.classes_idx = classes_idx
         self.scale_size = scale_size
+        self.feature_cache = feature_cache
 
     def __getitem__(self, index):
         """
@@ -225,10 +239,10 @@ class Video(data.Dataset):
         name = self.data[index]['video_name']   # video path
         cls  = self.data[index]['class']
         path = self.data[index]['abs_path']
-        rois = self.data[index]['rois']
+        video_key = self.data[index]['video_key']
 
 
-        n_frames = len(glob.glob(path+ '/*.jpg'))
+        n_frames = self.data[index]['n_images']
         print('path :',path,  ' n_frames :', n_frames, 'index :',index)        
 
         ## get  random frames from the video 
@@ -247,26 +261,32 @@ class Video(data.Dataset):
 
         if self.temporal_transform is not None:
             frame_indices = self.temporal_transform(frame_indices)
-        clip = self.loader(path, frame_indices)
-        # print('clip : ',len(clip))
-        ## get original height and width
-        w, h = clip[0].size
-        if self.spatial_transform is not None:
-            clip = [self.spatial_transform(img) for img in clip]
 
-        clip = torch.stack(clip, 0).permute(1, 0, 2, 3)
+        clip_key, cached = None, False
+        if self.feature_cache is not None:
+            clip_key = self.feature_cache.key(video_key, time_index)
+            cached = clip_key in self.feature_cache
+
+        if cached:
+            # backbone features of this clip, instead of its pixels
+            clip = self.feature_cache.get(clip_key)
+            w, h = self.data[index]['size']
+        else:
+            clip = self.loader(path, frame_indices)
+            # print('clip : ',len(clip))
+            ## get original height and width
+            w, h = original_size(clip[0])
+            if self.clip_transform is not None:
+                clip = self.clip_transform(clip)
+            else:
+                if self.spatial_transform is not None:
+                    clip = [self.spatial_transform(img) for img in clip]
+                clip = torch.stack(clip, 0).permute(1, 0, 2, 3)
         # print('clip :', clip.shape)
         ## get bboxes and create gt tubes
-        rois_Tensor = torch.Tensor(rois)
-        # print('rois_Tensor.shape:',rois_Tensor.shape)
-        # print('rois_Tensor :',rois_Tensor)
-        # rois_Tensor[ += 
-        # print('rois.shape :',rois.shape)
+        rois_sample_tensor = torch.from_numpy(self.tube_store.clip_rois(video_key, frame_indices))
+        # print('rois_sample_tensor.shape :',rois_sample_tensor.shape)
 
-        # print('rois :', rois)
-        # print('rois_Tensor.shape :',rois_Tensor.shape)
-
-        rois_sample_tensor = rois_Tensor[:,np.array(frame_indices),:]
         rois_sample_tensor[:,:,2] = rois_sample_tensor[:,:,2] + rois_sample_tensor[:,:,0]
         rois_sample_tensor[:,:,3] = rois_sample_tensor[:,:,3] + rois_sample_tensor[:,:,1]
         rois_sample = rois_sample_tensor.tolist()
@@ -316,10 +336,14 @@ class Video(data.Dataset):
         # print('gt_tubes.shape :',gt_tubes.shape)
         # print('final_rois.shape :', final_rois.shape)
         if self.mode == 'train':
-            return clip,  (h, w),  gt_tubes, final_rois
+            ret = clip,  (h, w),  gt_tubes, final_rois
         else:
             # return clip,  (h, w),  gt_tubes, final_rois,  self.data[index]['abs_path']
-            return clip,  (h, w),  gt_tubes, final_rois,  self.data[index]['abs_path'], frame_indices
+            ret = clip,  (h, w),  gt_tubes, final_rois,  self.data[index]['abs_path'], frame_indices
+
+        if self.feature_cache is not None:
+            ret += (clip_key, cached)
+        return ret
 
     def __len__(self):
         return len(self.data)
@@ -369,17 +393,20 @@ class TCN_Dataset(data.Dataset):
 class Pics(data.Dataset):
     def __init__(self, video_path, frames_dur=8, split_txt_path=None,
                  spatial_transform=None, temporal_transform=None, json_file=None,
-                 sample_duration=16, get_loader=get_default_video_loader, mode='train', classes_idx=None):
+                 sample_duration=16, get_loader=get_default_video_loader, mode='train', classes_idx=None,
+                 clip_transform=None):
 
         self.mode = mode
         self.data = make_dataset(
             video_path, split_txt_path, json_file, self.mode)
 
         self.spatial_transform = spatial_transform
+        self.clip_transform = clip_transform  # applied to the whole clip, instead of spatial_transform
         self.temporal_transform = temporal_transform
         self.loader = get_loader()
         self.sample_duration = frames_dur
         self.json_file = json_file
+        self.box_store = BoxStore(json_file)
         self.classes_idx = classes_idx
 
     def __getitem__(self, index):
@@ -407,30 +434,29 @@ class Pics(data.Dataset):
         clip = self.loader(path, frame_indices)
 
         # get original height and width
-        w, h = clip[0].size
-        if self.spatial_transform is not None:
-            clip = [self.spatial_transform(img) for img in clip]
-        clip = torch.stack(clip, 0).permute(1, 0, 2, 3)
+        w, h = original_size(clip[0])
+        if self.clip_transform is not None:
+            clip = self.clip_transform(clip)
+        else:
+            if self.spatial_transform is not None:
+                clip = [self.spatial_transform(img) for img in clip]
+            clip = torch.stack(clip, 0).permute(1, 0, 2, 3)
 
         # get bbox
         cls = self.data[index]['class']
         name = self.data[index]['video']
         json_key = os.path.join(cls, name)
 
-        with open(self.json_file, 'r') as fp:
-            data = json.load(fp)[json_key]
-
         # frames = list(range(time_index, ))
 
-        boxes = [data[i] for i in frame_indices]
+        boxes = torch.from_numpy(self.box_store.boxes(json_key)[frame_indices])
         # print('len(boxes) {}, len(boxes[0] {}'.format(
         #     len(boxes), len(boxes[0])))
 
         class_int = self.classes_idx[cls]
         target = torch.IntTensor([class_int])
         # print('target : ', target)
-        gt_bboxes = torch.Tensor([boxes[i] + [class_int]
-                                  for i in range(len(boxes))])
+        gt_bboxes = torch.cat([boxes, boxes.new_full((boxes.size(0), 1), class_int)], 1)
 
         # print('gt_bboxes ', gt_bboxes)
         if self.mode == 'train':
@@ -0,0 +1,83 @@
+"""
+Per-video frame manifest.
+
+Keeps the frame count, resolution and first/last frame number of every video
+in a json file next to the annotation file, so datasets don't need to list a
+frame directory per video (or per sample). An entry is rebuilt when the mtime
+of its frame directory (or `.shard` file) changes.
+"""
+
+import os
+import io
+import glob
+import json
+
+from PIL import Image
+
+from clip_shards import shard_path_for, open_shard, frame_number
+
+
+def manifest_path_for(annotation_file):
+    return annotation_file + '.manifest.json'
+
+
+def _video_mtime(video_path):
+    if os.path.isdir(video_path):
+        return os.stat(video_path).st_mtime
+    shard_path = shard_path_for(video_path)
+    if os.path.exists(shard_path):
+        return os.stat(shard_path).st_mtime
+    return None
+
+
+def scan_video(video_path, pattern='image_*.jpg'):
+    """Builds the manifest entry of a frame directory or its shard."""
+    entry = {'n_frames': 0, 'width': 0, 'height': 0,
+             'first': 0, 'last': -1, 'mtime': _video_mtime(video_path)}
+
+    if os.path.isdir(video_path):
+        frame_files = glob.glob(os.path.join(video_path, pattern))
+        if len(frame_files) == 0:
+            return entry
+        frames = sorted(frame_number(fl) for fl in frame_files)
+        first_file = min(frame_files, key=frame_number)
+        with Image.open(first_file) as img:  # only reads the header
+            width, height = img.size
+    elif entry['mtime'] is not None:
+        shard = open_shard(shard_path_for(video_path))
+        if len(shard) == 0:
+            return entry
+        frames = shard.frames.tolist()
+        with Image.open(io.BytesIO(shard.frame_buffer(frames[0]))) as img:
+            width, height = img.size
+    else:
+        return entry
+
+    entry.update({'n_frames': len(frames), 'width': width, 'height': height,
+                  'first': frames[0], 'last': frames[-1]})
+    return entry
+
+
+def load_manifest(annotation_file, video_paths, pattern='image_*.jpg'):
+    """Returns {video_path: entry} for `video_paths`, refreshing stale entries
+    and writing the cache back only if something changed."""
+    path = manifest_path_for(annotation_file)
+    manifest = {}
+    if os.path.exists(path):
+        with open(path, 'r') as fp:
+            manifest = json.load(fp)
+
+    changed = False
+    for video_path in video_paths:
+        entry = manifest.get(video_path)
+        if entry is None or entry['mtime'] != _video_mtime(video_path):
+            manifest[video_path] = scan_video(video_path, pattern)
+            changed = True
+
+    if changed:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            json.dump(manifest, fp)
+        os.rename(tmp_path, path)
+
+    return {video_path: manifest[video_path] for video_path in video_paths}